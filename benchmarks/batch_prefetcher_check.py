@@ -0,0 +1,76 @@
+"""
+Ordering check of the pinned-memory batch prefetcher (--prefetch_batches), needs a CUDA device.
+
+The learner holds on to a device batch while it trains on it, and the next upload into the same batch slot is issued
+by the batcher without waiting for the learner on the host. The check makes the learner slow (a GPU sleep before it
+reads the batch) and verifies that:
+- the learner reads the contents of its own upload, the next upload is ordered after its consumed event
+- the batcher gets the pinned host buffer back only after the upload from it completed (which in turn waited for the
+  consumed event of the learner), so it can't overwrite the pinned memory while it is still being copied
+
+Run from the repository root, exits with an error if the prefetcher reuses a buffer too early:
+
+    python -m benchmarks.batch_prefetcher_check
+    python -m benchmarks.batch_prefetcher_check --num_rounds 20 --consumer_sleep_cycles 200000000
+"""
+
+import argparse
+import sys
+from typing import List
+
+import torch
+
+from sample_factory.algo.learning.batcher import BatchPrefetcher
+from sample_factory.algo.utils.tensor_dict import TensorDict
+
+
+def check_prefetcher_ordering(num_rounds: int, batch_numel: int, consumer_sleep_cycles: int) -> List[str]:
+    """:return: descriptions of the ordering violations, empty if every buffer is reused only when it is safe"""
+    device = torch.device("cuda", 0)
+    prefetcher = BatchPrefetcher(device, num_batches=1)
+    device_batch = TensorDict(obs=torch.zeros(batch_numel, device=device))
+
+    violations = []
+    seen = []
+    for round_idx in range(num_rounds):
+        # batcher: gather the trajectories in the pinned buffer and upload them, the host never waits for the learner
+        host_batch = prefetcher.host_buffer(0, device_batch)
+        if round_idx > 0 and not prefetcher.uploaded[0].query():
+            violations.append(f"round {round_idx}: pinned buffer handed out while the previous upload was running")
+        host_batch["obs"].fill_(round_idx)
+        prefetcher.upload(0, device_batch)
+
+        # learner: a slow training step that only reads the batch at the end of it
+        prefetcher.wait_uploaded(0)
+        torch.cuda._sleep(consumer_sleep_cycles)
+        seen.append(device_batch["obs"].clone())
+        prefetcher.mark_consumed(0)
+
+    torch.cuda.synchronize(device)
+    for round_idx, batch in enumerate(seen):
+        values = batch.unique().tolist()
+        if values != [round_idx]:
+            violations.append(f"round {round_idx}: learner read {values}, the batch was overwritten before it was done")
+
+    return violations
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num_rounds", type=int, default=10)
+    parser.add_argument("--batch_numel", type=int, default=4096 * 3 * 72 * 128 // 16, help="Float32 elements")
+    parser.add_argument(
+        "--consumer_sleep_cycles", type=int, default=100_000_000, help="GPU cycles the learner spends on every batch"
+    )
+    args = parser.parse_args()
+
+    if not torch.cuda.is_available():
+        print("SKIPPED, no CUDA device")
+        sys.exit(0)
+
+    problems = check_prefetcher_ordering(args.num_rounds, args.batch_numel, args.consumer_sleep_cycles)
+    print("OK" if not problems else "VIOLATION")
+    for problem in problems[:10]:
+        print(f"    {problem}")
+    if problems:
+        sys.exit(1)
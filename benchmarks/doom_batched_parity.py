@@ -0,0 +1,126 @@
+"""
+Parity check of the batched Doom env (--batched_sampling) against the per-game wrapper stack of make_doom_env_impl().
+Both are stepped with the same seeds and the same random actions, the rewards, costs, true objectives, episode stats,
+done flags and observations have to match for every game and step. A short --episode_horizon makes sure that the
+time limit and the auto-reset of the batched env are covered, deaths end some of the episodes earlier.
+
+Run from the repository root, exits with an error if any of the scenarios differs:
+
+    python -m benchmarks.doom_batched_parity
+    python -m benchmarks.doom_batched_parity --scenarios armament_burden --num_envs 2 --num_steps 1000 --algo PPOCost
+
+PPOCost only works with the safety scenarios, the others don't report a cost.
+"""
+
+import argparse
+import sys
+from typing import List, Sequence
+
+import numpy as np
+
+from sample_factory.doom.env.batched_scenarios import SCENARIO_FUNCTIONS
+from sample_factory.doom.env.doom_batched import make_doom_env_batched
+from sample_factory.doom.env.doom_utils import doom_env_by_name, make_doom_env_impl
+from sample_factory.doom.train_vizdoom import parse_vizdoom_cfg
+from sample_factory.envs.env_utils import EnvCriticalError
+from sample_factory.utils.attr_dict import AttrDict
+
+
+def _obs_array(obs) -> np.ndarray:
+    return obs["obs"] if isinstance(obs, dict) else obs
+
+
+def check_batched_parity(
+    scenario: str, num_envs: int, num_steps: int, episode_horizon: int, seed: int, algo: str
+) -> List[str]:
+    """:return: descriptions of the mismatches, empty if the batched env matches the individual envs"""
+    argv = [
+        f"--envs={scenario}",
+        f"--algo={algo}",
+        f"--episode_horizon={episode_horizon}",
+        "--experiment=doom_batched_parity",
+    ]
+    cfg = parse_vizdoom_cfg(argv=argv)
+    cfg.record = False  # the batched env does not record videos
+    spec = doom_env_by_name(scenario)
+
+    envs = [make_doom_env_impl(spec, cfg=cfg, env_config=AttrDict(env_id=i)) for i in range(num_envs)]
+    batched_env = make_doom_env_batched(spec, cfg, [AttrDict(env_id=i) for i in range(num_envs)])
+    if batched_env is None:
+        return [f"no batched env for {scenario} with --algo={algo}"]
+
+    # VizdoomEnv.reset() ignores seed=0, DoomBatchedEnv seeds the i-th game with seed + i
+    obs = [_obs_array(env.reset(seed=seed + i)[0]).copy() for i, env in enumerate(envs)]
+    batched_obs, _ = batched_env.reset(seed=seed)
+
+    mismatches = []
+
+    def compare(what: str, step: int, i: int, expected, actual) -> None:
+        if not np.allclose(expected, actual, rtol=1e-5, atol=1e-5):
+            mismatches.append(f"step {step} env {i} {what}: individual {expected}, batched {actual}")
+
+    action_space = envs[0].action_space
+    action_space.seed(seed)
+    for step in range(num_steps):
+        for i in range(num_envs):
+            if not np.array_equal(obs[i], batched_obs["obs"][i]):
+                mismatches.append(f"step {step} env {i} observations differ")
+
+        actions = [action_space.sample() for _ in range(num_envs)]
+        batched_obs, rewards, terminated, truncated, infos = batched_env.step(np.stack(actions))
+
+        for i, env in enumerate(envs):
+            env_obs, reward, env_terminated, env_truncated, info = env.step(actions[i])
+            compare("reward", step, i, reward, rewards[i])
+            compare("cost", step, i, info.get("cost", 0.0), infos["cost"][i].item())
+            compare("true_objective", step, i, info.get("true_objective", reward), infos["true_objective"][i].item())
+            compare("terminated", step, i, env_terminated, terminated[i])
+            compare("truncated", step, i, env_truncated, truncated[i])
+            for key, value in info.get("episode_extra_stats", {}).items():
+                if key in infos["episode_extra_stats"]:
+                    compare(f"episode_extra_stats[{key}]", step, i, value, infos["episode_extra_stats"][key][i].item())
+
+            if env_terminated or env_truncated:
+                # the batched env auto-resets finished games
+                env_obs, _ = env.reset()
+            obs[i] = _obs_array(env_obs).copy()
+
+        if len(mismatches) >= 10:
+            break
+
+    for env in envs:
+        env.close()
+    batched_env.close()
+    return mismatches
+
+
+def check_scenarios(
+    scenarios: Sequence[str], num_envs: int, num_steps: int, episode_horizon: int, seed: int, algo: str
+) -> bool:
+    all_match = True
+    for scenario in scenarios:
+        try:
+            mismatches = check_batched_parity(scenario, num_envs, num_steps, episode_horizon, seed, algo)
+        except EnvCriticalError:
+            # i.e. the scenario files are missing, the error is logged by VizdoomEnv
+            print(f"{scenario:20s}: SKIPPED, could not start the game")
+            continue
+        print(f"{scenario:20s}: {'OK' if not mismatches else 'MISMATCH'}")
+        for mismatch in mismatches[:10]:
+            print(f"    {mismatch}")
+        all_match &= not mismatches
+    return all_match
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIO_FUNCTIONS), choices=list(SCENARIO_FUNCTIONS))
+    parser.add_argument("--num_envs", type=int, default=4)
+    parser.add_argument("--num_steps", type=int, default=500)
+    parser.add_argument("--episode_horizon", type=int, default=400, help="In frames, 100 steps at frameskip 4")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--algo", default="PPOLag", help="PPOCost also checks the penalized rewards")
+    args = parser.parse_args()
+
+    if not check_scenarios(args.scenarios, args.num_envs, args.num_steps, args.episode_horizon, args.seed, args.algo):
+        sys.exit(1)
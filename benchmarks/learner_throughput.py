@@ -0,0 +1,142 @@
+"""
+Training throughput of the learners (samples per second, all epochs included) on synthetic experience shaped like
+the Doom envs (72x128 RGB frames, 12 discrete actions). The PPO-style learners are measured for every
+--compile_train_step mode, the others only support eager mode. The first iteration is a warmup that also includes
+the compilation.
+
+Run from the repository root:
+
+    python -m benchmarks.learner_throughput
+    python -m benchmarks.learner_throughput --algos CPO PPODetached --use_rnn --num_iterations 1
+
+Any other arguments are passed on to the learners' config, i.e. --line_search_mode=batched.
+"""
+
+import argparse
+import time
+from typing import Sequence, Tuple
+
+import gymnasium as gym
+import numpy as np
+import torch
+
+from sample_factory.algo.learning.cpo_learner import CPOLearner
+from sample_factory.algo.learning.p3o_learner import P3OLearner
+from sample_factory.algo.learning.ppo_detached_learner import PPODetachedLearner
+from sample_factory.algo.learning.ppo_lag_learner import PPOLagLearner
+from sample_factory.algo.learning.ppo_learner import PPOLearner
+from sample_factory.algo.learning.ppo_pid_learner import PPOPidLearner
+from sample_factory.algo.learning.trpo_lag_learner import TRPOLagLearner
+from sample_factory.algo.learning.trpo_learner import TRPOLearner
+from sample_factory.algo.learning.trpo_pid_learner import TRPOPidLearner
+from sample_factory.algo.utils.env_info import EnvInfo
+from sample_factory.algo.utils.model_sharing import ParameterServer
+from sample_factory.algo.utils.shared_buffers import alloc_trajectory_tensors
+from sample_factory.algo.utils.tensor_dict import shallow_recursive_copy
+from sample_factory.cfg.arguments import parse_full_cfg, parse_sf_args
+from sample_factory.model.model_utils import get_rnn_size
+from sample_factory.utils.dicts import iterate_recursively
+
+# learners by algorithm name, PPODetached is PPO with --actor_critic_share_weights=False (see LearnerWorker)
+LEARNERS = dict(
+    PPO=PPOLearner,
+    PPODetached=PPODetachedLearner,
+    PPOLag=PPOLagLearner,
+    PPOPID=PPOPidLearner,
+    P3O=P3OLearner,
+    TRPO=TRPOLearner,
+    TRPOLag=TRPOLagLearner,
+    TRPOPID=TRPOPidLearner,
+    CPO=CPOLearner,
+)
+
+
+def benchmark_learner_throughput(
+    algos: Tuple[str, ...] = tuple(LEARNERS),
+    compile_modes: Tuple[str, ...] = ("off", "default"),
+    use_rnn: bool = False,
+    batch_size: int = 1024,
+    num_epochs: int = 2,
+    num_iterations: int = 5,
+    extra_argv: Sequence[str] = (),
+) -> None:
+    obs_space = gym.spaces.Dict(obs=gym.spaces.Box(0, 255, (3, 72, 128), dtype=np.uint8))
+    action_space = gym.spaces.Discrete(12)
+    env_info = EnvInfo(
+        "benchmark", obs_space, action_space, 1, False, False, [1], True, 4, safety_bound=5.0, timeout=2100
+    )
+
+    for algo in algos:
+        learner_cls = LEARNERS[algo]
+        modes = compile_modes if learner_cls in (PPOLearner, PPOLagLearner, PPOPidLearner, P3OLearner) else ("off",)
+        for mode in modes:
+            argv = [
+                f"--algo={'PPO' if algo == 'PPODetached' else algo}",
+                "--envs=benchmark",
+                "--experiment=benchmark_learner_throughput",
+                "--serial_mode=True",
+                "--device=cpu",
+                f"--use_rnn={use_rnn}",
+                f"--recurrence={32 if use_rnn else 1}",
+                f"--batch_size={batch_size}",
+                f"--num_epochs={num_epochs}",
+                f"--compile_train_step={mode}",
+                *extra_argv,
+            ]
+            if algo in ("CPO", "PPODetached"):
+                argv.append("--actor_critic_share_weights=False")
+            parser, _ = parse_sf_args(argv)
+            cfg = parse_full_cfg(parser, argv)
+
+            torch.manual_seed(0)
+            policy_versions = torch.zeros([1], dtype=torch.int32)
+            param_server = ParameterServer(0, policy_versions, cfg.serial_mode)
+            learner = learner_cls(cfg, env_info, policy_versions, 0, param_server)
+            learner.init()
+
+            num_traj = batch_size // cfg.rollout
+            batch = alloc_trajectory_tensors(
+                cfg.algo, env_info, num_traj, cfg.rollout, get_rnn_size(cfg), torch.device("cpu"), False
+            )
+            for _, key, tensor in iterate_recursively(batch):
+                if tensor.dtype == torch.uint8:
+                    tensor.random_(0, 256)
+                elif tensor.dtype.is_floating_point:
+                    tensor.normal_()
+            batch["actions"].random_(0, action_space.n)
+            batch["log_prob_actions"].fill_(-np.log(action_space.n))
+            batch["dones"].bernoulli_(0.01)
+            batch["policy_id"].fill_(0)
+            batch["policy_version"].fill_(0)
+
+            def iteration():
+                learner.train_step = 0  # keep all the experience valid regardless of --max_policy_lag
+                learner.train(shallow_recursive_copy(batch))
+
+            iteration()  # warmup
+            start = time.time()
+            for _ in range(num_iterations):
+                iteration()
+            samples_per_sec = num_iterations * batch_size * num_epochs / (time.time() - start)
+            print(f"{algo:>11} compile_train_step={mode:<16}: {samples_per_sec:8.0f} samples/sec")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--algos", nargs="+", default=list(LEARNERS), choices=list(LEARNERS))
+    parser.add_argument("--compile_modes", nargs="+", default=["off", "default"])
+    parser.add_argument("--use_rnn", action="store_true")
+    parser.add_argument("--batch_size", type=int, default=1024)
+    parser.add_argument("--num_epochs", type=int, default=2)
+    parser.add_argument("--num_iterations", type=int, default=5)
+    args, extra_argv = parser.parse_known_args()
+
+    benchmark_learner_throughput(
+        tuple(args.algos),
+        tuple(args.compile_modes),
+        args.use_rnn,
+        args.batch_size,
+        args.num_epochs,
+        args.num_iterations,
+        extra_argv,
+    )
@@ -0,0 +1,608 @@
+"""
+Micro-benchmarks of single components of the library, each against the code path or setting it replaced: the
+legacy implementations are kept here as a reference, the library only ships the new ones. The benchmarks that
+replace a computation also check that both versions agree on their inputs.
+
+Run from the repository root:
+
+    python -m benchmarks.micro_benchmarks              # all of them
+    python -m benchmarks.micro_benchmarks pack_info    # only some
+"""
+
+import argparse
+import queue
+import sys
+import threading
+import time
+from queue import Empty
+from typing import Callable, List, Sequence, Tuple, Type
+
+import gymnasium as gym
+import numpy as np
+import torch
+from signal_slot.queue_utils import get_queue
+from signal_slot.signal_slot import EventLoop
+from torch import Tensor, nn
+
+from sample_factory.algo.learning import rnn_utils
+from sample_factory.algo.learning.batcher import Batcher
+from sample_factory.algo.learning.natural_gradient import FisherVectorProduct, conjugate_gradient, flatten_grads
+from sample_factory.algo.sampling.inference_batching import AdaptiveInferenceBatching, InferenceBatching
+from sample_factory.algo.utils import rl_utils
+from sample_factory.algo.utils.env_info import EnvInfo
+from sample_factory.algo.utils.model_sharing import ParameterServer, make_parameter_client
+from sample_factory.algo.utils.shared_buffers import alloc_trajectory_tensors
+from sample_factory.cfg.arguments import parse_full_cfg, parse_sf_args
+from sample_factory.doom.env.batched_scenarios import SCENARIO_FUNCTIONS, ScenarioFunction
+from sample_factory.model.actor_critic import create_actor_critic
+from sample_factory.model.model_utils import get_rnn_size
+from sample_factory.utils.attr_dict import AttrDict
+from sample_factory.utils.dicts import iterate_recursively
+from sample_factory.utils.timing import Timing
+
+
+def _legacy_build_pack_info_from_dones(
+    dones: torch.Tensor, T: int
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """_build_pack_info_from_dones() as it used to be, with a loop over the unique sequence lengths."""
+    num_samples = len(dones)
+
+    rollout_boundaries = dones.clone().detach()
+    rollout_boundaries[T - 1 :: T] = 1
+    rollout_boundaries = rollout_boundaries.nonzero(as_tuple=False).squeeze(dim=1) + 1
+
+    first_len = rollout_boundaries[0].unsqueeze(0)
+    if len(rollout_boundaries) <= 1:
+        rollout_lengths = first_len
+    else:
+        rollout_lengths = torch.cat([first_len, rollout_boundaries[1:] - rollout_boundaries[:-1]])
+
+    rollout_starts_orig = rollout_boundaries - rollout_lengths
+
+    is_new_episode = dones.clone().detach().view((-1, T)).roll(1, 1)
+    is_new_episode[:, 0] = 0
+    is_new_episode = is_new_episode.view((-1,))
+
+    lengths, sorted_indices = torch.sort(rollout_lengths, descending=True)
+    cpu_lengths = lengths.to(device="cpu", non_blocking=True)
+    rollout_starts_sorted = rollout_starts_orig.index_select(0, sorted_indices)
+
+    select_inds = torch.empty(num_samples, device=dones.device, dtype=torch.int64)
+    max_length = int(cpu_lengths[0].item())
+    batch_sizes = torch.empty((max_length,), device="cpu", dtype=torch.int64)
+
+    offset = 0
+    prev_len = 0
+    num_valid_for_length = lengths.size(0)
+
+    unique_lengths = torch.unique_consecutive(cpu_lengths)
+    for i in range(len(unique_lengths) - 1, -1, -1):
+        valids = lengths[0:num_valid_for_length] > prev_len
+        num_valid_for_length = int(valids.float().sum().item())
+        next_len = int(unique_lengths[i])
+        batch_sizes[prev_len:next_len] = num_valid_for_length
+
+        new_inds = (
+            rollout_starts_sorted[0:num_valid_for_length].view(1, num_valid_for_length)
+            + torch.arange(prev_len, next_len, device=rollout_starts_sorted.device).view(next_len - prev_len, 1)
+        ).view(-1)
+        select_inds[offset : offset + new_inds.numel()] = new_inds
+        offset += new_inds.numel()
+        prev_len = next_len
+
+    return rollout_starts_orig, is_new_episode, select_inds, batch_sizes, sorted_indices
+
+
+def benchmark_pack_info(batch_size: int = 2048, recurrence: int = 32, num_builds: int = 20) -> None:
+    """
+    Time to build the pack info of a minibatch with the done patterns of HASARD scenarios: full-length episodes
+    (~500 agent steps, the 2100 frame timeout with frameskip 4), short episodes of scenarios where the agent dies
+    quickly, and the same with the trajectories of another policy marked invalid (done_or_invalid in the learners).
+    "cached" is the cost per build when the same minibatch is packed `num_builds` times, i.e. by three towers and
+    a few line search candidates.
+    """
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    generator = torch.Generator().manual_seed(0)
+
+    def dones_for(mean_episode_len: float, invalid_fraction: float = 0.0) -> Tensor:
+        dones = (torch.rand(batch_size, generator=generator) < 1.0 / mean_episode_len).float()
+        invalid = torch.rand(batch_size, generator=generator) < invalid_fraction
+        return torch.logical_or(dones, invalid).float()
+
+    patterns = {
+        "full episodes (~500 steps)": dones_for(500),
+        "short episodes (~50 steps)": dones_for(50),
+        "very short episodes (~10 steps)": dones_for(10),
+        "short episodes + 10% invalid": dones_for(50, 0.1),
+    }
+
+    def timed(fn) -> float:
+        fn()  # warmup
+        start = time.time()
+        for _ in range(num_builds):
+            fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        return (time.time() - start) / num_builds * 1000
+
+    for name, dones in patterns.items():
+        dones = dones.to(device)
+        legacy = _legacy_build_pack_info_from_dones(dones, recurrence)
+        vectorized = rnn_utils._build_pack_info_from_dones(dones, recurrence)
+        # sequences of the same length can be in any order, as long as select_inds and sorted_indices agree
+        for old, new in zip(legacy, vectorized):
+            assert old.shape == new.shape
+        assert torch.equal(legacy[3], vectorized[3])
+        assert torch.equal(legacy[2].sort().values, vectorized[2].sort().values)
+
+        t_legacy = timed(lambda: _legacy_build_pack_info_from_dones(dones, recurrence))
+        t_vectorized = timed(lambda: rnn_utils._build_pack_info_from_dones(dones, recurrence))
+        t_cached = timed(lambda: rnn_utils._pack_info_cache.get(dones.clone(), recurrence, device))
+        print(
+            f"{name:>32}: legacy {t_legacy:6.2f} ms, vectorized {t_vectorized:6.2f} ms, cached {t_cached:6.3f} ms"
+            f" ({len(legacy[4])} sequences)"
+        )
+
+
+def benchmark_multi_stream_gae(
+    num_envs: int = 1024, rollouts=(32, 256), num_streams: int = 2, chunk_sizes=(0, 8, 16), iters: int = 20
+) -> None:
+    """
+    Time the advantage computation of a safe RL batch: one gae_advantages() call per stream versus a single
+    multi_stream_gae() pass (sequential or chunked scan), and check that all of them agree.
+    """
+    γ, λ = 0.99, 0.95
+    for rollout in rollouts:
+        rewards = torch.randn(num_streams, num_envs, rollout)
+        values = torch.randn(num_streams, num_envs, rollout + 1)
+        dones = torch.rand(num_envs, rollout) < 0.05
+        valids = torch.rand(num_envs, rollout + 1) > 0.05
+
+        def per_stream():
+            advantages = [
+                rl_utils.gae_advantages(rewards[s], dones, values[s], valids, γ, λ) for s in range(num_streams)
+            ]
+            return torch.stack(advantages)
+
+        reference = per_stream()
+
+        def fused(chunk_size: int):
+            return rl_utils.multi_stream_gae(rewards, dones, values, valids, γ, λ, chunk_size)[0]
+
+        candidates = [("per-stream", per_stream)]
+        candidates += [(f"fused chunk={c}", lambda c=c: fused(c)) for c in chunk_sizes]
+
+        for name, fn in candidates:
+            max_err = (fn() - reference).abs().max().item()
+            start = time.time()
+            for _ in range(iters):
+                fn()
+            elapsed_ms = (time.time() - start) / iters * 1000
+            print(f"T={rollout:4d} S={num_streams} {name:18s} {elapsed_ms:8.3f} ms/batch  max_err={max_err:.2e}")
+
+
+def _legacy_fisher_vector_product(kl_func: Callable[[], Tensor], params: Sequence[Tensor], damping: float):
+    """Fisher-vector products as TRPOLearner used to compute them, rebuilding the KL gradient graph every time."""
+
+    def fvp(v: Tensor) -> Tensor:
+        kl_grad = torch.autograd.grad(kl_func(), params, create_graph=True)
+        flat_kl_grad = torch.cat([g.contiguous().view(-1) for g in kl_grad])
+        kl_hessian = torch.autograd.grad((flat_kl_grad * v).sum(), params, retain_graph=True)
+        return torch.cat([g.contiguous().view(-1) for g in kl_hessian]).detach() + damping * v
+
+    return fvp
+
+
+def _legacy_conjugate_gradient(avp: Callable[[Tensor], Tensor], b: Tensor, nsteps: int, residual_tol: float) -> Tensor:
+    x = torch.zeros_like(b)
+    r = b.clone()
+    p = r.clone()
+    rdotr = r.dot(r)
+    for _ in range(nsteps):
+        avp_p = avp(p)
+        alpha = rdotr / (p.dot(avp_p) + 1e-8)
+        x += alpha * p
+        r -= alpha * avp_p
+        new_rdotr = r.dot(r)
+        if new_rdotr < residual_tol:
+            break
+        p = r + (new_rdotr / rdotr) * p
+        rdotr = new_rdotr
+    return x
+
+
+def benchmark_natural_gradient(
+    batch_size: int = 512, recurrence: int = 32, cg_nsteps: int = 10, fvp_subsample: float = 0.25, num_updates: int = 5
+) -> None:
+    """
+    Wall-clock time of the natural gradient part of a TRPO update (policy gradient, CG solve and step size) with
+    a policy shaped like the default Doom model: conv encoder, GRU core and a discrete action head.
+    """
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    torch.manual_seed(0)
+
+    encoder = nn.Sequential(
+        nn.Conv2d(3, 32, 8, stride=4), nn.ELU(),
+        nn.Conv2d(32, 64, 4, stride=2), nn.ELU(),
+        nn.Conv2d(64, 128, 3, stride=2), nn.ELU(),
+        nn.Flatten(),
+    ).to(device)
+    obs = torch.randn(batch_size, 3, 72, 128, device=device)
+    with torch.no_grad():
+        encoder_out_size = encoder(obs[:1]).shape[1]
+    linear, core, head = nn.Linear(encoder_out_size, 512), nn.GRU(512, 512), nn.Linear(512, 12)
+    modules = [m.to(device) for m in (encoder, linear, core, head)]
+    params = [p for m in modules for p in m.parameters()]
+
+    def logits(x: Tensor) -> Tensor:
+        num_trajectories = len(x) // recurrence
+        h = torch.relu(linear(encoder(x))).view(num_trajectories, recurrence, -1).transpose(0, 1)
+        core_out, _ = core(h)
+        return head(core_out.transpose(0, 1).reshape(len(x), -1))
+
+    with torch.no_grad():
+        old_log_probs = torch.log_softmax(logits(obs) + 0.1 * torch.randn(batch_size, 12, device=device), dim=-1)
+    advantages = torch.randn(batch_size, 1, device=device)
+
+    def kl(log_probs: Tensor, old: Tensor) -> Tensor:
+        return (old.exp() * (old - log_probs)).sum(dim=-1).mean()
+
+    def update(variant: str) -> Tensor:
+        log_probs = torch.log_softmax(logits(obs), dim=-1)
+        loss = -(log_probs * advantages).mean()
+        grads = flatten_grads(torch.autograd.grad(loss, params, retain_graph=True), params)
+
+        if variant == "legacy":
+            fvp = _legacy_fisher_vector_product(lambda: kl(log_probs, old_log_probs), params, 0.1)
+            step_dir = _legacy_conjugate_gradient(fvp, grads, cg_nsteps, 1e-10)
+        else:
+            if variant == "subsampled":
+                n = max(1, int(batch_size // recurrence * fvp_subsample)) * recurrence
+                fvp_kl = kl(torch.log_softmax(logits(obs[:n]), dim=-1), old_log_probs[:n])
+            else:
+                fvp_kl = kl(log_probs, old_log_probs)
+            fvp = FisherVectorProduct(fvp_kl, params, 0.1)
+            step_dir = conjugate_gradient(fvp, grads, cg_nsteps, 1e-10)
+
+        shs = 0.5 * (step_dir * fvp(step_dir)).sum()
+        return step_dir * torch.sqrt(0.01 / shs)
+
+    def synchronize():
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+
+    results = dict()
+    for variant in ("legacy", "fused", "subsampled"):
+        update(variant)  # warmup
+        synchronize()
+        start = time.time()
+        for _ in range(num_updates):
+            results[variant] = update(variant)
+        synchronize()
+        print(f"{variant:>10}: {(time.time() - start) / num_updates * 1000:8.1f} ms per update")
+
+    for variant in ("fused", "subsampled"):
+        cos = torch.nn.functional.cosine_similarity(results[variant], results["legacy"], dim=0)
+        print(f"{variant:>10}: cosine similarity of the step with the legacy one {cos.item():.4f}")
+
+
+def benchmark_batcher(batch_size: int = 4096, rollout: int = 32, num_batches: int = 20) -> None:
+    """
+    Time to hand a training batch to the learner and release its trajectories afterwards, with and without
+    --zero_copy_batches, for trajectories shaped like the Doom envs (72x128 RGB frames). The trajectories of a batch
+    arrive as one contiguous slice, as they do with batched sampling.
+    """
+    obs_space = gym.spaces.Dict(obs=gym.spaces.Box(0, 255, (3, 72, 128), dtype=np.uint8))
+    env_info = EnvInfo(
+        "benchmark", obs_space, gym.spaces.Discrete(12), 1, False, False, [1], True, 4, safety_bound=5.0, timeout=2100
+    )
+    num_traj = batch_size // rollout
+
+    for zero_copy in (False, True):
+        argv = [
+            "--algo=PPOLag",
+            "--envs=benchmark",
+            "--experiment=benchmark_batcher",
+            "--serial_mode=True",
+            "--device=cpu",
+            "--async_rl=False",
+            f"--rollout={rollout}",
+            f"--batch_size={batch_size}",
+            f"--zero_copy_batches={zero_copy}",
+        ]
+        parser, _ = parse_sf_args(argv)
+        cfg = parse_full_cfg(parser, argv)
+
+        traj_tensors = alloc_trajectory_tensors(
+            cfg.algo, env_info, num_traj, rollout, get_rnn_size(cfg), torch.device("cpu"), False
+        )
+        traj_tensors["obs"]["obs"].random_(0, 256)
+        buffer_mgr = AttrDict(
+            trajectories_per_training_iteration=num_traj,
+            sampling_trajectories_per_iteration=num_traj,
+            traj_tensors_torch={"cpu": traj_tensors},
+            traj_buffer_queues={"cpu": get_queue(cfg.serial_mode)},
+            max_batches_to_accumulate=1,
+        )
+        batcher = Batcher(EventLoop("benchmark_batcher", serial_mode=True), 0, buffer_mgr, cfg, env_info)
+        batcher.init()
+
+        def batch_round_trip():
+            batcher.on_new_trajectories([dict(policy_id=0, traj_buffer_idx=slice(0, num_traj))], "cpu")
+            batch = batcher.training_batches[0]
+            batcher.on_training_batch_released(0, 0)
+            buffer_mgr.traj_buffer_queues["cpu"].get_many()
+            return batch
+
+        batch = batch_round_trip()  # warmup
+        shares_memory = batch["obs"]["obs"].data_ptr() == traj_tensors["obs"]["obs"].data_ptr()
+        start = time.time()
+        for _ in range(num_batches):
+            batch_round_trip()
+        ms_per_batch = (time.time() - start) / num_batches * 1000
+        batch_buffers_mb = sum(
+            t.numel() * t.element_size()
+            for buffers in batcher.batch_buffers
+            if buffers is not None
+            for _, _, t in iterate_recursively(buffers)
+        ) / 2**20
+        print(
+            f"zero_copy_batches={zero_copy!s:<5}: {ms_per_batch:7.2f} ms/batch,"
+            f" batch buffers {batch_buffers_mb:7.1f} MB,"
+            f" {'reads trajectories in place' if shares_memory else 'copies trajectories'}"
+        )
+
+
+def benchmark_weight_updates(num_updates: int = 100, train_step_sec: float = 0.005, inference_step_sec: float = 0.002):
+    """
+    Stall of a policy worker per weight update, with the weights copied under the policy lock vs double-buffered,
+    for models shaped like the Doom envs (72x128 RGB frames): the shared-weights constrained model (PPOLag) and the
+    three-tower constrained models (TRPOLag, separate actor, critic and cost critic) with small and large encoders.
+    A learner thread updates the weights in-place under the policy lock and publishes them every `train_step_sec`,
+    the policy worker checks for new weights before every inference step, the stall is the time of these checks
+    that found new weights, including the time spent waiting for the lock.
+    """
+    obs_space = gym.spaces.Dict(obs=gym.spaces.Box(0, 255, (3, 72, 128), dtype=np.uint8))
+    env_info = EnvInfo(
+        "benchmark", obs_space, gym.spaces.Discrete(12), 1, False, False, [1], True, 4, safety_bound=5.0, timeout=2100
+    )
+    models = dict(
+        ppo_lag_simple=("PPOLag", "convnet_simple"),
+        trpo_lag_simple=("TRPOLag", "convnet_simple"),
+        trpo_lag_resnet=("TRPOLag", "resnet_impala"),
+    )
+
+    for name, (algo, encoder) in models.items():
+        for double_buffered in (False, True):
+            argv = [
+                f"--algo={algo}",
+                "--envs=benchmark",
+                "--experiment=benchmark_weight_updates",
+                "--serial_mode=False",
+                "--device=cpu",
+                f"--encoder_conv_architecture={encoder}",
+                f"--double_buffered_weights={double_buffered}",
+            ]
+            parser, _ = parse_sf_args(argv)
+            cfg = parse_full_cfg(parser, argv)
+
+            actor_critic = create_actor_critic(cfg, obs_space, env_info.action_space)
+            actor_critic._apply(lambda t: t.share_memory_())
+            num_params = sum(p.numel() for p in actor_critic.parameters())
+
+            policy_versions = torch.zeros([1], dtype=torch.int32)
+            server = ParameterServer(0, policy_versions, cfg.serial_mode, 1 if double_buffered else 0)
+            device = torch.device("cpu")
+            server.init(actor_critic, 0, device)
+            state_dict = server.shared_weights if double_buffered else actor_critic.state_dict()
+
+            timing = Timing()
+            client = make_parameter_client(cfg.serial_mode, server, cfg, env_info, timing)
+            client.on_weights_initialized(state_dict, device, 0)
+
+            stop = threading.Event()
+
+            def learner_loop():
+                version = 0
+                while not stop.is_set():
+                    with torch.no_grad(), server.policy_lock:
+                        for p in actor_critic.parameters():
+                            p.add_(1e-6)  # optimizer step
+                    version += 1
+                    server.update_weights(version)
+                    time.sleep(train_step_sec)
+
+            learner_thread = threading.Thread(target=learner_loop)
+            learner_thread.start()
+
+            stalls = []
+            while len(stalls) < num_updates:
+                version = client.policy_version
+                start = time.time()
+                client.ensure_weights_updated()
+                if client.policy_version != version:
+                    stalls.append(time.time() - start)
+                time.sleep(inference_step_sec)
+
+            stop.set()
+            learner_thread.join()
+            client.cleanup()
+
+            stalls_ms = np.array(stalls) * 1000
+            print(
+                f"{name:>16} ({num_params / 1e6:5.2f}M params) double_buffered={double_buffered!s:<5}: "
+                f"stall per update mean {stalls_ms.mean():7.3f} ms, p99 {np.percentile(stalls_ms, 99):7.3f} ms"
+            )
+
+
+def benchmark_inference_batching(duration_sec: float = 5.0, warmup_sec: float = 1.0) -> None:
+    """
+    Throughput and latency of fixed vs adaptive batching in a closed loop: every rollout worker steps its envs,
+    sends a request and waits for the actions, a policy worker runs the forward passes (with a fixed and a
+    per-sample cost). Two scenarios where the fixed 25 ms window does not fit:
+    - cpu_bound: a model dominated by the fixed cost (e.g. the three towers of a constrained model) that competes for
+      the CPU with the envs. Both busy-wait while holding the GIL, i.e. they share a single core. Small batches spend
+      the CPU on the fixed cost of the forward pass instead of stepping the envs.
+    - slow_envs: slow env steps and a cheap model. The fixed window waits for min_num_requests requests that arrive
+      slowly, which adds latency to every env step for nothing.
+    """
+    # num_workers, samples per request, env step, env step uses the CPU, fixed and per-sample cost of the forward
+    scenarios = dict(
+        cpu_bound=(6, 4, 0.001, True, 0.003, 0.00002),
+        slow_envs=(16, 4, 0.02, False, 0.0003, 0.00001),
+    )
+
+    def busy_wait(seconds: float) -> None:
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            pass
+
+    def get_many(q: queue.Queue, timeout: float) -> List:
+        items = [q.get(timeout=timeout)]
+        while True:
+            try:
+                items.append(q.get_nowait())
+            except Empty:
+                return items
+
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(0.0002)  # closer to a fair share of the core
+
+    for scenario, (num_workers, samples_per_request, env_step, env_uses_cpu, fixed_cost, per_sample_cost) in (
+        scenarios.items()
+    ):
+        min_num_requests = max(1, num_workers // 3)
+        for name in ("fixed", "adaptive 10ms", "adaptive 25ms"):
+            if name == "fixed":
+                batching = InferenceBatching(min_num_requests)
+            else:
+                batching = AdaptiveInferenceBatching(min_num_requests, float(name.split()[1][:-2]) / 1000)
+
+            requests_queue = queue.Queue()
+            actions_ready = [threading.Event() for _ in range(num_workers)]
+            stop = threading.Event()
+            total_samples = num_forward_passes = 0
+
+            def rollout_worker(worker_idx: int):
+                while not stop.is_set():
+                    busy_wait(env_step) if env_uses_cpu else time.sleep(env_step)
+                    requests_queue.put(worker_idx)
+                    actions_ready[worker_idx].wait()
+                    actions_ready[worker_idx].clear()
+
+            workers = [threading.Thread(target=rollout_worker, args=(i,)) for i in range(num_workers)]
+            for w in workers:
+                w.start()
+
+            requests, request_times = [], []
+            # measured here, the fixed batching doesn't record any stats
+            queueing_delays, latencies = [], []
+            start = time.time()
+            warmed_up = False
+            while time.time() - start < warmup_sec + duration_sec:
+                if not warmed_up and time.time() - start > warmup_sec:
+                    # only report the steady state
+                    warmed_up = True
+                    queueing_delays, latencies = [], []
+                    total_samples = num_forward_passes = 0
+                waiting_started = time.time()
+                oldest_request = request_times[0] if request_times else None
+                while batching.should_wait(len(requests), waiting_started, oldest_request):
+                    try:
+                        new_requests = get_many(requests_queue, batching.poll_timeout(oldest_request))
+                        requests.extend(new_requests)
+                        request_times.extend([time.time()] * len(new_requests))
+                        oldest_request = request_times[0]
+                    except Empty:
+                        pass
+                if not requests:
+                    continue
+
+                num_samples = len(requests) * samples_per_request
+                forward_started = time.time()
+                busy_wait(fixed_cost + per_sample_cost * num_samples)
+                forward_sec = time.time() - forward_started
+                for worker_idx in requests:
+                    actions_ready[worker_idx].set()
+                received, finished = np.array(request_times), time.time()
+                batching.on_policy_step(num_samples, received, forward_started, forward_sec, finished)
+                queueing_delays.extend(forward_started - received)
+                latencies.extend(finished - received)
+                total_samples += num_samples
+                num_forward_passes += 1
+                requests, request_times = [], []
+
+            stop.set()
+            for event in actions_ready:
+                event.set()
+            for w in workers:
+                w.join()
+
+            print(
+                f"{scenario:>9} {name:<13}: {total_samples / duration_sec:7.0f} samples/sec,"
+                f" mean batch {total_samples / num_forward_passes:6.1f},"
+                f" queueing delay p99 {np.percentile(queueing_delays, 99) * 1000:6.2f} ms,"
+                f" latency p99 {np.percentile(latencies, 99) * 1000:6.2f} ms"
+            )
+
+    sys.setswitchinterval(switch_interval)
+
+
+def benchmark_scenario_function(
+    scenario_cls: Type[ScenarioFunction], num_envs: int, num_steps: int = 2000, episode_len: int = 500
+) -> float:
+    """
+    Step overhead of a scenario function on random game variables, without the game itself.
+    :return: microseconds per step of the whole batch
+    """
+    rng = np.random.default_rng(0)
+    num_vars = len(scenario_cls.variables)
+    # small non-negative integers, so that counters and ids behave somewhat like in the game
+    trace = rng.integers(0, 4, size=(num_steps, num_envs, num_vars)).astype(np.float64)
+    game_rewards = rng.random((num_steps, num_envs), dtype=np.float32)
+
+    scenario = scenario_cls(num_envs)
+    rewards = np.zeros(num_envs, dtype=np.float32)
+    costs, true_objective = np.zeros_like(rewards), np.zeros_like(rewards)
+    all_envs, no_envs = np.ones(num_envs, dtype=bool), np.zeros(num_envs, dtype=bool)
+    scenario.reset(all_envs, trace[0])
+
+    start = time.perf_counter()
+    for t in range(num_steps):
+        rewards[:] = game_rewards[t]
+        episode_end = t % episode_len == episode_len - 1
+        scenario.step(trace[t], all_envs if episode_end else no_envs, rewards, costs, true_objective)
+        if episode_end:
+            scenario.reset(all_envs, trace[t])
+    return (time.perf_counter() - start) / num_steps * 1e6
+
+
+def benchmark_scenario_functions(num_envs=(1, 8, 64)) -> None:
+    """Step overhead of the vectorized reward and cost function of every scenario, see batched_scenarios.py."""
+    for scenario_name, cls in SCENARIO_FUNCTIONS.items():
+        timings = ", ".join(f"N={n}: {benchmark_scenario_function(cls, n):.1f}us" for n in num_envs)
+        print(f"{scenario_name:20s} {timings}")
+
+
+BENCHMARKS = dict(
+    pack_info=benchmark_pack_info,
+    multi_stream_gae=benchmark_multi_stream_gae,
+    natural_gradient=benchmark_natural_gradient,
+    batcher=benchmark_batcher,
+    weight_updates=benchmark_weight_updates,
+    inference_batching=benchmark_inference_batching,
+    scenario_functions=benchmark_scenario_functions,
+)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmarks", nargs="*", help=f"any of {', '.join(BENCHMARKS)} (default: all)")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name!r}")
+
+    for name in args.benchmarks or BENCHMARKS:
+        print(f"{name}:")
+        BENCHMARKS[name]()
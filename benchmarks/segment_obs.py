@@ -0,0 +1,93 @@
+"""
+Per-frame cost of VizdoomEnv.segment_obs() (--segment_objects) against the per-label mask implementation it
+replaced, on frames recorded from the scenarios with random actions at the default resolution. Only the
+segmentation is timed, not the env steps. Both have to produce identical frames.
+
+Run from the repository root:
+
+    python -m benchmarks.segment_obs
+    python -m benchmarks.segment_obs --scenarios armament_burden --num_frames 1000
+"""
+
+import argparse
+import functools
+import time
+from types import SimpleNamespace
+from typing import Sequence
+
+import cv2
+import numpy as np
+
+from sample_factory.doom.env.doom_gym import VizdoomEnv
+from sample_factory.doom.env.doom_utils import doom_env_by_name, make_doom_env_impl
+from sample_factory.doom.train_vizdoom import parse_vizdoom_cfg
+
+
+def _legacy_segment_obs(env: VizdoomEnv, obs, state):
+    """segment_obs() as it used to be, with one full-frame mask per label value."""
+    obs = cv2.cvtColor(obs, cv2.COLOR_RGB2BGR)
+    label_buffer = state.labels_buffer.astype(np.uint8)
+    value_to_object = {}
+    for label in state.labels:
+        env.unique_label_names.add(label.object_name)
+        value_to_object[label.value] = label.object_name
+    for value, object_name in value_to_object.items():
+        if object_name not in env.object_name_to_color:
+            env.object_name_to_color[object_name] = env._generate_unique_color()
+    segmented_obs = np.zeros_like(obs)
+    for value in np.unique(label_buffer):
+        object_name = value_to_object.get(value, None)
+        if object_name is not None:
+            color = env.object_name_to_color[object_name]
+        else:
+            color = env.object_id_to_color.get(value, None)
+        if color is None:
+            color = env.default_color
+        mask = (label_buffer == value).astype(np.uint8)
+        for i in range(3):
+            segmented_obs[:, :, i] += mask * color[i]
+    return segmented_obs
+
+
+def benchmark_segment_obs(scenarios: Sequence[str], num_frames: int) -> None:
+    for scenario in scenarios:
+        argv = [f"--envs={scenario}", "--segment_objects", "--experiment=benchmark_segment_obs"]
+        cfg = parse_vizdoom_cfg(argv=argv)
+        env = make_doom_env_impl(doom_env_by_name(scenario), cfg=cfg)
+        doom = env.unwrapped
+
+        frames = []
+        env.reset(seed=0)
+        env.action_space.seed(0)
+        while len(frames) < num_frames:
+            _, _, terminated, truncated, _ = env.step(env.action_space.sample())
+            if terminated or truncated:
+                env.reset()
+                continue
+            state = doom.game.get_state()
+            labels = [SimpleNamespace(value=label.value, object_name=label.object_name) for label in state.labels]
+            recorded_state = SimpleNamespace(labels=labels, labels_buffer=state.labels_buffer.copy())
+            frames.append((state.screen_buffer.copy(), recorded_state))
+        env.close()
+
+        results = dict()
+        num_labels = np.mean([len(state.labels) for _, state in frames])
+        legacy = functools.partial(_legacy_segment_obs, doom)
+        for name, segment in (("palette", doom.segment_obs), ("per-label", legacy)):
+            segment(*frames[0])  # warmup, also assigns the colors of all objects seen so far
+            start = time.perf_counter()
+            results[name] = [segment(obs, state) for obs, state in frames]
+            per_frame_us = (time.perf_counter() - start) / num_frames * 1e6
+            print(f"{scenario:20s} {name:>10}: {per_frame_us:8.1f} us/frame ({num_labels:.1f} labels/frame)")
+
+        identical = all(np.array_equal(a, b) for a, b in zip(results["palette"], results["per-label"]))
+        print(f"{scenario:20s} identical frames: {identical}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", default=["collateral_damage", "detonators_dilemma"])
+    parser.add_argument("--num_frames", type=int, default=300)
+    args = parser.parse_args()
+
+    benchmark_segment_obs(args.scenarios, args.num_frames)
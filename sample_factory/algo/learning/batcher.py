@@ -6,10 +6,16 @@ from signal_slot.signal_slot import EventLoop, signal
 
 from sample_factory.algo.utils.env_info import EnvInfo
 from sample_factory.algo.utils.heartbeat import HeartbeatStoppableEventLoopObject
-from sample_factory.algo.utils.shared_buffers import BufferMgr, alloc_trajectory_tensors, policy_device
+from sample_factory.algo.utils.shared_buffers import (
+    BufferMgr,
+    alloc_trajectory_tensors,
+    policy_device,
+    zero_copy_batches,
+)
 from sample_factory.algo.utils.tensor_dict import TensorDict
 from sample_factory.model.model_utils import get_rnn_size
 from sample_factory.utils.attr_dict import AttrDict
+from sample_factory.utils.dicts import copy_dict_structure, iter_dicts_recursively
 from sample_factory.utils.timing import Timing
 from sample_factory.utils.typing import Device, PolicyID
 from sample_factory.utils.utils import debug_log_every_n, log
@@ -86,6 +92,51 @@ class SliceMerger:
         return None
 
 
+class BatchPrefetcher:
+    """
+    Uploads training batches to the GPU from pinned host buffers on a side CUDA stream, so that the upload of the
+    next batch overlaps with training on the current one instead of being serialized with it on the default stream.
+    The trajectories are gathered in a pinned buffer on the batcher thread, the upload is then asynchronous.
+    Events order the upload after the learner is done with the previous contents of the device buffer, and training
+    after the upload, without blocking the host.
+    """
+
+    def __init__(self, device: torch.device, num_batches: int):
+        self.device = device
+        self.stream = torch.cuda.Stream(device)
+        self.host_buffers: List[Optional[TensorDict]] = [None] * num_batches
+        self.uploaded = [torch.cuda.Event() for _ in range(num_batches)]
+        self.consumed = [torch.cuda.Event() for _ in range(num_batches)]
+
+    def host_buffer(self, batch_idx: int, device_batch: TensorDict) -> TensorDict:
+        """Pinned host buffer to gather the trajectories of the batch in, allocated on first use."""
+        if self.host_buffers[batch_idx] is None:
+            host_buffer = copy_dict_structure(device_batch)
+            for _, d, key, device_tensor, _ in iter_dicts_recursively(device_batch, host_buffer):
+                d[key] = torch.empty(device_tensor.shape, dtype=device_tensor.dtype, pin_memory=True)
+            self.host_buffers[batch_idx] = host_buffer
+
+        # the previous upload from this buffer must be done before we overwrite it
+        self.uploaded[batch_idx].synchronize()
+        return self.host_buffers[batch_idx]
+
+    def upload(self, batch_idx: int, device_batch: TensorDict) -> None:
+        with torch.cuda.stream(self.stream):
+            self.stream.wait_event(self.consumed[batch_idx])
+            host_batch = self.host_buffers[batch_idx]
+            for _, _, _, device_tensor, host_tensor in iter_dicts_recursively(device_batch, host_batch):
+                device_tensor.copy_(host_tensor, non_blocking=True)
+            self.uploaded[batch_idx].record(self.stream)
+
+    def wait_uploaded(self, batch_idx: int) -> None:
+        """Called by the learner before training on the batch."""
+        torch.cuda.current_stream(self.device).wait_event(self.uploaded[batch_idx])
+
+    def mark_consumed(self, batch_idx: int) -> None:
+        """Called by the learner after training on the batch, before releasing it."""
+        self.consumed[batch_idx].record(torch.cuda.current_stream(self.device))
+
+
 class Batcher(HeartbeatStoppableEventLoopObject):
     def __init__(
         self, evt_loop: EventLoop, policy_id: PolicyID, buffer_mgr: BufferMgr, cfg: AttrDict, env_info: EnvInfo
@@ -113,7 +164,6 @@ class Batcher(HeartbeatStoppableEventLoopObject):
 
         self.traj_buffer_queues = buffer_mgr.traj_buffer_queues
         self.traj_tensors = buffer_mgr.traj_tensors_torch
-        self.training_batches: List[TensorDict] = []
 
         self.max_batches_to_accumulate = buffer_mgr.max_batches_to_accumulate
         self.available_batches = list(range(self.max_batches_to_accumulate))
@@ -121,6 +171,22 @@ class Batcher(HeartbeatStoppableEventLoopObject):
             [] for _ in range(self.max_batches_to_accumulate)
         ]
 
+        # training batches handed to the learner, either our own buffers with a copy of the trajectories, or
+        # views into the trajectory buffers if the batch is a single contiguous slice (see --zero_copy_batches)
+        self.training_batches: List[Optional[TensorDict]] = [None] * self.max_batches_to_accumulate
+        self.batch_buffers: List[Optional[TensorDict]] = [None] * self.max_batches_to_accumulate
+        self.zero_copy_devices = {
+            device for device in self.traj_tensors if zero_copy_batches(cfg, device, self.policy_id)
+        }
+
+        # holders of the trajectories of each batch: the batcher until the batch is handed over (which in sync mode
+        # is when the learner is done with it), and the learner if it reads the trajectories in place
+        self.traj_tensor_refs: List[int] = [0] * self.max_batches_to_accumulate
+        self.batch_is_view: List[bool] = [False] * self.max_batches_to_accumulate
+
+        # uploads batches of trajectories sampled on the CPU to the GPU learner (see --prefetch_batches)
+        self.prefetcher: Optional[BatchPrefetcher] = None
+
     @signal
     def initialized(self):
         ...
@@ -147,20 +213,29 @@ class Batcher(HeartbeatStoppableEventLoopObject):
 
     def init(self):
         device = policy_device(self.cfg, self.policy_id)
-        for i in range(self.max_batches_to_accumulate):
-            rnn_size = get_rnn_size(self.cfg)
-            training_batch = alloc_trajectory_tensors(
+        prefetch = "prefetch_batches" in self.cfg and self.cfg.prefetch_batches
+        if prefetch and device.type == "cuda" and "cpu" in self.traj_tensors:
+            self.prefetcher = BatchPrefetcher(device, self.max_batches_to_accumulate)
+
+        if not self.zero_copy_devices:
+            # otherwise the buffers are only allocated if a batch ever needs to be copied
+            for batch_idx in range(self.max_batches_to_accumulate):
+                self._batch_buffer(batch_idx)
+
+        self.initialized.emit()
+
+    def _batch_buffer(self, batch_idx: int) -> TensorDict:
+        if self.batch_buffers[batch_idx] is None:
+            self.batch_buffers[batch_idx] = alloc_trajectory_tensors(
                 self.cfg.algo,
                 self.env_info,
                 self.traj_per_training_iteration,
                 self.cfg.rollout,
-                rnn_size,
-                device,
+                get_rnn_size(self.cfg),
+                policy_device(self.cfg, self.policy_id),
                 False,
             )
-            self.training_batches.append(training_batch)
-
-        self.initialized.emit()
+        return self.batch_buffers[batch_idx]
 
     def on_new_trajectories(self, trajectory_dicts: Iterable[Dict], device: str):
         with self.timing.add_time("batching"):
@@ -190,47 +265,73 @@ class Batcher(HeartbeatStoppableEventLoopObject):
                 self.available_batches.pop(0)
                 assert len(self.traj_tensors_to_release[batch_idx]) == 0
 
-                # extract slices of trajectories and copy them to the training batch
+                # extract slices of trajectories that make up the training batch
                 devices = list(self.slices_for_training.keys())
                 random.shuffle(devices)  # so that no sampling device is preferred
 
-                trajectories_copied = 0
-                remaining = self.traj_per_training_iteration - trajectories_copied
+                traj_slices = self.traj_tensors_to_release[batch_idx]  # we will need to release these trajectories
+                trajectories_extracted = 0
+                remaining = self.traj_per_training_iteration - trajectories_extracted
                 for device in devices:
-                    traj_tensors = self.traj_tensors[device]
                     slices = self.slices_for_training[device]
                     while remaining > 0 and (traj_slice := slices.get_at_most(remaining)):
-                        # copy data into the training buffer
-                        start = trajectories_copied
-                        stop = start + slice_len(traj_slice)
-
-                        # log.debug(f"Copying {traj_slice} trajectories from {device} to {batch_idx}")
-                        self.training_batches[batch_idx][start:stop] = traj_tensors[traj_slice]
-
-                        # remember that we need to release these trajectories
-                        self.traj_tensors_to_release[batch_idx].append((device, traj_slice))
-
-                        trajectories_copied += slice_len(traj_slice)
-                        remaining = self.traj_per_training_iteration - trajectories_copied
-
-                assert trajectories_copied == self.traj_per_training_iteration and remaining == 0
+                        traj_slices.append((device, traj_slice))
+                        trajectories_extracted += slice_len(traj_slice)
+                        remaining = self.traj_per_training_iteration - trajectories_extracted
+
+                assert trajectories_extracted == self.traj_per_training_iteration and remaining == 0
+
+                self.traj_tensor_refs[batch_idx] = 1
+                if len(traj_slices) == 1 and traj_slices[0][0] in self.zero_copy_devices:
+                    # a single contiguous slice on the learner device, the learner can read it in place
+                    device, traj_slice = traj_slices[0]
+                    self.training_batches[batch_idx] = self.traj_tensors[device][traj_slice]
+                    self.batch_is_view[batch_idx] = True
+                    self.traj_tensor_refs[batch_idx] += 1
+                else:
+                    self._copy_to_batch_buffer(batch_idx, traj_slices)
+                    self.batch_is_view[batch_idx] = False
 
                 # signal the learner that we have a new training batch
                 self.training_batches_available.emit(batch_idx)
 
                 if self.cfg.async_rl:
-                    self._release_traj_tensors(batch_idx)
+                    self._unref_traj_tensors(batch_idx)
                     if not self.available_batches:
                         debug_log_every_n(50, "Signal inference workers to stop experience collection...")
                         self.stop_experience_collection.emit()
 
+    def _copy_to_batch_buffer(self, batch_idx: int, traj_slices: List[Tuple[Device, slice]]):
+        training_batch = self._batch_buffer(batch_idx)
+
+        # trajectories sampled on the CPU are gathered in pinned memory and uploaded asynchronously
+        prefetch = self.prefetcher is not None and all(device == "cpu" for device, _ in traj_slices)
+        dst = self.prefetcher.host_buffer(batch_idx, training_batch) if prefetch else training_batch
+
+        start = 0
+        for device, traj_slice in traj_slices:
+            stop = start + slice_len(traj_slice)
+            # log.debug(f"Copying {traj_slice} trajectories from {device} to {batch_idx}")
+            dst[start:stop] = self.traj_tensors[device][traj_slice]
+            start = stop
+
+        if prefetch:
+            self.prefetcher.upload(batch_idx, training_batch)
+
+        self.training_batches[batch_idx] = training_batch
+
     def on_training_batch_released(self, batch_idx: int, training_iteration: int):
         with self.timing.add_time("releasing_batches"):
             self.training_iteration = training_iteration
 
             if not self.cfg.async_rl:
                 # in synchronous RL, we release the trajectories after they're processed by the learner
-                self._release_traj_tensors(batch_idx)
+                self._unref_traj_tensors(batch_idx)
+            if self.batch_is_view[batch_idx]:
+                # the learner is done reading the trajectories in place
+                self.training_batches[batch_idx] = None
+                self.batch_is_view[batch_idx] = False
+                self._unref_traj_tensors(batch_idx)
 
             if not self.available_batches and self.cfg.async_rl:
                 debug_log_every_n(50, "Signal inference workers to resume experience collection...")
@@ -244,6 +345,12 @@ class Batcher(HeartbeatStoppableEventLoopObject):
             #     f"{self.object_id} finished processing batch {batch_idx}, available batches: {self.available_batches}, {training_iteration=}"
             # )
 
+    def _unref_traj_tensors(self, batch_idx: int):
+        self.traj_tensor_refs[batch_idx] -= 1
+        assert self.traj_tensor_refs[batch_idx] >= 0
+        if self.traj_tensor_refs[batch_idx] == 0:
+            self._release_traj_tensors(batch_idx)
+
     def _release_traj_tensors(self, batch_idx: int):
         new_sampling_batches = dict()
 
@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from os.path import join
+from typing import Callable, Dict, List, Optional, Set
+
+import torch
+from torch import Tensor
+
+from sample_factory.utils.typing import Config, PolicyID
+from sample_factory.utils.utils import experiment_dir, log
+
+
+class LearnerDiagnostics:
+    """
+    Debugging aids for the learners that should never slow down regular training.
+
+    The loss computation reports the tensors at its points of interest with record(). Depending on
+    --learner_diagnostics this renders their autograd graphs (torchviz), saves them (torch.save) and/or checks
+    them for non-finite values. --diagnostics_trigger decides in which training iterations the graphs and snapshots
+    are collected: the first one, every --diagnostics_interval iterations or the ones with non-finite values.
+    Each point of interest is collected at most once per iteration.
+
+    Only the cheap part runs inline: walking the autograd graph (it is gone after the backward pass) and copying the
+    tensors to the host. Rendering and writing the files happen on a background thread, so Graphviz never runs in
+    the training loop. Artifacts go to <experiment dir>/diagnostics/p<policy_id>.
+    """
+
+    def __init__(self, cfg: Config, policy_id: PolicyID):
+        self.cfg = cfg
+        self.policy_id = policy_id
+
+        self.hooks: Set[str] = set(cfg.learner_diagnostics if "learner_diagnostics" in cfg else [])
+        self.trigger: str = cfg.diagnostics_trigger if "diagnostics_trigger" in cfg else "startup"
+        self.interval: int = max(1, cfg.diagnostics_interval if "diagnostics_interval" in cfg else 1)
+
+        self.iteration = -1
+        self._collected: Set[str] = set()
+
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending: List[Future] = []
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.hooks)
+
+    def next_iteration(self) -> None:
+        """Called by the learner at the start of every training iteration."""
+        self.iteration += 1
+        self._collected.clear()
+        # forget about the finished writes, report the failed ones
+        pending = []
+        for future in self._pending:
+            if not future.done():
+                pending.append(future)
+            elif future.exception() is not None:
+                log.warning("Failed to write learner diagnostics: %r", future.exception())
+        self._pending = pending
+
+    def _sampled(self) -> bool:
+        if self.trigger == "startup":
+            return self.iteration == 0
+        if self.trigger == "interval":
+            return self.iteration % self.interval == 0
+        return False
+
+    def record(self, name: str, tensors: Dict[str, Tensor]) -> None:
+        """
+        Point of interest `name` of the loss computation, with the tensors to diagnose.
+        Does nothing (and costs nothing) unless diagnostics are enabled.
+        """
+        if not self.hooks or name in self._collected:
+            return
+
+        triggered = self._sampled()
+        if "anomaly" in self.hooks or self.trigger == "nan":
+            non_finite = [key for key, t in tensors.items() if not bool(torch.isfinite(t.detach()).all())]
+            if non_finite:
+                log.warning(
+                    "Non-finite values in %s (%s), training iteration %d", name, ", ".join(non_finite), self.iteration
+                )
+                triggered |= self.trigger == "nan"
+
+        if not triggered:
+            return
+
+        self._collected.add(name)
+        prefix = join(self._diagnostics_dir(), f"{name}_{self.iteration:06d}")
+
+        if "graph" in self.hooks:
+            graphs = self._autograd_graphs(tensors)
+            for key, dot in graphs.items():
+                self._submit(dot.render, f"{prefix}_{key}", format="png", cleanup=True)
+
+        if "snapshot" in self.hooks:
+            snapshot = {key: t.detach().to("cpu", copy=True) for key, t in tensors.items()}
+            self._submit(torch.save, snapshot, f"{prefix}.pt")
+
+    def _autograd_graphs(self, tensors: Dict[str, Tensor]) -> Dict:
+        try:
+            from torchviz import make_dot
+        except ImportError:
+            log.warning("torchviz is not installed, disabling the graph diagnostics")
+            self.hooks.discard("graph")
+            return dict()
+
+        return {key: make_dot(t) for key, t in tensors.items() if t.grad_fn is not None}
+
+    def _diagnostics_dir(self) -> str:
+        diagnostics_dir = join(experiment_dir(self.cfg), "diagnostics", f"p{self.policy_id}")
+        os.makedirs(diagnostics_dir, exist_ok=True)
+        return diagnostics_dir
+
+    def _submit(self, func: Callable, *args, **kwargs) -> None:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="learner_diagnostics")
+        self._pending.append(self._executor.submit(func, *args, **kwargs))
+
+    def close(self) -> None:
+        """Waits for the pending writes."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
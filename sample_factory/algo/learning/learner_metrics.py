@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import torch
+from torch import Tensor
+
+from sample_factory.algo.utils.torch_utils import to_scalar
+from sample_factory.utils.attr_dict import AttrDict
+
+
+def global_grad_norm(params: Iterable[Tensor]) -> Tensor | float:
+    """L2 norm of the gradients of all parameters that have one, as a device tensor."""
+    grads = [p.grad for p in params if p.grad is not None]
+    if not grads:
+        return 0.0
+    if hasattr(torch, "_foreach_norm"):
+        norms = torch._foreach_norm(grads, 2)
+    else:
+        # older versions of PyTorch
+        norms = [torch.norm(g, 2) for g in grads]
+    return torch.norm(torch.stack(norms), 2)
+
+
+def adam_max_second_moment(optimizer: torch.optim.Optimizer) -> Tensor | float:
+    """
+    Largest second moment estimate of Adam-like optimizers, as a device tensor.
+    This caused numerical issues on some versions of PyTorch with second moment reaching infinity.
+    """
+    moments = [state["exp_avg_sq"] for state in optimizer.state.values() if "exp_avg_sq" in state]
+    if not moments:
+        return 0.0
+    return torch.stack([m.max() for m in moments]).max().clamp_min(0.0)
+
+
+class HostStats:
+    """
+    Summary statistics on their way to the host.
+
+    All single-element tensors of the stats are gathered into one tensor per device and copied to the host with
+    a single non-blocking transfer, instead of one .item() (and therefore one device sync) per statistic. The
+    learners start the transfer when they record the summaries and only wait for it in result(), after the rest of
+    the training iteration has been queued on the device.
+    """
+
+    def __init__(self, stats: Dict[str, Any]):
+        self._keys = list(stats.keys())
+        self._scalars: Dict[str, Any] = dict()
+        # per device: keys, whether the values were integers, and the host copy
+        self._transfers: List[Tuple[List[str], List[bool], Tensor, Optional[torch.cuda.Event]]] = []
+
+        by_device: Dict[torch.device, List[Tuple[str, Tensor]]] = dict()
+        for key, value in stats.items():
+            if isinstance(value, Tensor) and value.numel() == 1:
+                by_device.setdefault(value.device, []).append((key, value.detach()))
+            else:
+                self._scalars[key] = to_scalar(value)
+
+        for device, items in by_device.items():
+            keys = [key for key, _ in items]
+            is_int = [not (t.is_floating_point() or t.is_complex()) for _, t in items]
+            values = torch.stack([t.reshape(()).to(torch.float64) for _, t in items])
+
+            event = None
+            if device.type == "cuda":
+                host = torch.empty(values.shape, dtype=values.dtype, pin_memory=True)
+                host.copy_(values, non_blocking=True)
+                event = torch.cuda.Event()
+                event.record()
+            else:
+                host = values
+
+            self._transfers.append((keys, is_int, host, event))
+
+        self._result: Optional[AttrDict] = None
+
+    def result(self) -> AttrDict:
+        """Stats as Python scalars, waits for the transfer to finish if needed."""
+        if self._result is None:
+            values = dict(self._scalars)
+            for keys, is_int, host, event in self._transfers:
+                if event is not None:
+                    event.synchronize()
+                for key, integer, value in zip(keys, is_int, host.tolist()):
+                    values[key] = int(value) if integer else value
+
+            self._result = AttrDict({key: values[key] for key in self._keys})
+            self._transfers = []
+
+        return self._result
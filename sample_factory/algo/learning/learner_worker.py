@@ -11,6 +11,7 @@ from torch import Tensor
 
 from sample_factory.algo.learning.batcher import Batcher
 from sample_factory.algo.learning.cpo_learner import CPOLearner
+from sample_factory.algo.learning.learner import Learner
 from sample_factory.algo.learning.p3o_learner import P3OLearner
 from sample_factory.algo.learning.ppo_detached_learner import PPODetachedLearner
 from sample_factory.algo.learning.ppo_learner import PPOLearner
@@ -92,8 +93,9 @@ class LearnerWorker(HeartbeatStoppableEventLoopObject, Configurable):
         else:
             learner_cls = PPOLearner
         policy_versions_tensor: Tensor = buffer_mgr.policy_versions
-        self.param_server = ParameterServer(policy_id, policy_versions_tensor, cfg.serial_mode)
-        self.learner: PPOLearner = learner_cls(cfg, env_info, policy_versions_tensor, policy_id, self.param_server)
+        num_weight_clients = cfg.policy_workers_per_policy if cfg.double_buffered_weights else 0
+        self.param_server = ParameterServer(policy_id, policy_versions_tensor, cfg.serial_mode, num_weight_clients)
+        self.learner: Learner = learner_cls(cfg, env_info, policy_versions_tensor, policy_id, self.param_server)
 
         # total number of full training iterations (potentially multiple minibatches/epochs per iteration)
         self.training_iteration_since_resume: int = 0
@@ -173,8 +175,15 @@ class LearnerWorker(HeartbeatStoppableEventLoopObject, Configurable):
         log.debug(f"{self.object_id} finished initialization!")
 
     def on_new_training_batch(self, batch_idx: int):
+        prefetcher = self.batcher.prefetcher
+        if prefetcher is not None:
+            prefetcher.wait_uploaded(batch_idx)
+
         stats = self.learner.train(self.batcher.training_batches[batch_idx])
 
+        if prefetcher is not None:
+            prefetcher.mark_consumed(batch_idx)
+
         self.training_iteration_since_resume += 1
         self.training_batch_released.emit(batch_idx, self.training_iteration_since_resume)
         self.finished_training_iteration.emit(self.training_iteration_since_resume)
@@ -187,6 +196,7 @@ class LearnerWorker(HeartbeatStoppableEventLoopObject, Configurable):
 
     def on_stop(self, *args):
         self.learner.save()
+        self.learner.diagnostics.close()
         if not self.cfg.serial_mode:
             self.join_batcher_thread()
 
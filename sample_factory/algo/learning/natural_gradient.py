@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import math
+from typing import Callable, Optional, Sequence, Tuple
+
+import torch
+from torch import Tensor, nn
+
+
+def flatten_grads(
+    grads: Sequence[Optional[Tensor]], params: Sequence[Tensor], batch_shape: Sequence[int] = ()
+) -> Tensor:
+    """
+    Concatenate per-parameter gradients into a flat vector, parameters that got no gradient contribute zeros.
+    With batched gradients every gradient has the leading batch_shape dimensions.
+    """
+    flat = []
+    for grad, param in zip(grads, params):
+        if grad is None:
+            flat.append(param.new_zeros(*batch_shape, param.numel()))
+        else:
+            flat.append(grad.reshape(*batch_shape, -1))
+    return torch.cat(flat, dim=-1)
+
+
+class FisherVectorProduct:
+    """
+    Products of the Fisher information matrix (the Hessian of the KL divergence between the old and the current
+    policy) with arbitrary vectors, the matrix-free operator used by the conjugate gradient solver of TRPO and CPO.
+
+    The first-order KL gradient graph is built once when the operator is created and is reused by every product,
+    which only needs a single backward pass through that graph. The operator has to be recreated whenever the
+    parameters change.
+    """
+
+    def __init__(self, kl: Tensor, params: Sequence[Tensor], damping: float):
+        self.params = list(params)
+        self.damping = damping
+
+        kl_grads = torch.autograd.grad(kl, self.params, create_graph=True, allow_unused=True)
+        self.flat_kl_grad = flatten_grads(kl_grads, self.params)
+
+    def __call__(self, v: Tensor) -> Tensor:
+        """
+        :param v: [num_params] vector, or [num_vectors, num_params] to compute several products in one backward pass
+        """
+        batched = v.dim() > 1
+        v = v.detach()
+        hvp = torch.autograd.grad(
+            self.flat_kl_grad,
+            self.params,
+            grad_outputs=v,
+            retain_graph=True,
+            allow_unused=True,
+            is_grads_batched=batched,
+        )
+        return flatten_grads(hvp, self.params, v.shape[:-1]) + self.damping * v
+
+
+def conjugate_gradient(avp: Callable[[Tensor], Tensor], b: Tensor, nsteps: int, residual_tol: float = 1e-10) -> Tensor:
+    """
+    Approximately solve Ax = b for a symmetric positive definite A given as a matrix-vector product function.
+    b can be a [num_systems, n] batch of right-hand sides, which are solved together with batched products.
+
+    All scalars stay on the device: instead of breaking out of the loop when the residual is small enough (which
+    would synchronize with the GPU every iteration) converged systems just stop updating their solution.
+    """
+    x = torch.zeros_like(b)
+    r = b.clone()
+    p = b.clone()
+    rdotr = (r * r).sum(dim=-1, keepdim=True)
+
+    for _ in range(nsteps):
+        active = rdotr > residual_tol
+        avp_p = avp(p)
+        alpha = torch.where(active, rdotr / ((p * avp_p).sum(dim=-1, keepdim=True) + 1e-8), 0.0)
+        x.addcmul_(alpha, p)
+        r.addcmul_(alpha, avp_p, value=-1.0)
+        new_rdotr = (r * r).sum(dim=-1, keepdim=True)
+        p = torch.where(active, r + (new_rdotr / rdotr) * p, p)
+        rdotr = torch.where(active, new_rdotr, rdotr)
+
+    return x
+
+
+class _Closure(nn.Module):
+    """Wraps a function that uses a module, so that torch.func.functional_call() can swap the parameters it sees."""
+
+    def __init__(self, module: nn.Module, fn: Callable[[], Tuple[Tensor, ...]]):
+        super().__init__()
+        self.module = module
+        self.fn = fn
+
+    def forward(self) -> Tuple[Tensor, ...]:
+        return self.fn()
+
+
+def evaluate_parameter_candidates(
+    module: nn.Module,
+    names: Sequence[str],
+    candidates: Tensor,
+    fn: Callable[[], Tuple[Tensor, ...]],
+    vectorize: bool,
+) -> Tuple[Tensor, ...]:
+    """
+    Evaluate fn() for every row of candidates, a [num_candidates, num_params] batch of flat vectors of the module
+    parameters `names` (in this order), without modifying the module. fn() reads the parameters through the module
+    and returns a tuple of tensors, which are stacked over the candidates.
+
+    With vectorize=True all candidates go through fn() at once with torch.func.vmap, which requires batching rules
+    for all the ops (there are none for the RNN cores). Otherwise the candidates are evaluated one after another.
+    """
+    # only torch >= 2.0 has torch.func, only --line_search_mode batched needs it
+    from torch.func import functional_call, vmap
+
+    closure = _Closure(module, fn)
+    shapes = [module.get_parameter(name).shape for name in names]
+    sizes = [math.prod(shape) for shape in shapes]
+
+    def call(flat_params: Tensor) -> Tuple[Tensor, ...]:
+        params = {f"module.{name}": t.view(shape) for name, t, shape in zip(names, flat_params.split(sizes), shapes)}
+        return functional_call(closure, params, ())
+
+    if vectorize:
+        return vmap(call)(candidates)
+
+    outputs = [call(candidate) for candidate in candidates]
+    return tuple(torch.stack(values) for values in zip(*outputs))
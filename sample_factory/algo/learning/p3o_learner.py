@@ -1,23 +1,15 @@
 from __future__ import annotations
 
-from typing import Dict, Optional, Tuple
-
-import numpy as np
 import torch
 from torch import Tensor
 
+from sample_factory.algo.learning.learner import MinibatchLosses
 from sample_factory.algo.learning.ppo_learner import PPOLearner
-from sample_factory.algo.learning.rnn_utils import build_core_out_from_seq, build_rnn_inputs
-from sample_factory.algo.utils.action_distributions import get_action_distribution
 from sample_factory.algo.utils.env_info import EnvInfo
 from sample_factory.algo.utils.model_sharing import ParameterServer
-from sample_factory.algo.utils.rl_utils import gae_advantages
-from sample_factory.algo.utils.tensor_dict import TensorDict, shallow_recursive_copy
-from sample_factory.algo.utils.torch_utils import masked_select, synchronize, to_scalar
+from sample_factory.algo.utils.torch_utils import masked_select
 from sample_factory.utils.attr_dict import AttrDict
-from sample_factory.utils.dicts import iterate_recursively
-from sample_factory.utils.typing import ActionDistribution, Config, PolicyID
-from sample_factory.utils.utils import log
+from sample_factory.utils.typing import Config, PolicyID
 
 
 class P3OLearner(PPOLearner):
@@ -33,19 +25,14 @@ class P3OLearner(PPOLearner):
         self.kappa = cfg.kappa
 
     def _policy_cost_loss(self, ratio, cost_adv, cost_violation, valids, num_invalids):
-        cost_loss = (ratio * cost_adv)
-        cost_loss = masked_select(cost_loss, valids, num_invalids)
-        cost_loss = cost_loss.mean()
-        cost_loss = self.kappa * max(0.0, cost_loss + cost_violation)
+        # every constraint channel has its own exact penalty, the penalties of all the channels are summed
+        cost_loss = (self._expand_for_cost_channels(ratio) * cost_adv)
+        cost_loss = self._masked_cost_channel_mean(cost_loss, valids, num_invalids)
+        cost_loss = self.kappa * self._sum_cost_channels(torch.clamp_min(cost_loss + cost_violation, 0.0))
         return cost_loss
 
-    def _calculate_losses(
-            self, mb: AttrDict, num_invalids: int
-    ) -> Tuple[
-        ActionDistribution, Tensor, Tensor, Tensor | float, Optional[Tensor], Tensor | float, Tensor, Tensor, Dict]:
+    def _calculate_losses(self, mb: AttrDict, num_invalids: int) -> MinibatchLosses:
         with torch.no_grad(), self.timing.add_time("losses_init"):
-            recurrence: int = self.cfg.recurrence
-
             # PPO clipping
             clip_ratio_high = 1.0 + self.cfg.ppo_clip_ratio  # e.g. 1.1
             # this still works with e.g. clip_ratio = 2, while PPO's 1-r would give negative ratio_clipped
@@ -54,45 +41,9 @@ class P3OLearner(PPOLearner):
 
             valids = mb.valids
 
-        # calculate policy head outside of recurrent loop
-        with self.timing.add_time("forward_head"):
-            head_outputs = self.actor_critic.forward_head(mb.normalized_obs)
-            minibatch_size: int = head_outputs.size(0)
-
-        # initial rnn states
-        with self.timing.add_time("bptt_initial"):
-            if self.cfg.use_rnn:
-                # this is the only way to stop RNNs from backpropagating through invalid timesteps
-                # (i.e. experience collected by another policy)
-                done_or_invalid = torch.logical_or(mb.dones_cpu, ~valids.cpu()).float()
-                head_output_seq, rnn_states, inverted_select_inds = build_rnn_inputs(
-                    head_outputs,
-                    done_or_invalid,
-                    mb.rnn_states,
-                    recurrence,
-                )
-            else:
-                rnn_states = mb.rnn_states[::recurrence]
-
-        # calculate RNN outputs for each timestep in a loop
-        with self.timing.add_time("bptt"):
-            if self.cfg.use_rnn:
-                with self.timing.add_time("bptt_forward_core"):
-                    core_output_seq, _ = self.actor_critic.forward_core(head_output_seq, rnn_states)
-                core_outputs = build_core_out_from_seq(core_output_seq, inverted_select_inds)
-                del core_output_seq
-            else:
-                core_outputs, _ = self.actor_critic.forward_core(head_outputs, rnn_states)
-
-            del head_outputs
-
-        num_trajectories = minibatch_size // recurrence
-        assert core_outputs.shape[0] == minibatch_size
+        result, action_distribution = self._forward_minibatch(mb)
 
         with self.timing.add_time("tail"):
-            # calculate policy tail outside of recurrent loop
-            result = self.actor_critic.forward_tail(core_outputs, values_only=False, sample_actions=False)
-            action_distribution = self.actor_critic.action_distribution()
             log_prob_actions = action_distribution.log_prob(mb.actions)
             ratio = torch.exp(log_prob_actions - mb.log_prob_actions)  # pi / pi_old
 
@@ -102,55 +53,15 @@ class P3OLearner(PPOLearner):
             values = result["values"].squeeze()
             cost_values = result["cost_values"].squeeze()
 
-            del core_outputs
-
         # Average episode cost
-        mean_cost = mb["costs"].mean()
+        mean_cost = self._cost_channel_mean(mb["costs"])
         # Calculate the average cost constraint violation
         cost_violation = (mean_cost - self.safety_bound).detach()
 
         # these computations are not the part of the computation graph
         with torch.no_grad(), self.timing.add_time("advantages_returns"):
             if self.cfg.with_vtrace:
-                # V-trace parameters
-                rho_hat = torch.Tensor([self.cfg.vtrace_rho])
-                c_hat = torch.Tensor([self.cfg.vtrace_c])
-
-                ratios_cpu = ratio_clipped.cpu()
-                values_cpu = values.cpu()
-                rewards_cpu = mb.rewards_cpu
-                dones_cpu = mb.dones_cpu
-
-                vtrace_rho = torch.min(rho_hat, ratios_cpu)
-                vtrace_c = torch.min(c_hat, ratios_cpu)
-
-                vs = torch.zeros((num_trajectories * recurrence))
-                adv = torch.zeros((num_trajectories * recurrence))
-
-                next_values = values_cpu[recurrence - 1:: recurrence] - rewards_cpu[recurrence - 1:: recurrence]
-                next_values /= self.cfg.gamma
-                next_vs = next_values
-
-                for i in reversed(range(self.cfg.recurrence)):
-                    rewards = rewards_cpu[i::recurrence]
-                    dones = dones_cpu[i::recurrence]
-                    not_done = 1.0 - dones
-                    not_done_gamma = not_done * self.cfg.gamma
-
-                    curr_values = values_cpu[i::recurrence]
-                    curr_vtrace_rho = vtrace_rho[i::recurrence]
-                    curr_vtrace_c = vtrace_c[i::recurrence]
-
-                    delta_s = curr_vtrace_rho * (rewards + not_done_gamma * next_values - curr_values)
-                    adv[i::recurrence] = curr_vtrace_rho * (rewards + not_done_gamma * next_vs - curr_values)
-                    next_vs = curr_values + delta_s + not_done_gamma * curr_vtrace_c * (next_vs - next_values)
-                    vs[i::recurrence] = next_vs
-
-                    next_values = curr_values
-
-                targets = vs.to(self.device)
-                adv = adv.to(self.device)
-                # TODO implement cost V-trace
+                targets, adv, cost_targets, cost_adv = self._vtrace_with_costs(ratio_clipped, values, cost_values, mb)
             else:
                 # using regular GAE
                 adv = mb.advantages
@@ -159,7 +70,7 @@ class P3OLearner(PPOLearner):
                 cost_targets = mb.cost_returns
 
             adv_std, adv_mean = torch.std_mean(masked_select(adv, valids, num_invalids))
-            cost_adv_std, cost_adv_mean = torch.std_mean(masked_select(cost_adv, valids, num_invalids))
+            cost_adv_std, cost_adv_mean = self._masked_cost_channel_std_mean(cost_adv, valids, num_invalids)
             adv = (adv - adv_mean) / torch.clamp_min(adv_std, 1e-7)  # normalize advantage
             cost_adv = (cost_adv - cost_adv_mean) / torch.clamp_min(cost_adv_std, 1e-7)  # normalize advantage
 
@@ -174,7 +85,10 @@ class P3OLearner(PPOLearner):
             old_values = mb["values"]
             old_cost_values = mb["cost_values"]
             value_loss = self._value_loss(values, old_values, targets, clip_value, valids, num_invalids)
-            cost_loss = self._value_loss(cost_values, old_cost_values, cost_targets, clip_value, valids, num_invalids)
+            cost_valids = self._expand_for_cost_channels(valids)
+            cost_loss = self._value_loss(
+                cost_values, old_cost_values, cost_targets, clip_value, cost_valids, num_invalids
+            )
 
         loss_summaries = dict(
             ratio=ratio_clipped,
@@ -189,305 +103,32 @@ class P3OLearner(PPOLearner):
             cost_violation=cost_violation,
         )
 
-        return action_distribution, policy_loss, policy_cost_loss, exploration_loss, kl_old, kl_loss, value_loss, cost_loss, loss_summaries
-
-    def _train(
-            self, gpu_buffer: TensorDict, batch_size: int, experience_size: int, num_invalids: int
-    ) -> Optional[AttrDict]:
-        timing = self.timing
-        with torch.no_grad():
-            early_stopping_tolerance = 1e-6
-            early_stop = False
-            prev_epoch_actor_loss = 1e9
-            epoch_actor_losses = [0] * self.cfg.num_batches_per_epoch
-
-            # recent mean KL-divergences per minibatch, this used by LR schedulers
-            recent_kls = []
-
-            if self.cfg.with_vtrace:
-                assert (
-                        self.cfg.recurrence == self.cfg.rollout and self.cfg.recurrence > 1
-                ), "V-trace requires to recurrence and rollout to be equal"
-
-            num_sgd_steps = 0
-            stats_and_summaries: Optional[AttrDict] = None
-
-            # When it is time to record train summaries, we randomly sample epoch/batch for which the summaries are
-            # collected to get equal representation from different stages of training.
-            # Half the time, we record summaries from the very large step of training. There we will have the highest
-            # KL-divergence and ratio of PPO-clipped samples, which makes this data even more useful for analysis.
-            # Something to consider: maybe we should have these last-batch metrics in a separate summaries category?
-            with_summaries = self._should_save_summaries()
-            if np.random.rand() < 0.5:
-                summaries_epoch = np.random.randint(0, self.cfg.num_epochs)
-                summaries_batch = np.random.randint(0, self.cfg.num_batches_per_epoch)
-            else:
-                summaries_epoch = self.cfg.num_epochs - 1
-                summaries_batch = self.cfg.num_batches_per_epoch - 1
-
-            assert self.actor_critic.training
-
-        for epoch in range(self.cfg.num_epochs):
-            with timing.add_time("epoch_init"):
-                if early_stop:
-                    break
-
-                force_summaries = False
-                minibatches = self._get_minibatches(batch_size, experience_size)
-
-            for batch_num in range(len(minibatches)):
-                with torch.no_grad(), timing.add_time("minibatch_init"):
-                    indices = minibatches[batch_num]
-
-                    # current minibatch consisting of short trajectory segments with length == recurrence
-                    mb = self._get_minibatch(gpu_buffer, indices)
-
-                    # enable syntactic sugar that allows us to access dict's keys as object attributes
-                    mb = AttrDict(mb)
-
-                with timing.add_time("calculate_losses"):
-                    (
-                        action_distribution,
-                        policy_loss,
-                        policy_cost_loss,
-                        exploration_loss,
-                        kl_old,
-                        kl_loss,
-                        value_loss,
-                        cost_loss,
-                        loss_summaries,
-                    ) = self._calculate_losses(mb, num_invalids)
-
-                with timing.add_time("losses_postprocess"):
-                    # noinspection PyTypeChecker
-                    actor_loss: Tensor = policy_loss + policy_cost_loss + exploration_loss + kl_loss
-                    critic_loss = value_loss
-                    loss: Tensor = actor_loss + critic_loss + cost_loss
-
-                    epoch_actor_losses[batch_num] = float(actor_loss)
-
-                    high_loss = 30.0
-                    if torch.abs(loss) > high_loss:
-                        log.warning(
-                            "High loss value: l:%.4f pl:%.4f pcl:%.4f vl:%.4f exp_l:%.4f kl_l:%.4f (recommended to adjust the --reward_scale parameter)",
-                            to_scalar(loss),
-                            to_scalar(policy_loss),
-                            to_scalar(policy_cost_loss),
-                            to_scalar(value_loss),
-                            to_scalar(exploration_loss),
-                            to_scalar(kl_loss),
-                        )
-
-                        # perhaps something weird is happening, we definitely want summaries from this step
-                        force_summaries = True
-
-                with torch.no_grad(), timing.add_time("kl_divergence"):
-                    # if kl_old is not None it is already calculated above
-                    if kl_old is None:
-                        # calculate KL-divergence with the behaviour policy action distribution
-                        old_action_distribution = get_action_distribution(
-                            self.actor_critic.action_space,
-                            mb.action_logits,
-                        )
-                        kl_old = action_distribution.kl_divergence(old_action_distribution)
-                        kl_old = masked_select(kl_old, mb.valids, num_invalids)
-
-                    kl_old_mean = float(kl_old.mean().item())
-                    recent_kls.append(kl_old_mean)
-                    if kl_old.numel() > 0 and kl_old.max().item() > 100:
-                        log.warning(f"KL-divergence is very high: {kl_old.max().item():.4f}")
-
-                # update the weights
-                with timing.add_time("update"):
-                    # following advice from https://youtu.be/9mS1fIYj1So set grad to None instead of optimizer.zero_grad()
-                    for p in self.actor_critic.parameters():
-                        p.grad = None
-
-                    loss.backward()
-
-                    if self.cfg.max_grad_norm > 0.0:
-                        with timing.add_time("clip"):
-                            torch.nn.utils.clip_grad_norm_(self.actor_critic.parameters(), self.cfg.max_grad_norm)
-
-                    curr_policy_version = self.train_step  # policy version before the weight update
-
-                    actual_lr = self.curr_lr
-                    if num_invalids > 0:
-                        # if we have masked (invalid) data we should reduce the learning rate accordingly
-                        # this prevents a situation where most of the data in the minibatch is invalid
-                        # and we end up doing SGD with super noisy gradients
-                        actual_lr = self.curr_lr * (experience_size - num_invalids) / experience_size
-                    self._apply_lr(actual_lr)
-
-                    with self.param_server.policy_lock:
-                        self.optimizer.step()
-
-                    num_sgd_steps += 1
-
-                with torch.no_grad(), timing.add_time("after_optimizer"):
-                    self._after_optimizer_step()
-
-                    if self.lr_scheduler.invoke_after_each_minibatch():
-                        self.curr_lr = self.lr_scheduler.update(self.curr_lr, recent_kls)
-
-                    # collect and report summaries
-                    should_record_summaries = with_summaries
-                    should_record_summaries &= epoch == summaries_epoch and batch_num == summaries_batch
-                    should_record_summaries |= force_summaries
-                    if should_record_summaries:
-                        # hacky way to collect all of the intermediate variables for summaries
-                        summary_vars = {**locals(), **loss_summaries}
-                        stats_and_summaries = self._record_summaries(AttrDict(summary_vars))
-                        del summary_vars
-                        force_summaries = False
-
-                    # make sure everything (such as policy weights) is committed to shared device memory
-                    synchronize(self.cfg, self.device)
-                    # this will force policy update on the inference worker (policy worker)
-                    self.policy_versions_tensor[self.policy_id] = self.train_step
-
-            # end of an epoch
-            if self.lr_scheduler.invoke_after_each_epoch():
-                self.curr_lr = self.lr_scheduler.update(self.curr_lr, recent_kls)
-
-            new_epoch_actor_loss = float(np.mean(epoch_actor_losses))
-            loss_delta_abs = abs(prev_epoch_actor_loss - new_epoch_actor_loss)
-            if loss_delta_abs < early_stopping_tolerance:
-                early_stop = True
-                log.debug(
-                    "Early stopping after %d epochs (%d sgd steps), loss delta %.7f",
-                    epoch + 1,
-                    num_sgd_steps,
-                    loss_delta_abs,
-                )
-                break
-
-            prev_epoch_actor_loss = new_epoch_actor_loss
-
-        return stats_and_summaries
+        return MinibatchLosses(
+            action_distribution,
+            dict(
+                policy_loss=policy_loss,
+                policy_cost_loss=policy_cost_loss,
+                exploration_loss=exploration_loss,
+                kl_loss=kl_loss,
+            ),
+            dict(value_loss=value_loss, cost_loss=cost_loss),
+            kl_old,
+            loss_summaries,
+        )
 
-    def _record_summaries(self, train_loop_vars) -> AttrDict:
+    def _summary_stats(self, train_loop_vars) -> AttrDict:
         var = train_loop_vars
 
-        # Call the base _record_summaries method to get initial summaries
-        stats = super()._record_summaries(train_loop_vars)
+        # Call the base _summary_stats method to get initial summaries
+        stats = super()._summary_stats(train_loop_vars)
 
         stats.cost_loss = var.cost_loss
-        stats.cost_values = var.cost_values.mean()
-        stats.cost_violation = var.cost_violation
         stats.policy_cost_loss = var.policy_cost_loss
-        stats.avg_cost = var.avg_cost
-
-        for key, value in stats.items():
-            stats[key] = to_scalar(value)
+        self._record_cost_channel_stats(
+            stats,
+            cost_values=self._cost_channel_mean(var.cost_values),
+            cost_violation=var.cost_violation,
+            avg_cost=var.avg_cost,
+        )
 
         return stats
-
-    def _prepare_batch(self, batch: TensorDict) -> Tuple[TensorDict, int, int]:
-        with torch.no_grad():
-            # create a shallow copy so we can modify the dictionary
-            # we still reference the same buffers though
-            buff = shallow_recursive_copy(batch)
-
-            # ignore experience from other agents (i.e. on episode boundary) and from inactive agents
-            valids: Tensor = buff["policy_id"] == self.policy_id
-            # ignore experience that was older than the threshold even before training started
-            curr_policy_version: int = self.train_step
-            buff["valids"][:, :-1] = valids & (curr_policy_version - buff["policy_version"] < self.cfg.max_policy_lag)
-            # for last T+1 step, we want to use the validity of the previous step
-            buff["valids"][:, -1] = buff["valids"][:, -2]
-
-            # ensure we're in train mode so that normalization statistics are updated
-            if not self.actor_critic.training:
-                self.actor_critic.train()
-
-            buff["normalized_obs"] = self._prepare_and_normalize_obs(buff["obs"])
-            del buff["obs"]  # don't need non-normalized obs anymore
-
-            # calculate estimated value for the next step (T+1)
-            normalized_last_obs = buff["normalized_obs"][:, -1]
-            next_values = self.actor_critic(normalized_last_obs, buff["rnn_states"][:, -1], values_only=True)
-            buff["values"][:, -1] = next_values["values"]
-            buff["cost_values"][:, -1] = next_values["cost_values"]
-
-            if self.cfg.normalize_returns:
-                # Since our value targets are normalized, the values will also have normalized statistics.
-                # We need to denormalize them before using them for GAE caculation and value bootstrapping.
-                # rl_games PPO uses a similar approach, see:
-                # https://github.com/Denys88/rl_games/blob/7b5f9500ee65ae0832a7d8613b019c333ecd932c/rl_games/algos_torch/models.py#L51
-                denormalized_values = buff["values"].clone()  # need to clone since normalizer is in-place
-                denormalized_cost_values = buff["cost_values"].clone()  # need to clone since normalizer is in-place
-                self.actor_critic.returns_normalizer(denormalized_values, denormalize=True)
-                self.actor_critic.costs_normalizer(denormalized_cost_values, denormalize=True)
-            else:
-                # values are not normalized in this case, so we can use them as is
-                denormalized_values = buff["values"]
-                denormalized_cost_values = buff["cost_values"]
-
-            if self.cfg.value_bootstrap:
-                # Value bootstrapping is a technique that reduces the surprise for the critic in case
-                # we're ending the episode by timeout. Intuitively, in this case the cumulative return for the last step
-                # should not be zero, but rather what the critic expects. This improves learning in many envs
-                # because otherwise the critic cannot predict the abrupt change in rewards in a timed-out episode.
-                # What we really want here is v(t+1) which we don't have because we don't have obs(t+1) (since
-                # the episode ended). Using v(t) is an approximation that requires that rew(t) can be generally ignored.
-
-                # Multiply by both time_out and done flags to make sure we count only timeouts in terminal states.
-                # There was a bug in older versions of isaacgym where timeouts were reported for non-terminal states.
-                buff["rewards"].add_(self.cfg.gamma * denormalized_values[:, :-1] * buff["time_outs"] * buff["dones"])
-
-            if not self.cfg.with_vtrace:
-                # calculate advantage estimate (in case of V-trace it is done separately for each minibatch)
-                buff["advantages"] = gae_advantages(
-                    buff["rewards"],
-                    buff["dones"],
-                    denormalized_values,
-                    buff["valids"],
-                    self.cfg.gamma,
-                    self.cfg.gae_lambda,
-                )
-                buff["cost_advantages"] = gae_advantages(
-                    buff["costs"],
-                    buff["dones"],
-                    denormalized_cost_values,
-                    buff["valids"],
-                    self.cfg.gamma,
-                    self.cfg.gae_lambda,
-                )
-
-                # here returns are not normalized yet, so we should use denormalized values
-                buff["returns"] = buff["advantages"] + buff["valids"][:, :-1] * denormalized_values[:, :-1]
-                buff["cost_returns"] = buff["cost_advantages"] + buff["valids"][:, :-1] * denormalized_cost_values[:,
-                                                                                          :-1]
-
-            # remove next step obs, rnn_states, and values from the batch, we don't need them anymore
-            for key in ["normalized_obs", "rnn_states", "values", "cost_values", "valids"]:
-                buff[key] = buff[key][:, :-1]
-
-            dataset_size = buff["actions"].shape[0] * buff["actions"].shape[1]
-            for d, k, v in iterate_recursively(buff):
-                # collapse first two dimensions (batch and time) into a single dimension
-                d[k] = v.reshape((dataset_size,) + tuple(v.shape[2:]))
-
-            buff["dones_cpu"] = buff["dones"].to("cpu", copy=True, dtype=torch.float, non_blocking=True)
-            buff["rewards_cpu"] = buff["rewards"].to("cpu", copy=True, dtype=torch.float, non_blocking=True)
-
-            # return normalization parameters are only used on the learner, no need to lock the mutex
-            if self.cfg.normalize_returns:
-                self.actor_critic.returns_normalizer(buff["returns"])  # in-place
-                self.actor_critic.costs_normalizer(buff["cost_returns"])  # in-place
-
-            num_invalids = dataset_size - buff["valids"].sum().item()
-            if num_invalids > 0:
-                invalid_fraction = num_invalids / dataset_size
-                if invalid_fraction > 0.5:
-                    log.warning(f"{self.policy_id=} batch has {invalid_fraction:.2%} of invalid samples")
-
-                # invalid action values can cause problems when we calculate logprobs
-                # here we set them to 0 just to be safe
-                invalid_indices = (buff["valids"] == 0).nonzero().squeeze()
-                buff["actions"][invalid_indices] = 0
-                # likewise, some invalid values of log_prob_actions can cause NaNs or infs
-                buff["log_prob_actions"][invalid_indices] = -1  # -1 seems like a safe value
-
-            return buff, dataset_size, num_invalids
@@ -1,5 +1,10 @@
+from __future__ import annotations
+
 from collections import deque
 
+import torch
+from torch import Tensor
+
 
 class PIDLagrangian:
     """PID version of Lagrangian.
@@ -23,7 +28,11 @@ class PIDLagrangian:
         diff_norm (bool): Whether to use the diff norm.
         penalty_max (int): The maximum penalty.
         lagrangian_multiplier_init (float): The initial value of the lagrangian multiplier.
-        cost_limit (float): The cost limit.
+        cost_limit (float | Tensor): The cost limit, or one limit per constraint channel.
+        device (torch.device | str): The device of the costs, the controller state is kept there as well.
+
+    The controller state is a float64 tensor shaped like ``cost_limit``, so several constraint channels get their
+    own multipliers from the same tensor ops, and the update does not wait for the costs to reach the host.
 
     References:
         - Title: Responsive Safety in Reinforcement Learning by PID Lagrangian Methods
@@ -43,7 +52,8 @@ class PIDLagrangian:
             diff_norm: bool,
             penalty_max: int,
             lagrangian_multiplier_init: float,
-            cost_limit: float,
+            cost_limit: float | Tensor,
+            device: torch.device | str = "cpu",
     ) -> None:
         """Initialize an instance of :class:`PIDLagrangian`."""
         self._pid_kp: float = pid_kp
@@ -55,20 +65,20 @@ class PIDLagrangian:
         self._penalty_max: int = penalty_max
         self._sum_norm: bool = sum_norm
         self._diff_norm: bool = diff_norm
-        self._pid_i: float = lagrangian_multiplier_init
-        self._cost_ds: deque[float] = deque(maxlen=self._pid_d_delay)
-        self._cost_ds.append(0.0)
-        self._delta_p: float = 0.0
-        self._cost_d: float = 0.0
-        self._cost_limit: float = cost_limit
-        self._cost_penalty: float = 0.0
+        self._cost_limit: Tensor = torch.as_tensor(cost_limit, dtype=torch.float64, device=device)
+        self._pid_i: Tensor = torch.full_like(self._cost_limit, lagrangian_multiplier_init)
+        self._cost_ds: deque[Tensor] = deque(maxlen=self._pid_d_delay)
+        self._cost_ds.append(torch.zeros_like(self._cost_limit))
+        self._delta_p: Tensor = torch.zeros_like(self._cost_limit)
+        self._cost_d: Tensor = torch.zeros_like(self._cost_limit)
+        self._cost_penalty: Tensor = torch.zeros_like(self._cost_limit)
 
     @property
-    def lagrangian_multiplier(self) -> float:
-        """The lagrangian multiplier."""
+    def lagrangian_multiplier(self) -> Tensor:
+        """The lagrangian multiplier, one per constraint channel."""
         return self._cost_penalty
 
-    def pid_update(self, ep_cost_avg: float) -> float:
+    def pid_update(self, ep_cost_avg: Tensor) -> Tensor:
         r"""Update the PID controller.
 
         PID controller update the lagrangian multiplier following the next equation:
@@ -82,44 +92,45 @@ class PIDLagrangian:
         learning rate.
 
         Args:
-            ep_cost_avg (float): The average cost of the current episode.
+            ep_cost_avg (Tensor): The average cost of the current episode, per constraint channel.
         """
+        ep_cost_avg = ep_cost_avg.detach()
+
         # Calculate the error between the average cost of the episode and the cost limit.
-        delta = float(ep_cost_avg - self._cost_limit)
+        delta = (ep_cost_avg - self._cost_limit.to(ep_cost_avg.dtype)).to(torch.float64)
+        ep_cost_avg = ep_cost_avg.to(torch.float64)
 
         # Update the integral part of the PID controller by adding the error multiplied by the integral gain.
-        self._pid_i = max(0.0, self._pid_i + delta * self._pid_ki)
+        self._pid_i = torch.clamp_min(self._pid_i + delta * self._pid_ki, 0.0)
 
         # If differential normalization is active, clamp the integral term between 0 and 1.
         if self._diff_norm:
-            self._pid_i = max(0.0, min(1.0, self._pid_i))
+            self._pid_i = torch.clamp(self._pid_i, 0.0, 1.0)
 
         # Calculate the exponentially weighted moving average of the proportional error.
         a_p = self._pid_delta_p_ema_alpha
-        self._delta_p *= a_p
-        self._delta_p += (1 - a_p) * delta
+        self._delta_p = self._delta_p * a_p + (1 - a_p) * delta
 
         # Calculate the exponentially weighted moving average of the derivative of cost.
         a_d = self._pid_delta_d_ema_alpha
-        self._cost_d *= a_d
-        self._cost_d += (1 - a_d) * float(ep_cost_avg)
+        self._cost_d = self._cost_d * a_d + (1 - a_d) * ep_cost_avg
 
         # Calculate the derivative term of the PID controller, taking into account the historical data.
-        pid_d = max(0.0, self._cost_d - self._cost_ds[0])
+        pid_d = torch.clamp_min(self._cost_d - self._cost_ds[0], 0.0)
 
         # Compute the overall PID output by combining proportional, integral, and derivative terms.
         pid_o = self._pid_kp * self._delta_p + self._pid_i + self._pid_kd * pid_d
 
         # Determine the new Lagrange multiplier, ensuring it is non-negative.
-        self._cost_penalty = max(0.0, pid_o)
+        self._cost_penalty = torch.clamp_min(pid_o, 0.0)
 
         # If differential normalization is used, ensure the Lagrange multiplier is between 0 and 1.
         if self._diff_norm:
-            self._cost_penalty = min(1.0, self._cost_penalty)
+            self._cost_penalty = torch.clamp_max(self._cost_penalty, 1.0)
 
         # If neither differential nor sum normalization is active, cap the Lagrange multiplier at a maximum value.
         if not (self._diff_norm or self._sum_norm):
-            self._cost_penalty = min(self._cost_penalty, self._penalty_max)
+            self._cost_penalty = torch.clamp_max(self._cost_penalty, self._penalty_max)
 
         # Update the historical cost data queue with the latest derived cost.
         self._cost_ds.append(self._cost_d)
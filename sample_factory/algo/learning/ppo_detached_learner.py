@@ -1,26 +1,17 @@
 from __future__ import annotations
 
-import time
-from typing import Dict, Optional, Tuple
+from typing import Dict, Tuple
 
-import numpy as np
 import torch
 from torch import Tensor
 
 from sample_factory.algo.learning.ppo_learner import PPOLearner
 from sample_factory.algo.learning.rnn_utils import build_core_out_from_seq, build_rnn_inputs
-from sample_factory.algo.utils.action_distributions import get_action_distribution
 from sample_factory.algo.utils.env_info import EnvInfo
-from sample_factory.algo.utils.misc import LEARNER_ENV_STEPS, POLICY_ID_KEY, STATS_KEY, TRAIN_STATS, memory_stats
 from sample_factory.algo.utils.model_sharing import ParameterServer
-from sample_factory.algo.utils.optimizers import Lamb
-from sample_factory.algo.utils.rl_utils import gae_advantages, prepare_and_normalize_obs
-from sample_factory.algo.utils.tensor_dict import TensorDict, shallow_recursive_copy
-from sample_factory.algo.utils.torch_utils import masked_select, synchronize, to_scalar
+from sample_factory.algo.utils.tensor_dict import TensorDict
 from sample_factory.utils.attr_dict import AttrDict
-from sample_factory.utils.dicts import iterate_recursively
-from sample_factory.utils.typing import ActionDistribution, Config, InitModelData, PolicyID
-from sample_factory.utils.utils import log
+from sample_factory.utils.typing import ActionDistribution, Config, PolicyID
 
 
 class PPODetachedLearner(PPOLearner):
@@ -35,437 +26,43 @@ class PPODetachedLearner(PPOLearner):
         PPOLearner.__init__(self, cfg, env_info, policy_versions_tensor, policy_id, param_server)
         self.actor_optimizer = None
         self.critic_optimizer = None
-        self.optimizers = []
 
-    def init(self) -> InitModelData:
-        init_res = super(PPODetachedLearner, self).init()
+    def _create_optimizers(self) -> None:
         actor_params = list(self.actor_critic.actor.parameters())
         critic_params = list(self.actor_critic.critic.parameters())
         self.actor_optimizer = self.create_optimizer(actor_params)
         self.critic_optimizer = self.create_optimizer(critic_params)
-        self.optimizers = [self.actor_optimizer, self.critic_optimizer]
-        self._apply_lr(self.curr_lr)
         self.optimizer = None
-        return init_res
 
-    def _apply_lr(self, lr: float) -> None:
-        """Change the learning rate of the optimizers."""
-
-        def optimizer_lr(opt):
-            for group in opt.param_groups:
-                return group["lr"]
-
-        for optimizer in self.optimizers:
-            if lr != optimizer_lr(optimizer):
-                for param_group in optimizer.param_groups:
-                    param_group["lr"] = lr
-
-    def _train(
-            self, gpu_buffer: TensorDict, batch_size: int, experience_size: int, num_invalids: int
-    ) -> Optional[AttrDict]:
-        timing = self.timing
-        with torch.no_grad():
-            early_stopping_tolerance = 1e-6
-            early_stop = False
-            prev_epoch_actor_loss = 1e9
-            epoch_actor_losses = [0] * self.cfg.num_batches_per_epoch
-
-            # recent mean KL-divergences per minibatch, this used by LR schedulers
-            recent_kls = []
-
-            if self.cfg.with_vtrace:
-                assert (
-                        self.cfg.recurrence == self.cfg.rollout and self.cfg.recurrence > 1
-                ), "V-trace requires to recurrence and rollout to be equal"
-
-            num_sgd_steps = 0
-            stats_and_summaries: Optional[AttrDict] = None
-
-            # When it is time to record train summaries, we randomly sample epoch/batch for which the summaries are
-            # collected to get equal representation from different stages of training.
-            # Half the time, we record summaries from the very large step of training. There we will have the highest
-            # KL-divergence and ratio of PPO-clipped samples, which makes this data even more useful for analysis.
-            # Something to consider: maybe we should have these last-batch metrics in a separate summaries category?
-            with_summaries = self._should_save_summaries()
-            if np.random.rand() < 0.5:
-                summaries_epoch = np.random.randint(0, self.cfg.num_epochs)
-                summaries_batch = np.random.randint(0, self.cfg.num_batches_per_epoch)
-            else:
-                summaries_epoch = self.cfg.num_epochs - 1
-                summaries_batch = self.cfg.num_batches_per_epoch - 1
-
-            assert self.actor_critic.training
-
-        for epoch in range(self.cfg.num_epochs):
-            with timing.add_time("epoch_init"):
-                if early_stop:
-                    break
-
-                force_summaries = False
-                minibatches = self._get_minibatches(batch_size, experience_size)
-
-            for batch_num in range(len(minibatches)):
-                with torch.no_grad(), timing.add_time("minibatch_init"):
-                    indices = minibatches[batch_num]
-
-                    # current minibatch consisting of short trajectory segments with length == recurrence
-                    mb = self._get_minibatch(gpu_buffer, indices)
-
-                    # enable syntactic sugar that allows us to access dict's keys as object attributes
-                    mb = AttrDict(mb)
-
-                with timing.add_time("calculate_losses"):
-                    (
-                        action_distribution,
-                        policy_loss,
-                        exploration_loss,
-                        kl_old,
-                        kl_loss,
-                        value_loss,
-                        loss_summaries,
-                    ) = self._calculate_losses(mb, num_invalids)
-
-                with timing.add_time("losses_postprocess"):
-                    # noinspection PyTypeChecker
-                    actor_loss: Tensor = policy_loss + exploration_loss + kl_loss
-                    critic_loss = value_loss
-                    loss: Tensor = actor_loss + critic_loss
-
-                    epoch_actor_losses[batch_num] = float(actor_loss)
-
-                    high_loss = 30.0
-                    if torch.abs(loss) > high_loss:
-                        log.warning(
-                            "High loss value: l:%.4f pl:%.4f vl:%.4f exp_l:%.4f kl_l:%.4f (recommended to adjust the --reward_scale parameter)",
-                            to_scalar(loss),
-                            to_scalar(policy_loss),
-                            to_scalar(value_loss),
-                            to_scalar(exploration_loss),
-                            to_scalar(kl_loss),
-                        )
-
-                        # perhaps something weird is happening, we definitely want summaries from this step
-                        force_summaries = True
-
-                with torch.no_grad(), timing.add_time("kl_divergence"):
-                    # if kl_old is not None it is already calculated above
-                    if kl_old is None:
-                        # calculate KL-divergence with the behaviour policy action distribution
-                        old_action_distribution = get_action_distribution(
-                            self.actor_critic.action_space,
-                            mb.action_logits,
-                        )
-                        kl_old = action_distribution.kl_divergence(old_action_distribution)
-                        kl_old = masked_select(kl_old, mb.valids, num_invalids)
-
-                    kl_old_mean = float(kl_old.mean().item())
-                    recent_kls.append(kl_old_mean)
-                    if kl_old.numel() > 0 and kl_old.max().item() > 100:
-                        log.warning(f"KL-divergence is very high: {kl_old.max().item():.4f}")
-
-                # update the weights
-                with timing.add_time("update"):
-                    # following advice from https://youtu.be/9mS1fIYj1So set grad to None instead of optimizer.zero_grad()
-                    for p in self.actor_critic.parameters():
-                        p.grad = None
-
-                    loss.backward()
-
-                    if self.cfg.max_grad_norm > 0.0:
-                        with timing.add_time("clip"):
-                            torch.nn.utils.clip_grad_norm_(self.actor_critic.parameters(), self.cfg.max_grad_norm)
-
-                    curr_policy_version = self.train_step  # policy version before the weight update
-
-                    actual_lr = self.curr_lr
-                    if num_invalids > 0:
-                        # if we have masked (invalid) data we should reduce the learning rate accordingly
-                        # this prevents a situation where most of the data in the minibatch is invalid
-                        # and we end up doing SGD with super noisy gradients
-                        actual_lr = self.curr_lr * (experience_size - num_invalids) / experience_size
-                    self._apply_lr(actual_lr)
-
-                    with self.param_server.policy_lock:
-                        self.critic_optimizer.step()
-                        self.actor_optimizer.step()
-
-                    num_sgd_steps += 1
-
-                with torch.no_grad(), timing.add_time("after_optimizer"):
-                    self._after_optimizer_step()
-
-                    if self.lr_scheduler.invoke_after_each_minibatch():
-                        self.curr_lr = self.lr_scheduler.update(self.curr_lr, recent_kls)
-
-                    # collect and report summaries
-                    should_record_summaries = with_summaries
-                    should_record_summaries &= epoch == summaries_epoch and batch_num == summaries_batch
-                    should_record_summaries |= force_summaries
-                    if should_record_summaries:
-                        # hacky way to collect all of the intermediate variables for summaries
-                        summary_vars = {**locals(), **loss_summaries}
-                        stats_and_summaries = self._record_summaries(AttrDict(summary_vars))
-                        del summary_vars
-                        force_summaries = False
-
-                    # make sure everything (such as policy weights) is committed to shared device memory
-                    synchronize(self.cfg, self.device)
-                    # this will force policy update on the inference worker (policy worker)
-                    self.policy_versions_tensor[self.policy_id] = self.train_step
-
-            # end of an epoch
-            if self.lr_scheduler.invoke_after_each_epoch():
-                self.curr_lr = self.lr_scheduler.update(self.curr_lr, recent_kls)
-
-            new_epoch_actor_loss = float(np.mean(epoch_actor_losses))
-            loss_delta_abs = abs(prev_epoch_actor_loss - new_epoch_actor_loss)
-            if loss_delta_abs < early_stopping_tolerance:
-                early_stop = True
-                log.debug(
-                    "Early stopping after %d epochs (%d sgd steps), loss delta %.7f",
-                    epoch + 1,
-                    num_sgd_steps,
-                    loss_delta_abs,
-                )
-                break
-
-            prev_epoch_actor_loss = new_epoch_actor_loss
-
-        return stats_and_summaries
-
-    def _get_checkpoint_dict(self):
-        checkpoint = {
-            "train_step": self.train_step,
-            "env_steps": self.env_steps,
-            "best_performance": self.best_performance,
-            "model": self.actor_critic.state_dict(),
-            "actor_optimizer": self.actor_optimizer.state_dict(),
-            "critic_optimizer": self.critic_optimizer.state_dict(),
-            "curr_lr": self.curr_lr,
-        }
-        return checkpoint
-
-    def _record_summaries(self, train_loop_vars) -> AttrDict:
-        var = train_loop_vars
-
-        self.last_summary_time = time.time()
-        stats = AttrDict()
-
-        stats.lr = self.curr_lr
-        stats.actual_lr = train_loop_vars.actual_lr  # potentially scaled because of masked data
-
-        stats.update(self.actor_critic.summaries())
-
-        stats.valids_fraction = var.mb.valids.float().mean()
-        stats.same_policy_fraction = (var.mb.policy_id == self.policy_id).float().mean()
-
-        grad_norm = (
-                sum(p.grad.data.norm(2).item()**2 for p in self.actor_critic.parameters() if p.grad is not None)**0.5
-        )
-        stats.grad_norm = grad_norm
-        stats.loss = var.loss
-        stats.value = var.values.mean()
-        stats.entropy = var.action_distribution.entropy().mean()
-        stats.policy_loss = var.policy_loss
-        stats.kl_loss = var.kl_loss
-        stats.value_loss = var.value_loss
-        stats.exploration_loss = var.exploration_loss
-
-        stats.act_min = var.mb.actions.min()
-        stats.act_max = var.mb.actions.max()
-
-        if "adv_mean" in stats:
-            stats.adv_min = var.mb.advantages.min()
-            stats.adv_max = var.mb.advantages.max()
-            stats.adv_std = var.adv_std
-            stats.adv_mean = var.adv_mean
-
-        stats.max_abs_logprob = torch.abs(var.mb.action_logits).max()
-
-        if hasattr(var.action_distribution, "summaries"):
-            stats.update(var.action_distribution.summaries())
-
-        if var.epoch == self.cfg.num_epochs - 1 and var.batch_num == len(var.minibatches) - 1:
-            # we collect these stats only for the last PPO batch, or every time if we're only doing one batch, IMPALA-style
-            valid_ratios = masked_select(var.ratio, var.mb.valids, var.num_invalids)
-            ratio_mean = torch.abs(1.0 - valid_ratios).mean().detach()
-            ratio_min = valid_ratios.min().detach()
-            ratio_max = valid_ratios.max().detach()
-            # log.debug('Learner %d ratio mean min max %.4f %.4f %.4f', self.policy_id, ratio_mean.cpu().item(), ratio_min.cpu().item(), ratio_max.cpu().item())
-
-            value_delta = torch.abs(var.values - var.mb.values)
-            value_delta_avg, value_delta_max = value_delta.mean(), value_delta.max()
-
-            stats.kl_divergence = var.kl_old_mean
-            stats.kl_divergence_max = var.kl_old.max()
-            stats.value_delta = value_delta_avg
-            stats.value_delta_max = value_delta_max
-            # noinspection PyUnresolvedReferences
-            stats.fraction_clipped = (
-                    (valid_ratios < var.clip_ratio_low).float() + (valid_ratios > var.clip_ratio_high).float()
-            ).mean()
-            stats.ratio_mean = ratio_mean
-            stats.ratio_min = ratio_min
-            stats.ratio_max = ratio_max
-            stats.num_sgd_steps = var.num_sgd_steps
-
-        # this caused numerical issues on some versions of PyTorch with second moment reaching infinity
-        adam_max_second_moment = 0.0
-        for key, tensor_state in self.optimizers[0].state.items():
-            if "exp_avg_sq" in tensor_state:
-                adam_max_second_moment = max(tensor_state["exp_avg_sq"].max().item(), adam_max_second_moment)
-        stats.adam_max_second_moment = adam_max_second_moment
-
-        version_diff = (var.curr_policy_version - var.mb.policy_version)[var.mb.policy_id == self.policy_id]
-        stats.version_diff_avg = version_diff.mean()
-        stats.version_diff_min = version_diff.min()
-        stats.version_diff_max = version_diff.max()
-
-        for key, value in stats.items():
-            stats[key] = to_scalar(value)
-
-        return stats
-
-    def _prepare_and_normalize_obs(self, obs: TensorDict) -> TensorDict:
-        og_shape = dict()
-
-        # assuming obs is a flat dict, collapse time and envs dimensions into a single batch dimension
-        for key, x in obs.items():
-            og_shape[key] = x.shape
-            obs[key] = x.view((x.shape[0] * x.shape[1],) + x.shape[2:])
-
-        # hold the lock while we alter the state of the normalizer since they can be used in other processes too
-        with self.param_server.policy_lock:
-            normalized_obs = prepare_and_normalize_obs(self.actor_critic, obs)
-
-        # restore original shape
-        for key, x in normalized_obs.items():
-            normalized_obs[key] = x.view(og_shape[key])
-
-        return normalized_obs
-
-    def _prepare_batch(self, batch: TensorDict) -> Tuple[TensorDict, int, int]:
-        with torch.no_grad():
-            # create a shallow copy so we can modify the dictionary
-            # we still reference the same buffers though
-            buff = shallow_recursive_copy(batch)
-
-            # ignore experience from other agents (i.e. on episode boundary) and from inactive agents
-            valids: Tensor = buff["policy_id"] == self.policy_id
-            # ignore experience that was older than the threshold even before training started
-            curr_policy_version: int = self.train_step
-            buff["valids"][:, :-1] = valids & (curr_policy_version - buff["policy_version"] < self.cfg.max_policy_lag)
-            # for last T+1 step, we want to use the validity of the previous step
-            buff["valids"][:, -1] = buff["valids"][:, -2]
-
-            # ensure we're in train mode so that normalization statistics are updated
-            if not self.actor_critic.training:
-                self.actor_critic.train()
-
-            buff["normalized_obs"] = self._prepare_and_normalize_obs(buff["obs"])
-            del buff["obs"]  # don't need non-normalized obs anymore
-
-            # calculate estimated value for the next step (T+1)
-            normalized_last_obs = buff["normalized_obs"][:, -1]
-            next_values = self.actor_critic(normalized_last_obs, buff["rnn_states"][:, -1], values_only=True)["values"]
-            buff["values"][:, -1] = next_values
-
-            if self.cfg.normalize_returns:
-                # Since our value targets are normalized, the values will also have normalized statistics.
-                # We need to denormalize them before using them for GAE caculation and value bootstrapping.
-                # rl_games PPO uses a similar approach, see:
-                # https://github.com/Denys88/rl_games/blob/7b5f9500ee65ae0832a7d8613b019c333ecd932c/rl_games/algos_torch/models.py#L51
-                denormalized_values = buff["values"].clone()  # need to clone since normalizer is in-place
-                self.actor_critic.returns_normalizer(denormalized_values, denormalize=True)
-            else:
-                # values are not normalized in this case, so we can use them as is
-                denormalized_values = buff["values"]
-
-            if self.cfg.value_bootstrap:
-                # Value bootstrapping is a technique that reduces the surprise for the critic in case
-                # we're ending the episode by timeout. Intuitively, in this case the cumulative return for the last step
-                # should not be zero, but rather what the critic expects. This improves learning in many envs
-                # because otherwise the critic cannot predict the abrupt change in rewards in a timed-out episode.
-                # What we really want here is v(t+1) which we don't have because we don't have obs(t+1) (since
-                # the episode ended). Using v(t) is an approximation that requires that rew(t) can be generally ignored.
-
-                # Multiply by both time_out and done flags to make sure we count only timeouts in terminal states.
-                # There was a bug in older versions of isaacgym where timeouts were reported for non-terminal states.
-                buff["rewards"].add_(self.cfg.gamma * denormalized_values[:, :-1] * buff["time_outs"] * buff["dones"])
-
-            if not self.cfg.with_vtrace:
-                # calculate advantage estimate (in case of V-trace it is done separately for each minibatch)
-                buff["advantages"] = gae_advantages(
-                    buff["rewards"],
-                    buff["dones"],
-                    denormalized_values,
-                    buff["valids"],
-                    self.cfg.gamma,
-                    self.cfg.gae_lambda,
-                )
-                # here returns are not normalized yet, so we should use denormalized values
-                buff["returns"] = buff["advantages"] + buff["valids"][:, :-1] * denormalized_values[:, :-1]
-
-            # remove next step obs, rnn_states, and values from the batch, we don't need them anymore
-            for key in ["normalized_obs", "rnn_states", "values", "valids"]:
-                buff[key] = buff[key][:, :-1]
-
-            dataset_size = buff["actions"].shape[0] * buff["actions"].shape[1]
-            for d, k, v in iterate_recursively(buff):
-                # collapse first two dimensions (batch and time) into a single dimension
-                d[k] = v.reshape((dataset_size,) + tuple(v.shape[2:]))
-
-            buff["dones_cpu"] = buff["dones"].to("cpu", copy=True, dtype=torch.float, non_blocking=True)
-            buff["rewards_cpu"] = buff["rewards"].to("cpu", copy=True, dtype=torch.float, non_blocking=True)
-
-            # return normalization parameters are only used on the learner, no need to lock the mutex
-            if self.cfg.normalize_returns:
-                self.actor_critic.returns_normalizer(buff["returns"])  # in-place
-
-            num_invalids = dataset_size - buff["valids"].sum().item()
-            if num_invalids > 0:
-                invalid_fraction = num_invalids / dataset_size
-                if invalid_fraction > 0.5:
-                    log.warning(f"{self.policy_id=} batch has {invalid_fraction:.2%} of invalid samples")
-
-                # invalid action values can cause problems when we calculate logprobs
-                # here we set them to 0 just to be safe
-                invalid_indices = (buff["valids"] == 0).nonzero().squeeze()
-                buff["actions"][invalid_indices] = 0
-                # likewise, some invalid values of log_prob_actions can cause NaNs or infs
-                buff["log_prob_actions"][invalid_indices] = -1  # -1 seems like a safe value
-
-            return buff, dataset_size, num_invalids
-
-    def train(self, batch: TensorDict) -> Optional[Dict]:
-        with self.timing.add_time("misc"):
-            self._maybe_update_cfg()
-            self._maybe_load_policy()
-
-        with self.timing.add_time("prepare_batch"):
-            buff, experience_size, num_invalids = self._prepare_batch(batch)
-
-        if num_invalids >= experience_size:
-            if self.cfg.with_pbt:
-                log.warning("No valid samples in the batch, with PBT this must mean we just replaced weights")
-            else:
-                log.error(f"Learner {self.policy_id=} received an entire batch of invalid data, skipping...")
-            return None
+    def _named_optimizers(self) -> Dict[str, torch.optim.Optimizer]:
+        return dict(actor_optimizer=self.actor_optimizer, critic_optimizer=self.critic_optimizer)
+
+    def _forward_minibatch(self, mb: AttrDict) -> Tuple[TensorDict, ActionDistribution]:
+        """The actor and the critic towers have their own heads, cores and RNN states, the pass is always eager."""
+        actor_head_outputs, critic_head_outputs = self.actor_critic.forward_head(mb.normalized_obs)
+        if self.cfg.use_rnn:
+            done_or_invalid = torch.logical_or(mb.dones_cpu, ~mb.valids.cpu()).float()
+            actor_rnn_states, critic_rnn_states = mb.rnn_states.chunk(2, dim=1)
+
+            actor_head_output_seq, actor_rnn_states, actor_inverted_inds = build_rnn_inputs(
+                actor_head_outputs, done_or_invalid, actor_rnn_states, self.cfg.recurrence
+            )
+            critic_head_output_seq, critic_rnn_states, critic_inverted_inds = build_rnn_inputs(
+                critic_head_outputs, done_or_invalid, critic_rnn_states, self.cfg.recurrence
+            )
+
+            actor_core_output_seq, critic_core_output_seq, _, _ = self.actor_critic.forward_core(
+                actor_head_output_seq, critic_head_output_seq, actor_rnn_states, critic_rnn_states
+            )
+            actor_core_outputs = build_core_out_from_seq(actor_core_output_seq, actor_inverted_inds)
+            critic_core_outputs = build_core_out_from_seq(critic_core_output_seq, critic_inverted_inds)
         else:
-            with self.timing.add_time("train"):
-                train_stats = self._train(buff, self.cfg.batch_size, experience_size, num_invalids)
-
-            # multiply the number of samples by frameskip so that FPS metrics reflect the number
-            # of environment steps actually simulated
-            if self.cfg.summaries_use_frameskip:
-                self.env_steps += experience_size * self.env_info.frameskip
-            else:
-                self.env_steps += experience_size
+            actor_rnn_states, critic_rnn_states = mb.rnn_states[:: self.cfg.recurrence].chunk(2, dim=1)
+            actor_core_outputs, critic_core_outputs, _, _ = self.actor_critic.forward_core(
+                actor_head_outputs, critic_head_outputs, actor_rnn_states, critic_rnn_states
+            )
 
-            stats = {LEARNER_ENV_STEPS: self.env_steps, POLICY_ID_KEY: self.policy_id}
-            if train_stats is not None:
-                if train_stats is not None:
-                    stats[TRAIN_STATS] = train_stats
-                stats[STATS_KEY] = memory_stats("learner", self.device)
-
-            return stats
+        result = self.actor_critic.forward_tail(
+            actor_core_outputs, critic_core_outputs, values_only=False, sample_actions=False
+        )
+        return result, self.actor_critic.action_distribution()
@@ -1,128 +1,25 @@
 from __future__ import annotations
 
-import glob
-import os
 import time
-from abc import ABC, abstractmethod
-from os.path import join
 from typing import Callable, Dict, Optional, Tuple
 
-import numpy as np
 import torch
 from torch import Tensor
-from torch.nn import Module
 
-from sample_factory.algo.learning.rnn_utils import build_core_out_from_seq, build_rnn_inputs
+from sample_factory.algo.learning.learner import Learner, MinibatchLosses
+from sample_factory.algo.learning.learner_metrics import adam_max_second_moment, global_grad_norm
+from sample_factory.algo.learning.rnn_utils import build_core_out_from_seq
 from sample_factory.algo.utils.action_distributions import get_action_distribution, is_continuous_action_space
 from sample_factory.algo.utils.env_info import EnvInfo
-from sample_factory.algo.utils.misc import LEARNER_ENV_STEPS, POLICY_ID_KEY, STATS_KEY, TRAIN_STATS, memory_stats
 from sample_factory.algo.utils.model_sharing import ParameterServer
-from sample_factory.algo.utils.optimizers import Lamb
-from sample_factory.algo.utils.rl_utils import gae_advantages, prepare_and_normalize_obs
-from sample_factory.algo.utils.shared_buffers import policy_device
-from sample_factory.algo.utils.tensor_dict import TensorDict, shallow_recursive_copy
-from sample_factory.algo.utils.torch_utils import masked_select, synchronize, to_scalar
-from sample_factory.cfg.configurable import Configurable
-from sample_factory.model.actor_critic import ActorCritic, create_actor_critic
+from sample_factory.algo.utils.tensor_dict import TensorDict
+from sample_factory.algo.utils.torch_utils import masked_select
 from sample_factory.utils.attr_dict import AttrDict
-from sample_factory.utils.decay import LinearDecay
-from sample_factory.utils.dicts import iterate_recursively
-from sample_factory.utils.timing import Timing
 from sample_factory.utils.typing import ActionDistribution, Config, InitModelData, PolicyID
-from sample_factory.utils.utils import ensure_dir_exists, experiment_dir, log
+from sample_factory.utils.utils import log
 
 
-class LearningRateScheduler:
-    def update(self, current_lr, recent_kls):
-        return current_lr
-
-    def invoke_after_each_minibatch(self):
-        return False
-
-    def invoke_after_each_epoch(self):
-        return False
-
-
-class KlAdaptiveScheduler(LearningRateScheduler, ABC):
-    def __init__(self, cfg: Config):
-        self.lr_schedule_kl_threshold = cfg.lr_schedule_kl_threshold
-        self.min_lr = cfg.lr_adaptive_min
-        self.max_lr = cfg.lr_adaptive_max
-
-    @abstractmethod
-    def num_recent_kls_to_use(self) -> int:
-        pass
-
-    def update(self, current_lr, recent_kls):
-        num_kls_to_use = self.num_recent_kls_to_use()
-        kls = recent_kls[-num_kls_to_use:]
-        mean_kl = np.mean(kls)
-        lr = current_lr
-        if mean_kl > 2.0 * self.lr_schedule_kl_threshold:
-            lr = max(current_lr / 1.5, self.min_lr)
-        if mean_kl < (0.5 * self.lr_schedule_kl_threshold):
-            lr = min(current_lr * 1.5, self.max_lr)
-        return lr
-
-
-class KlAdaptiveSchedulerPerMinibatch(KlAdaptiveScheduler):
-    def num_recent_kls_to_use(self) -> int:
-        return 1
-
-    def invoke_after_each_minibatch(self):
-        return True
-
-
-class KlAdaptiveSchedulerPerEpoch(KlAdaptiveScheduler):
-    def __init__(self, cfg):
-        super().__init__(cfg)
-        self.num_minibatches_per_epoch = cfg.num_batches_per_epoch
-
-    def num_recent_kls_to_use(self) -> int:
-        return self.num_minibatches_per_epoch
-
-    def invoke_after_each_epoch(self):
-        return True
-
-
-class LinearDecayScheduler(LearningRateScheduler):
-    def __init__(self, cfg):
-        num_updates = cfg.train_for_env_steps // cfg.batch_size * cfg.num_epochs
-        self.linear_decay = LinearDecay([(0, cfg.learning_rate), (num_updates, 0)])
-        self.step = 0
-
-    def invoke_after_each_minibatch(self):
-        return True
-
-    def update(self, current_lr, recent_kls):
-        self.step += 1
-        lr = self.linear_decay.at(self.step)
-        return lr
-
-
-def get_lr_scheduler(cfg) -> LearningRateScheduler:
-    if cfg.lr_schedule == "constant":
-        return LearningRateScheduler()
-    elif cfg.lr_schedule == "kl_adaptive_minibatch":
-        return KlAdaptiveSchedulerPerMinibatch(cfg)
-    elif cfg.lr_schedule == "kl_adaptive_epoch":
-        return KlAdaptiveSchedulerPerEpoch(cfg)
-    elif cfg.lr_schedule == "linear_decay":
-        return LinearDecayScheduler(cfg)
-    else:
-        raise RuntimeError(f"Unknown scheduler {cfg.lr_schedule}")
-
-
-def model_initialization_data(
-    cfg: Config, policy_id: PolicyID, actor_critic: Module, policy_version: int, device: torch.device
-) -> InitModelData:
-    # in serial mode we will just use the same actor_critic directly
-    state_dict = None if cfg.serial_mode else actor_critic.state_dict()
-    model_state = (policy_id, state_dict, device, policy_version)
-    return model_state
-
-
-class PPOLearner(Configurable):
+class PPOLearner(Learner):
     def __init__(
         self,
         cfg: Config,
@@ -131,62 +28,17 @@ class PPOLearner(Configurable):
         policy_id: PolicyID,
         param_server: ParameterServer,
     ):
-        Configurable.__init__(self, cfg)
-
-        self.timing = Timing(name=f"Learner {policy_id} profile")
-
-        self.policy_id = policy_id
-
-        self.env_info = env_info
-
-        self.safety_bound = env_info.safety_bound / env_info.timeout * env_info.frameskip
-
-        self.device = None
-        self.actor_critic: Optional[ActorCritic] = None
-
-        self.optimizer = None
-
-        self.curr_lr: Optional[float] = None
-        self.lr_scheduler: Optional[LearningRateScheduler] = None
-
-        self.train_step: int = 0  # total number of SGD steps
-        self.env_steps: int = 0  # total number of environment steps consumed by the learner
+        super().__init__(cfg, env_info, policy_versions_tensor, policy_id, param_server)
 
-        self.best_performance = -1e9
-
-        # for configuration updates, i.e. from PBT
-        self.new_cfg: Optional[Dict] = None
-
-        # for multi-policy learning (i.e. with PBT) when we need to load weights of another policy
-        self.policy_to_load: Optional[PolicyID] = None
-
-        # decay rate at which summaries are collected
-        # save summaries every 5 seconds in the beginning, but decay to every 4 minutes in the limit, because we
-        # do not need frequent summaries for longer experiments
-        self.summary_rate_decay_seconds = LinearDecay([(0, 2), (100000, 60), (1000000, 120)])
-        self.last_summary_time = 0
-        self.last_milestone_time = 0
-
-        # shared tensor used to share the latest policy version between processes
-        self.policy_versions_tensor: Tensor = policy_versions_tensor
-
-        self.param_server: ParameterServer = param_server
-
-        self.exploration_loss_func: Optional[Callable] = None
         self.kl_loss_func: Optional[Callable] = None
 
-        self.is_initialized = False
+        # compiled forward pass of the minibatches and the minibatch size it was compiled for,
+        # see _compiled_minibatch_forward()
+        self._compiled_forward: Optional[Callable] = None
+        self._compiled_minibatch_size: Optional[int] = None
+        self._compile_failed = False
 
     def init(self) -> InitModelData:
-        if self.cfg.exploration_loss_coeff == 0.0:
-            self.exploration_loss_func = lambda action_distr, valids, num_invalids: 0.0
-        elif self.cfg.exploration_loss == "entropy":
-            self.exploration_loss_func = self._entropy_exploration_loss
-        elif self.cfg.exploration_loss == "symmetric_kl":
-            self.exploration_loss_func = self._symmetric_kl_exploration_loss
-        else:
-            raise NotImplementedError(f"{self.cfg.exploration_loss} not supported!")
-
         if self.cfg.kl_loss_coeff == 0.0:
             if is_continuous_action_space(self.env_info.action_space):
                 log.warning(
@@ -197,250 +49,7 @@ class PPOLearner(Configurable):
         else:
             self.kl_loss_func = self._kl_loss
 
-        # initialize the Torch modules
-        if self.cfg.seed is None:
-            log.info("Starting seed is not provided")
-        else:
-            log.info("Setting fixed seed %d", self.cfg.seed)
-            torch.manual_seed(self.cfg.seed)
-            np.random.seed(self.cfg.seed)
-
-        # initialize device
-        self.device = policy_device(self.cfg, self.policy_id)
-
-        log.debug("Initializing actor-critic model on device %s", self.device)
-
-        # trainable torch module
-        self.actor_critic = create_actor_critic(self.cfg, self.env_info.obs_space, self.env_info.action_space)
-        log.debug("Created Actor Critic model with architecture:")
-        log.debug(self.actor_critic)
-        self.actor_critic.model_to_device(self.device)
-
-        def share_mem(t):
-            if t is not None and not t.is_cuda:
-                return t.share_memory_()
-            return t
-
-        # noinspection PyProtectedMember
-        self.actor_critic._apply(share_mem)
-        self.actor_critic.train()
-
-        params = list(self.actor_critic.parameters())
-
-        self.optimizer = self.create_optimizer(params)
-
-        # self.load_from_checkpoint(self.policy_id)
-        self.param_server.init(self.actor_critic, self.train_step, self.device)
-        self.policy_versions_tensor[self.policy_id] = self.train_step
-
-        self.lr_scheduler = get_lr_scheduler(self.cfg)
-        self.curr_lr = self.cfg.learning_rate if self.curr_lr is None else self.curr_lr
-        self._apply_lr(self.curr_lr)
-
-        self.is_initialized = True
-
-        return model_initialization_data(self.cfg, self.policy_id, self.actor_critic, self.train_step, self.device)
-
-    def create_optimizer(self, params):
-        optimizer_cls = dict(adam=torch.optim.Adam, lamb=Lamb)
-        if self.cfg.optimizer not in optimizer_cls:
-            raise RuntimeError(f"Unknown optimizer {self.cfg.optimizer}")
-        optimizer_cls = optimizer_cls[self.cfg.optimizer]
-        log.debug(f"Using optimizer {optimizer_cls}")
-        optimizer_kwargs = dict(
-            lr=self.cfg.learning_rate,  # use default lr only in ctor, then we use the one loaded from the checkpoint
-            betas=(self.cfg.adam_beta1, self.cfg.adam_beta2),
-        )
-        if self.cfg.optimizer in ["adam", "lamb"]:
-            optimizer_kwargs["eps"] = self.cfg.adam_eps
-        return optimizer_cls(params, **optimizer_kwargs)
-
-    @staticmethod
-    def checkpoint_dir(cfg, policy_id):
-        checkpoint_dir = join(experiment_dir(cfg=cfg), f"checkpoint_p{policy_id}")
-        return ensure_dir_exists(checkpoint_dir)
-
-    @staticmethod
-    def get_checkpoints(checkpoints_dir, pattern="checkpoint_*"):
-        checkpoints = glob.glob(join(checkpoints_dir, pattern))
-        return sorted(checkpoints)
-
-    @staticmethod
-    def load_checkpoint(checkpoints, device):
-        if len(checkpoints) <= 0:
-            log.warning("No checkpoints found")
-            return None
-        else:
-            latest_checkpoint = checkpoints[-1]
-
-            # extra safety mechanism to recover from spurious filesystem errors
-            num_attempts = 3
-            for attempt in range(num_attempts):
-                # noinspection PyBroadException
-                try:
-                    log.warning("Loading state from checkpoint %s...", latest_checkpoint)
-                    checkpoint_dict = torch.load(latest_checkpoint, map_location=device)
-                    return checkpoint_dict
-                except Exception:
-                    log.exception(f"Could not load from checkpoint, attempt {attempt}")
-
-    def _load_state(self, checkpoint_dict, load_progress=True):
-        if load_progress:
-            self.train_step = checkpoint_dict["train_step"]
-            self.env_steps = checkpoint_dict["env_steps"]
-            self.best_performance = checkpoint_dict.get("best_performance", self.best_performance)
-        self.actor_critic.load_state_dict(checkpoint_dict["model"])
-        self.optimizer.load_state_dict(checkpoint_dict["optimizer"])
-        self.curr_lr = checkpoint_dict.get("curr_lr", self.cfg.learning_rate)
-
-        log.info(f"Loaded experiment state at {self.train_step=}, {self.env_steps=}")
-
-    def load_from_checkpoint(self, policy_id: PolicyID, load_progress: bool = True) -> None:
-        name_prefix = dict(latest="checkpoint", best="best")[self.cfg.load_checkpoint_kind]
-        checkpoints = self.get_checkpoints(self.checkpoint_dir(self.cfg, policy_id), pattern=f"{name_prefix}_*")
-        checkpoint_dict = self.load_checkpoint(checkpoints, self.device)
-        if checkpoint_dict is None:
-            log.debug("Did not load from checkpoint, starting from scratch!")
-        else:
-            log.debug("Loading model from checkpoint")
-
-            # if we're replacing our policy with another policy (under PBT), let's not reload the env_steps
-            self._load_state(checkpoint_dict, load_progress=load_progress)
-
-    def _should_save_summaries(self):
-        summaries_every_seconds = self.summary_rate_decay_seconds.at(self.train_step)
-        if time.time() - self.last_summary_time < summaries_every_seconds:
-            return False
-
-        return True
-
-    def _after_optimizer_step(self):
-        """A hook to be called after each optimizer step."""
-        self.train_step += 1
-
-    def _get_checkpoint_dict(self):
-        checkpoint = {
-            "train_step": self.train_step,
-            "env_steps": self.env_steps,
-            "best_performance": self.best_performance,
-            "model": self.actor_critic.state_dict(),
-            "optimizer": self.optimizer.state_dict(),
-            "curr_lr": self.curr_lr,
-        }
-        return checkpoint
-
-    def _save_impl(self, name_prefix, name_suffix, keep_checkpoints, verbose=True) -> bool:
-        if not self.is_initialized:
-            return False
-
-        checkpoint = self._get_checkpoint_dict()
-        assert checkpoint is not None
-
-        checkpoint_dir = self.checkpoint_dir(self.cfg, self.policy_id)
-        tmp_filepath = join(checkpoint_dir, f"{name_prefix}_temp")
-        checkpoint_name = f"{name_prefix}_{self.train_step:09d}_{self.env_steps}{name_suffix}.pth"
-        filepath = join(checkpoint_dir, checkpoint_name)
-        if verbose:
-            log.info("Saving %s...", filepath)
-
-        # This should protect us from a rare case where something goes wrong mid-save and we end up with a corrupted
-        # checkpoint file. It better be a corrupted temp file.
-        torch.save(checkpoint, tmp_filepath)
-        os.rename(tmp_filepath, filepath)
-
-        while len(checkpoints := self.get_checkpoints(checkpoint_dir, f"{name_prefix}_*")) > keep_checkpoints:
-            oldest_checkpoint = checkpoints[0]
-            if os.path.isfile(oldest_checkpoint):
-                if verbose:
-                    log.debug("Removing %s", oldest_checkpoint)
-                os.remove(oldest_checkpoint)
-
-        return True
-
-    def save(self) -> bool:
-        return self._save_impl("checkpoint", "", self.cfg.keep_checkpoints)
-
-    def save_milestone(self):
-        checkpoint = self._get_checkpoint_dict()
-        assert checkpoint is not None
-        checkpoint_dir = self.checkpoint_dir(self.cfg, self.policy_id)
-        checkpoint_name = f"checkpoint_{self.train_step:09d}_{self.env_steps}.pth"
-
-        milestones_dir = ensure_dir_exists(join(checkpoint_dir, "milestones"))
-        milestone_path = join(milestones_dir, f"{checkpoint_name}")
-        log.info("Saving a milestone %s", milestone_path)
-        torch.save(checkpoint, milestone_path)
-
-    def save_best(self, policy_id, metric, metric_value) -> bool:
-        if policy_id != self.policy_id:
-            return False
-        p = 3  # precision, number of significant digits
-        if metric_value - self.best_performance > 1 / 10**p:
-            log.info(f"Saving new best policy, {metric}={metric_value:.{p}f}!")
-            self.best_performance = metric_value
-            name_suffix = f"_{metric}_{metric_value:.{p}f}"
-            return self._save_impl("best", name_suffix, 1, verbose=False)
-
-        return False
-
-    def set_new_cfg(self, new_cfg: Dict) -> None:
-        self.new_cfg = new_cfg
-
-    def set_policy_to_load(self, policy_to_load: PolicyID) -> None:
-        self.policy_to_load = policy_to_load
-
-    def _maybe_update_cfg(self) -> None:
-        if self.new_cfg is not None:
-            for key, value in self.new_cfg.items():
-                if getattr(self.cfg, key) != value:
-                    log.debug("Learner %d replacing cfg parameter %r with new value %r", self.policy_id, key, value)
-                    setattr(self.cfg, key, value)
-
-            if self.cfg.lr_schedule == "constant" and self.curr_lr != self.cfg.learning_rate:
-                # PBT-optimized learning rate, only makes sense if we use constant LR
-                # in case of more advanced LR scheduling we should update the parameters of the scheduler, not the
-                # learning rate directly
-                log.debug(f"Updating learning rate from {self.curr_lr} to {self.cfg.learning_rate}")
-                self.curr_lr = self.cfg.learning_rate
-                self._apply_lr(self.curr_lr)
-
-            for param_group in self.optimizer.param_groups:
-                param_group["betas"] = (self.cfg.adam_beta1, self.cfg.adam_beta2)
-                log.debug("Optimizer lr value %.7f, betas: %r", param_group["lr"], param_group["betas"])
-
-            self.new_cfg = None
-
-    def _maybe_load_policy(self) -> None:
-        cfg = self.cfg
-        if self.policy_to_load is not None:
-            with self.param_server.policy_lock:
-                # don't re-load progress if we are loading from another policy checkpoint
-                self.load_from_checkpoint(self.policy_to_load, load_progress=False)
-
-            # make sure everything (such as policy weights) is committed to shared device memory
-            synchronize(cfg, self.device)
-            # this will force policy update on the inference worker (policy worker)
-            # we add max_policy_lag steps so that all experience currently in batches is invalidated
-            self.train_step += cfg.max_policy_lag + 1
-            self.policy_versions_tensor[self.policy_id] = self.train_step
-
-            self.policy_to_load = None
-
-        timestamp = cfg.load_checkpoint_timestamp
-        if timestamp:
-            level = cfg.load_checkpoint_level
-            kind = cfg.load_checkpoint_kind
-            name_prefix = dict(latest="checkpoint", best="best")[kind]
-            checkpoints_dir = f'{cfg.train_dir}/{cfg.algo}/{cfg.env}/Level_{level}/{timestamp}/checkpoint_p0'
-            print(f'Loading checkpoint from {checkpoints_dir}')
-            if not os.path.exists(checkpoints_dir):
-                raise FileNotFoundError(f"No checkpoint directory found at {checkpoints_dir}")
-            checkpoints = PPOLearner.get_checkpoints(checkpoints_dir, f"{name_prefix}_*")
-            if not checkpoints:
-                raise FileNotFoundError(f"No checkpoint files match the specified pattern.")
-            checkpoint_dict = PPOLearner.load_checkpoint(checkpoints, self.device)
-            self.actor_critic.load_state_dict(checkpoint_dict["model"])
-            cfg.load_checkpoint_timestamp = None  # Set to None to prevent from loading a second time
+        return super().init()
 
     @staticmethod
     def _policy_loss(ratio, adv, clip_ratio_low, clip_ratio_high, valids, num_invalids: int):
@@ -485,100 +94,72 @@ class PPOLearner(Configurable):
 
         return kl_old, kl_loss
 
-    def _entropy_exploration_loss(self, action_distribution, valids, num_invalids: int) -> Tensor:
-        entropy = action_distribution.entropy()
-        entropy = masked_select(entropy, valids, num_invalids)
-        entropy_loss = -self.cfg.exploration_loss_coeff * entropy.mean()
-        return entropy_loss
-
-    def _symmetric_kl_exploration_loss(self, action_distribution, valids, num_invalids: int) -> Tensor:
-        kl_prior = action_distribution.symmetric_kl_with_uniform_prior()
-        kl_prior = masked_select(kl_prior, valids, num_invalids).mean()
-        if not torch.isfinite(kl_prior):
-            kl_prior = torch.zeros(kl_prior.shape)
-        kl_prior = torch.clamp(kl_prior, max=30)
-        kl_prior_loss = self.cfg.exploration_loss_coeff * kl_prior
-        return kl_prior_loss
-
-    def _optimizer_lr(self):
-        for param_group in self.optimizer.param_groups:
-            return param_group["lr"]
-
-    def _apply_lr(self, lr: float) -> None:
-        """Change learning rate in the optimizer."""
-        if lr != self._optimizer_lr():
-            for param_group in self.optimizer.param_groups:
-                param_group["lr"] = lr
-
-    def _get_minibatches(self, batch_size, experience_size):
-        """Generating minibatches for training."""
-        assert self.cfg.rollout % self.cfg.recurrence == 0
-        assert experience_size % batch_size == 0, f"experience size: {experience_size}, batch size: {batch_size}"
-        minibatches_per_epoch = self.cfg.num_batches_per_epoch
-
-        if minibatches_per_epoch == 1:
-            return [None]  # single minibatch is actually the entire buffer, we don't need indices
-
-        if self.cfg.shuffle_minibatches:
-            # indices that will start the mini-trajectories from the same episode (for bptt)
-            indices = np.arange(0, experience_size, self.cfg.recurrence)
-            indices = np.random.permutation(indices)
-
-            # complete indices of mini trajectories, e.g. with recurrence==4: [4, 16] -> [4, 5, 6, 7, 16, 17, 18, 19]
-            indices = [np.arange(i, i + self.cfg.recurrence) for i in indices]
-            indices = np.concatenate(indices)
-
-            assert len(indices) == experience_size
-
-            num_minibatches = experience_size // batch_size
-            minibatches = np.split(indices, num_minibatches)
-        else:
-            minibatches = list(slice(i * batch_size, (i + 1) * batch_size) for i in range(0, minibatches_per_epoch))
+    def _compile_mode(self) -> Optional[str]:
+        mode = self.cfg.compile_train_step if "compile_train_step" in self.cfg else "off"
+        return None if mode == "off" else mode
+
+    def _compiled_minibatch_forward(self, minibatch_size: int) -> Optional[Callable]:
+        """
+        The forward pass of a minibatch (head, core and tail) compiled with torch.compile, or None when the minibatch
+        has to go through the eager path. Only feed-forward cores are compiled: the packed sequences of the RNN cores
+        change shape with every batch. The function is compiled for the first minibatch size it sees, minibatches of
+        any other size (i.e. the FVP subsample of CPO) fall back to eager mode instead of triggering a recompilation.
+        """
+        mode = self._compile_mode()
+        if mode is None or self.cfg.use_rnn or self._compile_failed:
+            return None
 
-            # this makes sense but I'd like to do some testing before enabling it
-            # random.shuffle(minibatches)  # same minibatches between epochs, but in random order
+        if self._compiled_forward is None:
+            actor_critic = self.actor_critic
 
-        return minibatches
+            def minibatch_forward(normalized_obs: Dict[str, Tensor], rnn_states: Tensor) -> Dict[str, Tensor]:
+                head_outputs = actor_critic.forward_head(normalized_obs)
+                core_outputs, _ = actor_critic.forward_core(head_outputs, rnn_states)
+                return dict(actor_critic.forward_tail(core_outputs, values_only=False, sample_actions=False))
 
-    @staticmethod
-    def _get_minibatch(buffer, indices):
-        if indices is None:
-            # handle the case of a single batch, where the entire buffer is a minibatch
-            return buffer
+            log.debug("Compiling the minibatch forward pass (mode=%s, minibatch size %d)", mode, minibatch_size)
+            self._compiled_forward = torch.compile(minibatch_forward, mode=mode, dynamic=False)
+            self._compiled_minibatch_size = minibatch_size
 
-        mb = buffer[indices]
-        return mb
+        if minibatch_size != self._compiled_minibatch_size:
+            return None
 
-    def _calculate_losses(
-        self, mb: AttrDict, num_invalids: int
-    ) -> Tuple[ActionDistribution, Tensor, Tensor | float, Optional[Tensor], Tensor | float, Tensor, Dict]:
-        with torch.no_grad(), self.timing.add_time("losses_init"):
-            recurrence: int = self.cfg.recurrence
+        return self._compiled_forward
 
-            # PPO clipping
-            clip_ratio_high = 1.0 + self.cfg.ppo_clip_ratio  # e.g. 1.1
-            # this still works with e.g. clip_ratio = 2, while PPO's 1-r would give negative ratio
-            clip_ratio_low = 1.0 / clip_ratio_high
-            clip_value = self.cfg.ppo_clip_value
+    def _forward_minibatch(self, mb: AttrDict) -> Tuple[TensorDict, ActionDistribution]:
+        """Actor-critic outputs for the minibatch and the current action distribution."""
+        recurrence: int = self.cfg.recurrence
+        minibatch_size: int = len(mb.valids)
 
-            valids = mb.valids
+        compiled_forward = self._compiled_minibatch_forward(minibatch_size)
+        if compiled_forward is not None:
+            with self.timing.add_time("compiled_forward"):
+                # only torch >= 2.0 has torch.compile()
+                from torch._dynamo.exc import BackendCompilerFailed, Unsupported
+
+                try:
+                    result = TensorDict(compiled_forward(mb.normalized_obs, mb.rnn_states[::recurrence]))
+                except (BackendCompilerFailed, Unsupported) as exc:
+                    # i.e. no working compiler toolchain, we don't want to crash the experiment because of this
+                    # (errors in the model itself, OOM etc. are raised as usual)
+                    log.warning("Could not compile the minibatch forward pass, using eager mode: %r", exc)
+                    self._compile_failed = True
+                    return self._forward_minibatch(mb)
+
+                # distribution objects don't leave the compiled graph, rebuild it from the parameters
+                action_distribution = get_action_distribution(self.actor_critic.action_space, result["action_logits"])
+                self.actor_critic.last_action_distribution = action_distribution
+                return result, action_distribution
 
         # calculate policy head outside of recurrent loop
         with self.timing.add_time("forward_head"):
             head_outputs = self.actor_critic.forward_head(mb.normalized_obs)
-            minibatch_size: int = head_outputs.size(0)
 
         # initial rnn states
         with self.timing.add_time("bptt_initial"):
             if self.cfg.use_rnn:
-                # this is the only way to stop RNNs from backpropagating through invalid timesteps
-                # (i.e. experience collected by another policy)
-                done_or_invalid = torch.logical_or(mb.dones_cpu, ~valids.cpu()).float()
-                head_output_seq, rnn_states, inverted_select_inds = build_rnn_inputs(
-                    head_outputs,
-                    done_or_invalid,
-                    mb.rnn_states,
-                    recurrence,
+                head_output_seq, rnn_states, inverted_select_inds = self._minibatch_rnn_inputs(
+                    mb, head_outputs, mb.valids
                 )
             else:
                 rnn_states = mb.rnn_states[::recurrence]
@@ -595,13 +176,33 @@ class PPOLearner(Configurable):
 
             del head_outputs
 
-        num_trajectories = minibatch_size // recurrence
         assert core_outputs.shape[0] == minibatch_size
 
         with self.timing.add_time("tail"):
             # calculate policy tail outside of recurrent loop
             result = self.actor_critic.forward_tail(core_outputs, values_only=False, sample_actions=False)
             action_distribution = self.actor_critic.action_distribution()
+
+        return result, action_distribution
+
+    def _defer_minibatch_checks(self) -> bool:
+        # with a compiled train step the losses and KL-divergences of the minibatches stay on the device and
+        # the sanity checks run once per epoch, the loop only waits for the device to sync the weights
+        return self._compile_mode() is not None
+
+    def _calculate_losses(self, mb: AttrDict, num_invalids: int) -> MinibatchLosses:
+        with torch.no_grad(), self.timing.add_time("losses_init"):
+            # PPO clipping
+            clip_ratio_high = 1.0 + self.cfg.ppo_clip_ratio  # e.g. 1.1
+            # this still works with e.g. clip_ratio = 2, while PPO's 1-r would give negative ratio
+            clip_ratio_low = 1.0 / clip_ratio_high
+            clip_value = self.cfg.ppo_clip_value
+
+            valids = mb.valids
+
+        result, action_distribution = self._forward_minibatch(mb)
+
+        with self.timing.add_time("tail"):
             log_prob_actions = action_distribution.log_prob(mb.actions)
             ratio = torch.exp(log_prob_actions - mb.log_prob_actions)  # pi / pi_old
 
@@ -610,49 +211,10 @@ class PPOLearner(Configurable):
 
             values = result["values"].squeeze()
 
-            del core_outputs
-
         # these computations are not the part of the computation graph
         with torch.no_grad(), self.timing.add_time("advantages_returns"):
             if self.cfg.with_vtrace:
-                # V-trace parameters
-                rho_hat = torch.Tensor([self.cfg.vtrace_rho])
-                c_hat = torch.Tensor([self.cfg.vtrace_c])
-
-                ratios_cpu = ratio.cpu()
-                values_cpu = values.cpu()
-                rewards_cpu = mb.rewards_cpu
-                dones_cpu = mb.dones_cpu
-
-                vtrace_rho = torch.min(rho_hat, ratios_cpu)
-                vtrace_c = torch.min(c_hat, ratios_cpu)
-
-                vs = torch.zeros((num_trajectories * recurrence))
-                adv = torch.zeros((num_trajectories * recurrence))
-
-                next_values = values_cpu[recurrence - 1 :: recurrence] - rewards_cpu[recurrence - 1 :: recurrence]
-                next_values /= self.cfg.gamma
-                next_vs = next_values
-
-                for i in reversed(range(self.cfg.recurrence)):
-                    rewards = rewards_cpu[i::recurrence]
-                    dones = dones_cpu[i::recurrence]
-                    not_done = 1.0 - dones
-                    not_done_gamma = not_done * self.cfg.gamma
-
-                    curr_values = values_cpu[i::recurrence]
-                    curr_vtrace_rho = vtrace_rho[i::recurrence]
-                    curr_vtrace_c = vtrace_c[i::recurrence]
-
-                    delta_s = curr_vtrace_rho * (rewards + not_done_gamma * next_values - curr_values)
-                    adv[i::recurrence] = curr_vtrace_rho * (rewards + not_done_gamma * next_vs - curr_values)
-                    next_vs = curr_values + delta_s + not_done_gamma * curr_vtrace_c * (next_vs - next_values)
-                    vs[i::recurrence] = next_vs
-
-                    next_values = curr_values
-
-                targets = vs.to(self.device)
-                adv = adv.to(self.device)
+                targets, adv = self._vtrace(ratio, values, mb)
             else:
                 # using regular GAE
                 adv = mb.advantages
@@ -671,7 +233,7 @@ class PPOLearner(Configurable):
             old_values = mb["values"]
             value_loss = self._value_loss(values, old_values, targets, clip_value, valids, num_invalids)
 
-        mean_cost = mb["costs"].mean()
+        mean_cost = self._sum_cost_channels(mb["costs"]).mean()
 
         loss_summaries = dict(
             ratio=ratio,
@@ -684,181 +246,16 @@ class PPOLearner(Configurable):
             adv_mean=adv_mean,
         )
 
-        return action_distribution, policy_loss, exploration_loss, kl_old, kl_loss, value_loss, loss_summaries
-
-    def _train(
-        self, gpu_buffer: TensorDict, batch_size: int, experience_size: int, num_invalids: int
-    ) -> Optional[AttrDict]:
-        timing = self.timing
-        with torch.no_grad():
-            early_stopping_tolerance = 1e-6
-            early_stop = False
-            prev_epoch_actor_loss = 1e9
-            epoch_actor_losses = [0] * self.cfg.num_batches_per_epoch
-
-            # recent mean KL-divergences per minibatch, this used by LR schedulers
-            recent_kls = []
-
-            if self.cfg.with_vtrace:
-                assert (
-                    self.cfg.recurrence == self.cfg.rollout and self.cfg.recurrence > 1
-                ), "V-trace requires to recurrence and rollout to be equal"
-
-            num_sgd_steps = 0
-            stats_and_summaries: Optional[AttrDict] = None
-
-            # When it is time to record train summaries, we randomly sample epoch/batch for which the summaries are
-            # collected to get equal representation from different stages of training.
-            # Half the time, we record summaries from the very large step of training. There we will have the highest
-            # KL-divergence and ratio of PPO-clipped samples, which makes this data even more useful for analysis.
-            # Something to consider: maybe we should have these last-batch metrics in a separate summaries category?
-            with_summaries = self._should_save_summaries()
-            if np.random.rand() < 0.5:
-                summaries_epoch = np.random.randint(0, self.cfg.num_epochs)
-                summaries_batch = np.random.randint(0, self.cfg.num_batches_per_epoch)
-            else:
-                summaries_epoch = self.cfg.num_epochs - 1
-                summaries_batch = self.cfg.num_batches_per_epoch - 1
-
-            assert self.actor_critic.training
-
-        for epoch in range(self.cfg.num_epochs):
-            with timing.add_time("epoch_init"):
-                if early_stop:
-                    break
-
-                force_summaries = False
-                minibatches = self._get_minibatches(batch_size, experience_size)
-
-            for batch_num in range(len(minibatches)):
-                with torch.no_grad(), timing.add_time("minibatch_init"):
-                    indices = minibatches[batch_num]
-
-                    # current minibatch consisting of short trajectory segments with length == recurrence
-                    mb = self._get_minibatch(gpu_buffer, indices)
-
-                    # enable syntactic sugar that allows us to access dict's keys as object attributes
-                    mb = AttrDict(mb)
-
-                with timing.add_time("calculate_losses"):
-                    (
-                        action_distribution,
-                        policy_loss,
-                        exploration_loss,
-                        kl_old,
-                        kl_loss,
-                        value_loss,
-                        loss_summaries,
-                    ) = self._calculate_losses(mb, num_invalids)
-
-                with timing.add_time("losses_postprocess"):
-                    # noinspection PyTypeChecker
-                    actor_loss: Tensor = policy_loss + exploration_loss + kl_loss
-                    critic_loss = value_loss
-                    loss: Tensor = actor_loss + critic_loss
-
-                    epoch_actor_losses[batch_num] = float(actor_loss)
-
-                    high_loss = 30.0
-                    if torch.abs(loss) > high_loss:
-                        log.warning(
-                            "High loss value: l:%.4f pl:%.4f vl:%.4f exp_l:%.4f kl_l:%.4f (recommended to adjust the --reward_scale parameter)",
-                            to_scalar(loss),
-                            to_scalar(policy_loss),
-                            to_scalar(value_loss),
-                            to_scalar(exploration_loss),
-                            to_scalar(kl_loss),
-                        )
-
-                        # perhaps something weird is happening, we definitely want summaries from this step
-                        force_summaries = True
-
-                with torch.no_grad(), timing.add_time("kl_divergence"):
-                    # if kl_old is not None it is already calculated above
-                    if kl_old is None:
-                        # calculate KL-divergence with the behaviour policy action distribution
-                        old_action_distribution = get_action_distribution(
-                            self.actor_critic.action_space,
-                            mb.action_logits,
-                        )
-                        kl_old = action_distribution.kl_divergence(old_action_distribution)
-                        kl_old = masked_select(kl_old, mb.valids, num_invalids)
-
-                    kl_old_mean = float(kl_old.mean().item())
-                    recent_kls.append(kl_old_mean)
-                    if kl_old.numel() > 0 and kl_old.max().item() > 100:
-                        log.warning(f"KL-divergence is very high: {kl_old.max().item():.4f}")
-
-                # update the weights
-                with timing.add_time("update"):
-                    # following advice from https://youtu.be/9mS1fIYj1So set grad to None instead of optimizer.zero_grad()
-                    for p in self.actor_critic.parameters():
-                        p.grad = None
-
-                    loss.backward()
-
-                    if self.cfg.max_grad_norm > 0.0:
-                        with timing.add_time("clip"):
-                            torch.nn.utils.clip_grad_norm_(self.actor_critic.parameters(), self.cfg.max_grad_norm)
-
-                    curr_policy_version = self.train_step  # policy version before the weight update
-
-                    actual_lr = self.curr_lr
-                    if num_invalids > 0:
-                        # if we have masked (invalid) data we should reduce the learning rate accordingly
-                        # this prevents a situation where most of the data in the minibatch is invalid
-                        # and we end up doing SGD with super noisy gradients
-                        actual_lr = self.curr_lr * (experience_size - num_invalids) / experience_size
-                    self._apply_lr(actual_lr)
-
-                    with self.param_server.policy_lock:
-                        self.optimizer.step()
-
-                    num_sgd_steps += 1
-
-                with torch.no_grad(), timing.add_time("after_optimizer"):
-                    self._after_optimizer_step()
-
-                    if self.lr_scheduler.invoke_after_each_minibatch():
-                        self.curr_lr = self.lr_scheduler.update(self.curr_lr, recent_kls)
-
-                    # collect and report summaries
-                    should_record_summaries = with_summaries
-                    should_record_summaries &= epoch == summaries_epoch and batch_num == summaries_batch
-                    should_record_summaries |= force_summaries
-                    if should_record_summaries:
-                        # hacky way to collect all of the intermediate variables for summaries
-                        summary_vars = {**locals(), **loss_summaries}
-                        stats_and_summaries = self._record_summaries(AttrDict(summary_vars))
-                        del summary_vars
-                        force_summaries = False
-
-                    # make sure everything (such as policy weights) is committed to shared device memory
-                    synchronize(self.cfg, self.device)
-                    # this will force policy update on the inference worker (policy worker)
-                    self.policy_versions_tensor[self.policy_id] = self.train_step
-
-            # end of an epoch
-            if self.lr_scheduler.invoke_after_each_epoch():
-                self.curr_lr = self.lr_scheduler.update(self.curr_lr, recent_kls)
-
-            new_epoch_actor_loss = float(np.mean(epoch_actor_losses))
-            loss_delta_abs = abs(prev_epoch_actor_loss - new_epoch_actor_loss)
-            if loss_delta_abs < early_stopping_tolerance:
-                early_stop = True
-                log.debug(
-                    "Early stopping after %d epochs (%d sgd steps), loss delta %.7f",
-                    epoch + 1,
-                    num_sgd_steps,
-                    loss_delta_abs,
-                )
-                break
-
-            prev_epoch_actor_loss = new_epoch_actor_loss
-
-        return stats_and_summaries
+        return MinibatchLosses(
+            action_distribution,
+            dict(policy_loss=policy_loss, exploration_loss=exploration_loss, kl_loss=kl_loss),
+            dict(value_loss=value_loss),
+            kl_old,
+            loss_summaries,
+        )
 
-    def _record_summaries(self, train_loop_vars) -> AttrDict:
+    def _summary_stats(self, train_loop_vars) -> AttrDict:
+        """Summaries of the current minibatch, mostly as device tensors."""
         var = train_loop_vars
 
         self.last_summary_time = time.time()
@@ -872,9 +269,7 @@ class PPOLearner(Configurable):
         stats.valids_fraction = var.mb.valids.float().mean()
         stats.same_policy_fraction = (var.mb.policy_id == self.policy_id).float().mean()
 
-        grad_norm = (
-            sum(p.grad.data.norm(2).item() ** 2 for p in self.actor_critic.parameters() if p.grad is not None) ** 0.5
-        )
+        grad_norm = global_grad_norm(self.actor_critic.parameters())
         stats.grad_norm = grad_norm
         stats.loss = var.loss
         stats.value = var.values.mean()
@@ -923,162 +318,12 @@ class PPOLearner(Configurable):
             stats.num_sgd_steps = var.num_sgd_steps
 
         # this caused numerical issues on some versions of PyTorch with second moment reaching infinity
-        adam_max_second_moment = 0.0
-        for key, tensor_state in self.optimizer.state.items():
-            if "exp_avg_sq" in tensor_state:
-                adam_max_second_moment = max(tensor_state["exp_avg_sq"].max().item(), adam_max_second_moment)
-        stats.adam_max_second_moment = adam_max_second_moment
+        optimizer = next(iter(self._named_optimizers().values()))
+        stats.adam_max_second_moment = adam_max_second_moment(optimizer)
 
         version_diff = (var.curr_policy_version - var.mb.policy_version)[var.mb.policy_id == self.policy_id]
         stats.version_diff_avg = version_diff.mean()
         stats.version_diff_min = version_diff.min()
         stats.version_diff_max = version_diff.max()
 
-        for key, value in stats.items():
-            stats[key] = to_scalar(value)
-
         return stats
-
-    def _prepare_and_normalize_obs(self, obs: TensorDict) -> TensorDict:
-        og_shape = dict()
-
-        # assuming obs is a flat dict, collapse time and envs dimensions into a single batch dimension
-        for key, x in obs.items():
-            og_shape[key] = x.shape
-            obs[key] = x.view((x.shape[0] * x.shape[1],) + x.shape[2:])
-
-        # hold the lock while we alter the state of the normalizer since they can be used in other processes too
-        with self.param_server.policy_lock:
-            normalized_obs = prepare_and_normalize_obs(self.actor_critic, obs)
-
-        # restore original shape
-        for key, x in normalized_obs.items():
-            normalized_obs[key] = x.view(og_shape[key])
-
-        return normalized_obs
-
-    def _prepare_batch(self, batch: TensorDict) -> Tuple[TensorDict, int, int]:
-        with torch.no_grad():
-            # create a shallow copy so we can modify the dictionary
-            # we still reference the same buffers though
-            buff = shallow_recursive_copy(batch)
-
-            # ignore experience from other agents (i.e. on episode boundary) and from inactive agents
-            valids: Tensor = buff["policy_id"] == self.policy_id
-            # ignore experience that was older than the threshold even before training started
-            curr_policy_version: int = self.train_step
-            buff["valids"][:, :-1] = valids & (curr_policy_version - buff["policy_version"] < self.cfg.max_policy_lag)
-            # for last T+1 step, we want to use the validity of the previous step
-            buff["valids"][:, -1] = buff["valids"][:, -2]
-
-            # ensure we're in train mode so that normalization statistics are updated
-            if not self.actor_critic.training:
-                self.actor_critic.train()
-
-            buff["normalized_obs"] = self._prepare_and_normalize_obs(buff["obs"])
-            del buff["obs"]  # don't need non-normalized obs anymore
-
-            # calculate estimated value for the next step (T+1)
-            normalized_last_obs = buff["normalized_obs"][:, -1]
-            next_values = self.actor_critic(normalized_last_obs, buff["rnn_states"][:, -1], values_only=True)["values"]
-            buff["values"][:, -1] = next_values
-
-            if self.cfg.normalize_returns:
-                # Since our value targets are normalized, the values will also have normalized statistics.
-                # We need to denormalize them before using them for GAE caculation and value bootstrapping.
-                # rl_games PPO uses a similar approach, see:
-                # https://github.com/Denys88/rl_games/blob/7b5f9500ee65ae0832a7d8613b019c333ecd932c/rl_games/algos_torch/models.py#L51
-                denormalized_values = buff["values"].clone()  # need to clone since normalizer is in-place
-                self.actor_critic.returns_normalizer(denormalized_values, denormalize=True)
-            else:
-                # values are not normalized in this case, so we can use them as is
-                denormalized_values = buff["values"]
-
-            if self.cfg.value_bootstrap:
-                # Value bootstrapping is a technique that reduces the surprise for the critic in case
-                # we're ending the episode by timeout. Intuitively, in this case the cumulative return for the last step
-                # should not be zero, but rather what the critic expects. This improves learning in many envs
-                # because otherwise the critic cannot predict the abrupt change in rewards in a timed-out episode.
-                # What we really want here is v(t+1) which we don't have because we don't have obs(t+1) (since
-                # the episode ended). Using v(t) is an approximation that requires that rew(t) can be generally ignored.
-
-                # Multiply by both time_out and done flags to make sure we count only timeouts in terminal states.
-                # There was a bug in older versions of isaacgym where timeouts were reported for non-terminal states.
-                buff["rewards"].add_(self.cfg.gamma * denormalized_values[:, :-1] * buff["time_outs"] * buff["dones"])
-
-            if not self.cfg.with_vtrace:
-                # calculate advantage estimate (in case of V-trace it is done separately for each minibatch)
-                buff["advantages"] = gae_advantages(
-                    buff["rewards"],
-                    buff["dones"],
-                    denormalized_values,
-                    buff["valids"],
-                    self.cfg.gamma,
-                    self.cfg.gae_lambda,
-                )
-                # here returns are not normalized yet, so we should use denormalized values
-                buff["returns"] = buff["advantages"] + buff["valids"][:, :-1] * denormalized_values[:, :-1]
-
-            # remove next step obs, rnn_states, and values from the batch, we don't need them anymore
-            for key in ["normalized_obs", "rnn_states", "values", "valids"]:
-                buff[key] = buff[key][:, :-1]
-
-            dataset_size = buff["actions"].shape[0] * buff["actions"].shape[1]
-            for d, k, v in iterate_recursively(buff):
-                # collapse first two dimensions (batch and time) into a single dimension
-                d[k] = v.reshape((dataset_size,) + tuple(v.shape[2:]))
-
-            buff["dones_cpu"] = buff["dones"].to("cpu", copy=True, dtype=torch.float, non_blocking=True)
-            buff["rewards_cpu"] = buff["rewards"].to("cpu", copy=True, dtype=torch.float, non_blocking=True)
-
-            # return normalization parameters are only used on the learner, no need to lock the mutex
-            if self.cfg.normalize_returns:
-                self.actor_critic.returns_normalizer(buff["returns"])  # in-place
-
-            num_invalids = dataset_size - buff["valids"].sum().item()
-            if num_invalids > 0:
-                invalid_fraction = num_invalids / dataset_size
-                if invalid_fraction > 0.5:
-                    log.warning(f"{self.policy_id=} batch has {invalid_fraction:.2%} of invalid samples")
-
-                # invalid action values can cause problems when we calculate logprobs
-                # here we set them to 0 just to be safe
-                invalid_indices = (buff["valids"] == 0).nonzero().squeeze()
-                buff["actions"][invalid_indices] = 0
-                # likewise, some invalid values of log_prob_actions can cause NaNs or infs
-                buff["log_prob_actions"][invalid_indices] = -1  # -1 seems like a safe value
-
-            return buff, dataset_size, num_invalids
-
-    def train(self, batch: TensorDict) -> Optional[Dict]:
-        with self.timing.add_time("misc"):
-            self._maybe_update_cfg()
-            self._maybe_load_policy()
-
-        with self.timing.add_time("prepare_batch"):
-            buff, experience_size, num_invalids = self._prepare_batch(batch)
-
-        if num_invalids >= experience_size:
-            if self.cfg.with_pbt:
-                log.warning("No valid samples in the batch, with PBT this must mean we just replaced weights")
-            else:
-                log.error(f"Learner {self.policy_id=} received an entire batch of invalid data, skipping...")
-            return None
-        else:
-            with self.timing.add_time("train"):
-                train_stats = self._train(buff, self.cfg.batch_size, experience_size, num_invalids)
-
-            # multiply the number of samples by frameskip so that FPS metrics reflect the number
-            # of environment steps actually simulated
-            if self.cfg.summaries_use_frameskip:
-                self.env_steps += experience_size * self.env_info.frameskip
-            else:
-                self.env_steps += experience_size
-
-            stats = {LEARNER_ENV_STEPS: self.env_steps, POLICY_ID_KEY: self.policy_id}
-            if train_stats is not None:
-                if train_stats is not None:
-                    stats[TRAIN_STATS] = train_stats
-                stats[STATS_KEY] = memory_stats("learner", self.device)
-
-            return stats
@@ -1,11 +1,21 @@
-from typing import Tuple
+from __future__ import annotations
+
+from typing import Dict, List, NamedTuple, Tuple
 
 import torch
+from torch import Tensor
 
 # noinspection PyPep8Naming
 from torch.nn.utils.rnn import PackedSequence, invert_permutation
 
-from sample_factory.utils.utils import log
+
+class PackInfo(NamedTuple):
+    rollout_starts: Tensor
+    is_new_episode: Tensor
+    select_inds: Tensor
+    batch_sizes: Tensor
+    sorted_indices: Tensor
+    inverted_select_inds: Tensor
 
 
 def _build_pack_info_from_dones(
@@ -25,25 +35,21 @@ def _build_pack_info_from_dones(
     This method will generate the new index ordering such that you can
     construct the data for a PackedSequence from a (N*T, ...) tensor
     via x.index_select(0, select_inds)
+
+    Everything is computed with tensor ops, without loops over the sequence lengths. The only values that have
+    to be copied to the CPU are the number of sequences (implicitly, by nonzero()) and the sequence lengths for
+    batch_sizes, which PackedSequence requires to be a CPU tensor.
     """
 
     num_samples = len(dones)
+    device = dones.device
 
     rollout_boundaries = dones.clone().detach()
     rollout_boundaries[T - 1 :: T] = 1  # end of each rollout is the boundary
     rollout_boundaries = rollout_boundaries.nonzero(as_tuple=False).squeeze(dim=1) + 1
+    num_sequences = len(rollout_boundaries)
 
-    first_len = rollout_boundaries[0].unsqueeze(0)
-
-    if len(rollout_boundaries) <= 1:
-        log.debug(
-            "Only one rollout boundary. This can happen if batch size is 1, probably not during the real training."
-        )
-        rollout_lengths = first_len
-    else:
-        rollout_lengths = rollout_boundaries[1:] - rollout_boundaries[:-1]
-        rollout_lengths = torch.cat([first_len, rollout_lengths])
-
+    rollout_lengths = torch.diff(rollout_boundaries, prepend=rollout_boundaries.new_zeros(1))
     rollout_starts_orig = rollout_boundaries - rollout_lengths
 
     # done=True for the last step in the episode, so done flags rolled 1 step to the right will indicate
@@ -56,10 +62,26 @@ def _build_pack_info_from_dones(
     is_new_episode[:, 0] = 0
     is_new_episode = is_new_episode.view((-1,))
 
+    # the same sort as the sequential version used to do, so that the sequences of the same length end up in the same
+    # order in the packed batch (the RNN results depend on it up to float rounding)
     lengths, sorted_indices = torch.sort(rollout_lengths, descending=True)
-    # We will want these on the CPU for torch.unique_consecutive,
-    # so move now.
-    cpu_lengths = lengths.to(device="cpu", non_blocking=True)
+
+    # batch_sizes[t] is the number of sequences longer than t, batch_sizes is *always* on the CPU
+    cpu_lengths = lengths.cpu()
+    max_length = int(cpu_lengths[0])
+    num_shorter = torch.bincount(cpu_lengths, minlength=max_length + 1).cumsum(0)
+    batch_sizes = num_sequences - num_shorter[:max_length]
+
+    # for a set of sequences [1, 2, 3], [4, 5], [6, 7], [8]
+    # select_inds will be 1,4,6,8,2,5,7,3
+    # (all first steps in all trajectories, then all second steps, etc.)
+    # i.e. samples ordered by their step within the sequence, then by the rank of the sequence in sorted order
+    sequence_ids = torch.repeat_interleave(
+        torch.arange(num_sequences, device=device), rollout_lengths, output_size=num_samples
+    )
+    steps = torch.arange(num_samples, device=device) - rollout_starts_orig[sequence_ids]
+    sequence_ranks = invert_permutation(sorted_indices)[sequence_ids]
+    select_inds = torch.argsort(steps * num_sequences + sequence_ranks)
 
     # We need to keep the original unpermuted rollout_starts, because the permutation is later applied
     # internally in the RNN implementation.
@@ -67,48 +89,78 @@ def _build_pack_info_from_dones(
     #       Each batch of the hidden state should match the input sequence that
     #       the user believes he/she is passing in.
     #       hx = self.permute_hidden(hx, sorted_indices)
-    rollout_starts_sorted = rollout_starts_orig.index_select(0, sorted_indices)
+    return rollout_starts_orig, is_new_episode, select_inds, batch_sizes, sorted_indices
 
-    select_inds = torch.empty(num_samples, device=dones.device, dtype=torch.int64)
 
-    max_length = int(cpu_lengths[0].item())
-    # batch_sizes is *always* on the CPU
-    batch_sizes = torch.empty((max_length,), device="cpu", dtype=torch.int64)
+def _build_pack_info(dones: Tensor, T: int) -> PackInfo:
+    rollout_starts, is_new_episode, select_inds, batch_sizes, sorted_indices = _build_pack_info_from_dones(dones, T)
+    return PackInfo(
+        rollout_starts, is_new_episode, select_inds, batch_sizes, sorted_indices, invert_permutation(select_inds)
+    )
 
-    offset = 0
-    prev_len = 0
-    num_valid_for_length = lengths.size(0)
 
-    unique_lengths = torch.unique_consecutive(cpu_lengths)
-    # Iterate over all unique lengths in reverse as they sorted
-    # in decreasing order
-    for i in range(len(unique_lengths) - 1, -1, -1):
-        valids = lengths[0:num_valid_for_length] > prev_len
-        num_valid_for_length = int(valids.float().sum().item())
+class _PackInfoCache:
+    """
+    Pack info of the most recently seen dones. The learners build the RNN inputs of the same minibatch several
+    times: for every tower of models with separate weights and for every candidate of the TRPO/CPO line search.
+    The dones are compared by value, callers usually create a new tensor of done_or_invalid flags every time.
+    """
 
-        next_len = int(unique_lengths[i])
+    def __init__(self, max_entries: int = 4):
+        self.max_entries = max_entries
+        self.entries: List[Tuple[Tensor, int, Dict[torch.device, PackInfo]]] = []
 
-        batch_sizes[prev_len:next_len] = num_valid_for_length
+    def get(self, dones: Tensor, T: int, device: torch.device) -> PackInfo:
+        dones = dones.detach()
+        for cached_dones, cached_T, per_device in self.entries:
+            if (
+                cached_T == T
+                and cached_dones.shape == dones.shape
+                and cached_dones.dtype == dones.dtype
+                and torch.equal(cached_dones, dones)
+            ):
+                break
+        else:
+            per_device = dict()
+            self.entries.insert(0, (dones.clone(), T, per_device))
+            del self.entries[self.max_entries :]
 
-        new_inds = (
-            rollout_starts_sorted[0:num_valid_for_length].view(1, num_valid_for_length)
-            + torch.arange(prev_len, next_len, device=rollout_starts_sorted.device).view(next_len - prev_len, 1)
-        ).view(-1)
+        pack_info = per_device.get(device)
+        if pack_info is None:
+            # built once, then only copied to other devices
+            pack_info = next(iter(per_device.values()), None) or _build_pack_info(dones, T)
+            # batch_sizes are always on the CPU
+            pack_info = PackInfo(*(t if t is pack_info.batch_sizes else t.to(device) for t in pack_info))
+            per_device[device] = pack_info
 
-        # for a set of sequences [1, 2, 3], [4, 5], [6, 7], [8]
-        # these indices will be 1,4,6,8,2,5,7,3
-        # (all first steps in all trajectories, then all second steps, etc.)
-        select_inds[offset : offset + new_inds.numel()] = new_inds
+        return pack_info
 
-        offset += new_inds.numel()
 
-        prev_len = next_len
+_pack_info_cache = _PackInfoCache()
 
-    # Make sure we have an index for all elements
-    assert offset == num_samples
-    assert is_new_episode.shape[0] == num_samples
 
-    return rollout_starts_orig, is_new_episode, select_inds, batch_sizes, sorted_indices
+def get_pack_info(dones_cpu: Tensor, T: int, device: torch.device) -> PackInfo:
+    """Pack info for the given dones (see _build_pack_info_from_dones()) with the index tensors on the device."""
+    return _pack_info_cache.get(dones_cpu, T, device)
+
+
+def pack_sequence(x: Tensor, pack_info: PackInfo) -> PackedSequence:
+    return PackedSequence(x.index_select(0, pack_info.select_inds), pack_info.batch_sizes, pack_info.sorted_indices)
+
+
+def sequence_start_rnn_states(rnn_states: Tensor, pack_info: PackInfo) -> Tensor:
+    """
+    Initial RNN states of the packed sequences.
+    We zero-out rnn states for timesteps at the beginning of the episode.
+    rollout_starts are indices of all starts of sequences
+    (which can be due to episode boundary or just boundary of a rollout)
+    (1 - is_new_episode.view(-1, 1)).index_select(0, rollout_starts) gives us a zero for every beginning of
+    the sequence that is actually also a start of a new episode, and by multiplying this RNN state by zero
+    we ensure no information transfer across episode boundaries.
+    """
+    rollout_starts = pack_info.rollout_starts
+    is_same_episode = (1 - pack_info.is_new_episode.view(-1, 1)).index_select(0, rollout_starts)
+    return rnn_states.index_select(0, rollout_starts) * is_same_episode
 
 
 def build_rnn_inputs(x, dones_cpu, rnn_states, T: int):
@@ -127,17 +179,8 @@ def build_rnn_inputs(x, dones_cpu, rnn_states, T: int):
         rnn_states are the corresponding rnn state, zeroed on the episode boundary
         inverted_select_inds can be passed to build_core_out_from_seq so the RNN output can be retrieved
     """
-    rollout_starts, is_new_episode, select_inds, batch_sizes, sorted_indices = _build_pack_info_from_dones(dones_cpu, T)
-    inverted_select_inds = invert_permutation(select_inds)
-
-    def device(t):
-        return t.to(device=x[0].device if isinstance(x, tuple) else x.device)
-
-    select_inds = device(select_inds)
-    inverted_select_inds = device(inverted_select_inds)
-    sorted_indices = device(sorted_indices)
-    rollout_starts = device(rollout_starts)
-    is_new_episode = device(is_new_episode)
+    device = x[0].device if isinstance(x, tuple) else x.device
+    pack_info = get_pack_info(dones_cpu, T, device)
 
     if isinstance(x, tuple):  # Split head setting
         # Split rnn_states into actor and critic components
@@ -146,34 +189,20 @@ def build_rnn_inputs(x, dones_cpu, rnn_states, T: int):
         critic_rnn_states = rnn_states[:, rnn_state_dim:]
 
         # Create PackedSequences for both actor and critic outputs
-        actor_seq = PackedSequence(x[0].index_select(0, select_inds), batch_sizes, sorted_indices)
-        critic_seq = PackedSequence(x[1].index_select(0, select_inds), batch_sizes, sorted_indices)
+        actor_seq = pack_sequence(x[0], pack_info)
+        critic_seq = pack_sequence(x[1], pack_info)
 
         # Zero-out RNN states for episode boundaries
-        actor_rnn_states = actor_rnn_states.index_select(0, rollout_starts)
-        critic_rnn_states = critic_rnn_states.index_select(0, rollout_starts)
-        is_same_episode = (1 - is_new_episode.view(-1, 1)).index_select(0, rollout_starts)
-
-        actor_rnn_states = actor_rnn_states * is_same_episode
-        critic_rnn_states = critic_rnn_states * is_same_episode
+        actor_rnn_states = sequence_start_rnn_states(actor_rnn_states, pack_info)
+        critic_rnn_states = sequence_start_rnn_states(critic_rnn_states, pack_info)
 
-        return actor_seq, critic_seq, (actor_rnn_states, critic_rnn_states), inverted_select_inds
+        return actor_seq, critic_seq, (actor_rnn_states, critic_rnn_states), pack_info.inverted_select_inds
 
     else:  # Shared backbone setting
 
-        x_seq = PackedSequence(x.index_select(0, select_inds), batch_sizes, sorted_indices)
-
-        # We zero-out rnn states for timesteps at the beginning of the episode.
-        # rollout_starts are indices of all starts of sequences
-        # (which can be due to episode boundary or just boundary of a rollout)
-        # (1 - is_new_episode.view(-1, 1)).index_select(0, rollout_starts) gives us a zero for every beginning of
-        # the sequence that is actually also a start of a new episode, and by multiplying this RNN state by zero
-        # we ensure no information transfer across episode boundaries.
-        rnn_states = rnn_states.index_select(0, rollout_starts)
-        is_same_episode = (1 - is_new_episode.view(-1, 1)).index_select(0, rollout_starts)
-        rnn_states = rnn_states * is_same_episode
-
-        return x_seq, rnn_states, inverted_select_inds
+        x_seq = pack_sequence(x, pack_info)
+        rnn_states = sequence_start_rnn_states(rnn_states, pack_info)
+        return x_seq, rnn_states, pack_info.inverted_select_inds
 
 
 def build_core_out_from_seq(x_seq: PackedSequence, inverted_select_inds):
@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+from typing import Optional
+
 import torch
 from torch import Tensor
 
@@ -7,7 +9,7 @@ from sample_factory.algo.learning.pid_lagrangian import PIDLagrangian
 from sample_factory.algo.learning.trpo_lag_learner import TRPOLagLearner
 from sample_factory.algo.utils.env_info import EnvInfo
 from sample_factory.algo.utils.model_sharing import ParameterServer
-from sample_factory.utils.typing import Config, PolicyID
+from sample_factory.utils.typing import Config, InitModelData, PolicyID
 
 
 class TRPOPidLearner(TRPOLagLearner):
@@ -20,13 +22,20 @@ class TRPOPidLearner(TRPOLagLearner):
             param_server: ParameterServer,
     ):
         TRPOLagLearner.__init__(self, cfg, env_info, policy_versions_tensor, policy_id, param_server)
+        self.pid_lagrangian: Optional[PIDLagrangian] = None
+
+    def init(self) -> InitModelData:
+        init_res = super().init()
+        # the controller state lives on the learner device, next to the costs
+        cfg = self.cfg
         self.pid_lagrangian = PIDLagrangian(pid_kp=cfg.pid_kp, pid_ki=cfg.pid_ki, pid_kd=cfg.pid_kd,
                                             pid_d_delay=cfg.pid_d_delay,
                                             pid_delta_p_ema_alpha=cfg.pid_delta_p_ema_alpha,
                                             pid_delta_d_ema_alpha=cfg.pid_delta_d_ema_alpha, sum_norm=cfg.sum_norm,
                                             diff_norm=cfg.diff_norm, penalty_max=cfg.penalty_max,
                                             lagrangian_multiplier_init=cfg.lagrangian_multiplier_init,
-                                            cost_limit=self.safety_bound)
+                                            cost_limit=self.safety_bound, device=self.device)
+        return init_res
 
     def _update_lagrange(self, mean_cost):
         return self.pid_lagrangian.pid_update(mean_cost)
@@ -48,5 +57,6 @@ class TRPOPidLearner(TRPOLagLearner):
         Returns:
             The ``advantage`` combined with ``reward_advantage`` and ``cost_advantage``.
         """
+        # with several constraint channels, the penalties of all of them
         penalty = self.pid_lagrangian.lagrangian_multiplier
-        return (adv_r - penalty * adv_c) / (1 + penalty)
+        return (adv_r - self._sum_cost_channels(penalty * adv_c)) / (1 + self._sum_cost_channels(penalty))
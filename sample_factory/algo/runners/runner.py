@@ -32,6 +32,7 @@ from sample_factory.algo.utils.heartbeat import HeartbeatStoppableEventLoopObjec
 from sample_factory.algo.utils.misc import (
     EPISODIC,
     LEARNER_ENV_STEPS,
+    POLICY_ID_KEY,
     SAMPLES_COLLECTED,
     STATS_KEY,
     TIMING_STATS,
@@ -39,6 +40,7 @@ from sample_factory.algo.utils.misc import (
     ExperimentStatus,
 )
 from sample_factory.algo.utils.shared_buffers import BufferMgr
+from sample_factory.algo.utils.task_switch import TaskSwitchScheduler
 from sample_factory.cfg.arguments import cfg_dict, cfg_str, preprocess_cfg
 from sample_factory.cfg.configurable import Configurable
 from sample_factory.utils.attr_dict import AttrDict
@@ -120,6 +122,7 @@ class Runner(EventLoopObject, Configurable):
 
         # for continual learning setting, we keep track of which env we are in
         self.current_env_id = 0
+        self.task_switch = TaskSwitchScheduler(self.cfg.task_switch_waves, self.cfg.task_switch_wave_interval_sec)
 
         # samples_collected counts the total number of observations processed by the algorithm
         self.samples_collected = [0 for _ in range(self.cfg.num_policies)]
@@ -189,10 +192,13 @@ class Runner(EventLoopObject, Configurable):
             t.timeout.connect(cb)
             self.timers.append(t)
 
+        periodic(1.0, self._drain_episodic_stats)
         periodic(self.report_interval_sec, self._update_stats_and_print_report)
         periodic(self.summaries_interval_sec, self._report_experiment_summaries)
 
         periodic(self.update_training_info_every_sec, self._propagate_training_info)
+        if len(self.cfg.envs) > 1:
+            periodic(1.0, self._update_task_switch)
 
         if self.cfg.save_models:
             periodic(self.cfg.save_every_sec, self._save_policy)
@@ -294,20 +300,42 @@ class Runner(EventLoopObject, Configurable):
         s = msg[EPISODIC]
         for _, key, value in iterate_recursively(s):
             if key not in runner.policy_avg_stats:
-                max_len = runner.cfg.heatmap_avg if key == 'heatmap' else runner.cfg.stats_avg
                 runner.policy_avg_stats[key] = [
-                    deque(maxlen=max_len) for _ in range(runner.cfg.num_policies)
+                    deque(maxlen=runner.cfg.stats_avg) for _ in range(runner.cfg.num_policies)
                 ]
 
-            if isinstance(value, np.ndarray) and value.ndim > 0 and key != 'heatmap':
-                if len(value) > runner.policy_avg_stats[key][policy_id].maxlen:
-                    # increase maxlen to make sure we never ignore any stats from the environments
-                    runner.policy_avg_stats[key][policy_id] = deque(maxlen=len(value))
-
+            if isinstance(value, np.ndarray) and value.ndim > 0:
+                # arrays of many episodes (batched envs, drained shared stats) keep the newest stats_avg of them, the
+                # averaging window stays the same
                 runner.policy_avg_stats[key][policy_id].extend(value)
             else:
                 runner.policy_avg_stats[key][policy_id].append(value)
 
+    def _drain_episodic_stats(self) -> None:
+        """
+        Collect the episodic stats written by the rollout workers to shared memory and pass them to the EPISODIC
+        handlers, one message per policy with an array of per-episode values for every key (like the reports of
+        batched envs).
+        """
+        episodic_stats = self.buffer_mgr.episodic_stats if self.buffer_mgr is not None else None
+        if episodic_stats is None:
+            return
+
+        records, policy_ids = episodic_stats.drain()
+        if len(records) == 0:
+            return
+
+        for policy_id in np.unique(policy_ids).tolist():
+            policy_records = records[policy_ids == policy_id]
+            reported = ~np.isnan(policy_records)
+            stats = dict()
+            for column in np.flatnonzero(reported.any(axis=0)):
+                stats[episodic_stats.keys[column]] = policy_records[reported[:, column], column]
+
+            msg = {EPISODIC: stats, POLICY_ID_KEY: policy_id}
+            for handler in self.policy_msg_handlers.get(EPISODIC, ()):
+                handler(self, msg, policy_id)
+
     @staticmethod
     def _train_stats_handler(runner: Runner, msg: Dict, policy_id: PolicyID) -> None:
         """We write the train summaries to disk right away instead of accumulating them."""
@@ -539,7 +567,10 @@ class Runner(EventLoopObject, Configurable):
                         writer.add_scalar(f"stats/{key}", np.mean(value), env_steps)
 
                 for key, value in self.stats.items():
-                    writer.add_scalar(f"stats/{key}", value, env_steps)
+                    if isinstance(value, np.ndarray):
+                        writer.add_histogram(f"stats/{key}", value, env_steps)
+                    else:
+                        writer.add_scalar(f"stats/{key}", value, env_steps)
 
             env_index = self.current_env_id % len(self.cfg.envs)
             writer.add_scalar("task_id", env_index, env_steps)
@@ -547,29 +578,28 @@ class Runner(EventLoopObject, Configurable):
             if not math.isnan(sample_throughput[policy_id]):
                 writer.add_scalar("perf/_sample_throughput", sample_throughput[policy_id], env_steps)
 
-            if self.cfg.with_wandb and 'heatmap' in self.policy_avg_stats and self.cfg.log_heatmap:
-                heatmap = np.mean(self.policy_avg_stats['heatmap'], axis=1).squeeze()
-                if self.cumulative_heatmap is None:
-                    # Initialize the cumulative heatmap to the correct shape
-                    self.cumulative_heatmap = np.zeros_like(heatmap)
-
-                # Accumulate the heatmap data
-                self.cumulative_heatmap += heatmap
+            heatmaps = self.buffer_mgr.heatmaps
+            if self.cfg.with_wandb and heatmaps is not None and self.cfg.log_heatmap:
                 if env_steps - self.last_heatmap_log >= self.cfg.heatmap_log_interval:
-                    if self.cfg.log_overlay:
-                        self.log_overlay(heatmap, env_steps, 'traversal/overlay')
-                    if self.cfg.log_heatmap:
-                        self.log_heatmap(self.cumulative_heatmap, env_steps, "traversal/cumulative")
-                        self.log_heatmap(heatmap, env_steps, "traversal/window")
-                    self.last_heatmap_log = env_steps
+                    # average visitation over all episodes finished since the last time we logged the heatmap
+                    heatmap = heatmaps.merge(policy_id)
+                    if heatmap is not None:
+                        if self.cumulative_heatmap is None:
+                            self.cumulative_heatmap = np.zeros_like(heatmap)
+                        self.cumulative_heatmap += heatmap
+
+                        if self.cfg.log_overlay:
+                            self.log_overlay(heatmap, env_steps, 'traversal/overlay')
+                        if self.cfg.log_heatmap:
+                            self.log_heatmap(self.cumulative_heatmap, env_steps, "traversal/cumulative")
+                            self.log_heatmap(heatmap, env_steps, "traversal/window")
+                        self.last_heatmap_log = env_steps
 
                 if env_steps - self.last_gif_log >= self.cfg.gif_log_interval:
                     self.last_gif_log = env_steps
                     self.create_and_upload_gif("traversal/evolution")
 
             for key, stat in self.policy_avg_stats.items():
-                if key == 'heatmap':
-                    continue  # Skip if it's histogram, already logged
                 if len(stat[policy_id]) >= stat[policy_id].maxlen or (
                         len(stat[policy_id]) > 10 and self.total_train_seconds > 300
                 ):
@@ -666,7 +696,7 @@ class Runner(EventLoopObject, Configurable):
                 # "approx" here because it will lag behind a little bit due to the async nature of the system
                 approx_total_training_steps=self.env_steps.get(policy_id, 0),
                 reward_shaping=self.reward_shaping[policy_id],
-                current_env_id=self.current_env_id % len(self.cfg.envs),
+                **self.task_switch.training_info(),
                 # add more stats if needed (commented by default for efficiency)
                 # stats=self.stats,
                 # avg_stats=self.avg_stats,
@@ -717,6 +747,10 @@ class Runner(EventLoopObject, Configurable):
         self._register_msg_handler(self.policy_msg_handlers, key, func)
 
     def register_episodic_stats_handler(self, func: PolicyMsgHandler):
+        """
+        Stats of a single episode are scalars, stats drained from shared memory (--shared_episodic_stats) and
+        reports of batched envs have arrays with a value per episode.
+        """
         self.policy_msg_handlers[EPISODIC].append(func)
 
     def register_observer(self, observer: AlgoObserver) -> None:
@@ -794,7 +828,8 @@ class Runner(EventLoopObject, Configurable):
         self._save_cfg()
         save_git_diff(experiment_dir(self.cfg))
 
-        self.buffer_mgr = BufferMgr(self.cfg, self.env_info)
+        shared_episodic_stats = "shared_episodic_stats" in self.cfg and self.cfg.shared_episodic_stats
+        self.buffer_mgr = BufferMgr(self.cfg, self.env_info, shared_episodic_stats=shared_episodic_stats)
 
         self._observers_call(AlgoObserver.on_init, self)
 
@@ -942,8 +977,37 @@ class Runner(EventLoopObject, Configurable):
 
     def _go_to_next_env(self):
         self.current_env_id = (self.current_env_id + 1) % len(self.cfg.envs)
+
+        fps_stats, _ = self._get_perf_stats()
+        env_steps = self.total_env_steps_since_resume or 0
+        self.task_switch.start_switch(self.current_env_id % len(self.cfg.envs), time.time(), env_steps, fps_stats[0])
         self._propagate_training_info()  # emit the new env id to the sampler & rollout workers right away
 
+    def _update_task_switch(self):
+        """Release the next wave of an ongoing task switch and report the sampling throughput of the previous one."""
+        if not self.task_switch.in_progress or self.total_env_steps_since_resume is None:
+            return
+
+        measured_waves = self.task_switch.update(time.time(), self.total_env_steps_since_resume)
+        default_policy = 0
+        for wave, wave_fps, fps_dip in measured_waves:
+            log.info(
+                "Task switch to %d, wave %d/%d: %.1f FPS (dip %.1f%%)",
+                self.task_switch.task,
+                wave + 1,
+                self.task_switch.num_waves,
+                wave_fps,
+                fps_dip * 100,
+            )
+            env_steps = self.env_steps.get(default_policy, 0)
+            self.writers[default_policy].add_scalar("perf/task_switch_wave_fps", wave_fps, env_steps)
+            if not math.isnan(fps_dip):
+                self.writers[default_policy].add_scalar("perf/task_switch_fps_dip", fps_dip, env_steps)
+
+        if measured_waves and self.task_switch.in_progress:
+            # next wave was released
+            self._propagate_training_info()
+
     def _should_end_training(self):
         end = len(self.env_steps) > 0 and all(s > self.cfg.train_for_env_steps for s in self.env_steps.values())
         end |= self.total_train_seconds > self.cfg.train_for_seconds
@@ -1003,6 +1067,9 @@ class Runner(EventLoopObject, Configurable):
             self.all_components_stopped.emit()
 
     def _on_everything_stopped(self):
+        # episodes finished since the last periodic drain
+        self._drain_episodic_stats()
+
         # sort profiles by name
         self.component_profiles = sorted(list(self.component_profiles.items()), key=lambda x: x[0])
         for component, profile in self.component_profiles:
@@ -10,11 +10,12 @@ import torch
 from torch import Tensor
 
 from sample_factory.algo.sampling.sampling_utils import VectorEnvRunner, record_episode_statistics_wrapper_stats
-from sample_factory.algo.utils.env_info import EnvInfo, check_env_info
+from sample_factory.algo.utils.env_info import EnvInfo, check_env_info, cost_stat_keys
 from sample_factory.algo.utils.make_env import BatchedVecEnv, SequentialVectorizeWrapper, make_env_func_batched
 from sample_factory.algo.utils.misc import EPISODIC, POLICY_ID_KEY
 from sample_factory.algo.utils.tensor_dict import TensorDict
 from sample_factory.algo.utils.torch_utils import synchronize
+from sample_factory.envs.create_env import create_batched_env
 from sample_factory.envs.env_utils import (
     TrainingInfoInterface,
     find_training_info_interface,
@@ -157,10 +158,18 @@ class BatchedVectorEnvRunner(VectorEnvRunner):
 
         self.curr_episode_reward = self.curr_episode_len = None
 
+        # envs with several constraint channels report a vector of costs per step, accumulated here per channel
+        self.cost_stat_keys = cost_stat_keys(env_info)
+        self.curr_episode_costs = None
+
         self.training_info: List[Optional[Dict]] = training_info
 
         self.min_raw_rewards = self.max_raw_rewards = None
 
+        # agents of the vector env are consecutive actors in the shared episodic stats
+        self.episodic_stats = buffer_mgr.episodic_stats
+        self.first_actor_idx = (worker_idx * cfg.num_envs_per_worker + split_idx * num_envs) * env_info.num_agents
+
         self.device: Optional[torch.device] = None
 
     def init(self, timing):
@@ -168,26 +177,38 @@ class BatchedVectorEnvRunner(VectorEnvRunner):
         Actually instantiate the env instances.
         Also creates ActorState objects that hold the state of individual actors in (potentially) multi-agent envs.
         """
-        envs: List[BatchedVecEnv] = []
+        env_configs: List[AttrDict] = []
         for env_i in range(self.num_envs):
             vector_idx = self.split_idx * self.num_envs + env_i
 
             # global env id within the entire system
             env_id = self.worker_idx * self.cfg.num_envs_per_worker + vector_idx
 
-            env_config = AttrDict(
-                worker_index=self.worker_idx,
-                vector_index=vector_idx,
-                env_id=env_id,
+            # observations are copied to the trajectory buffers before the next step, envs can reuse their arrays
+            env_configs.append(
+                AttrDict(worker_index=self.worker_idx, vector_index=vector_idx, env_id=env_id, reuse_observations=True)
             )
 
-            # log.info('Creating env %r... %d-%d-%d', env_config, self.worker_idx, self.split_idx, env_i)
-            # a vectorized environment - we assume that it always provides a dict of vectors of obs, rewards, etc.
-            env: BatchedVecEnv = make_env_func_batched(self.cfg, env_config)
-            check_env_info(env, self.env_info, self.cfg)
+        # some envs can simulate the whole vector natively, without stacking individual env instances
+        batched_env = create_batched_env(self.cfg.envs[0], self.cfg, env_configs) if len(self.cfg.envs) == 1 else None
 
-            env.seed(env_id)  # since Gym 0.26 seeding is done in reset(), we do it in BatchedVecEnv class
+        envs: List[BatchedVecEnv] = []
+        if batched_env is not None:
+            env = BatchedVecEnv(batched_env)
+            assert env.num_agents == self.num_envs * self.env_info.num_agents
+            assert env.observation_space == self.env_info.obs_space and env.action_space == self.env_info.action_space
+
+            env.seed(env_configs[0].env_id)  # env instances are seeded with consecutive env ids starting from here
             envs.append(env)
+        else:
+            for env_config in env_configs:
+                # log.info('Creating env %r... %d-%d-%d', env_config, self.worker_idx, self.split_idx, env_i)
+                # a vectorized environment - we assume that it always provides a dict of vectors of obs, rewards, etc.
+                env: BatchedVecEnv = make_env_func_batched(self.cfg, env_config)
+                check_env_info(env, self.env_info, self.cfg)
+
+                env.seed(env_config.env_id)  # since Gym 0.26 seeding is done in reset(), we do it in BatchedVecEnv class
+                envs.append(env)
 
         if len(envs) == 1:
             # assuming this is already a vectorized environment
@@ -212,6 +233,7 @@ class BatchedVectorEnvRunner(VectorEnvRunner):
 
         self.curr_episode_reward = torch.zeros(self.vec_env.num_agents)
         self.curr_episode_len = torch.zeros(self.vec_env.num_agents, dtype=torch.int32)
+        self.curr_episode_costs = torch.zeros(self.vec_env.num_agents, len(self.cost_stat_keys))
         self.min_raw_rewards = torch.empty_like(self.curr_episode_reward).fill_(np.inf)
         self.max_raw_rewards = torch.empty_like(self.curr_episode_reward).fill_(-np.inf)
 
@@ -231,6 +253,30 @@ class BatchedVectorEnvRunner(VectorEnvRunner):
         self.max_raw_rewards = torch.max(self.max_raw_rewards, rewards_orig_cpu)
         return rewards
 
+    def _record_costs(self, infos) -> None:
+        """Per-step costs used by the safe RL algorithms, envs that do not report any are treated as cost-free."""
+        costs = self.curr_step["costs"]
+        if self.cost_stat_keys:
+            # [num_agents, num_channels] costs of the multi-channel envs, also accumulated for the episodic stats
+            if isinstance(infos, dict):
+                channel_costs = infos.get("costs")
+                if channel_costs is None:
+                    costs.fill_(0.0)
+                else:
+                    costs.copy_(torch.as_tensor(channel_costs))
+            else:
+                no_costs = np.zeros(len(self.cost_stat_keys))
+                costs.copy_(torch.as_tensor(np.array([info.get("costs", no_costs) for info in infos])))
+            self.curr_episode_costs += costs.cpu()
+        elif isinstance(infos, dict):
+            cost = infos.get("cost")
+            if cost is None:
+                costs.fill_(0.0)
+            else:
+                costs.copy_(torch.as_tensor(cost))
+        else:
+            costs.copy_(torch.tensor([info.get("cost", 0.0) for info in infos]))
+
     def _process_env_step(self, rewards: Tensor, dones_orig: Tensor, infos):
         dones = dones_orig.cpu()
         num_dones = dones.sum().item()
@@ -250,12 +296,18 @@ class BatchedVectorEnvRunner(VectorEnvRunner):
             min_raw_reward=self.min_raw_rewards[finished],
             max_raw_reward=self.max_raw_rewards[finished],
         )
+        for channel, key in enumerate(self.cost_stat_keys):
+            stats[key] = self.curr_episode_costs[finished, channel]
 
         if isinstance(infos, dict):
             # vectorized reports
             for _, key, value, prefix in iterate_recursively_with_prefix(infos):
+                if not prefix and key in ("cost", "costs"):
+                    continue  # per-step costs, already recorded in the trajectories
+
                 key_str = key
-                if prefix:
+                # episode_extra_stats keep the same flat keys as the ones reported by non-batched envs
+                if prefix and prefix != ["episode_extra_stats"]:
                     key_str = f"{'/'.join(prefix)}/{key}"
 
                 if isinstance(value, Tensor):
@@ -296,10 +348,15 @@ class BatchedVectorEnvRunner(VectorEnvRunner):
                     value, numbers.Number
                 ), f"Expect stats[{key}] to be a scalar or numpy array, got {type(value)}"
 
-        reports.append({EPISODIC: stats, POLICY_ID_KEY: self.policy_id})
+        if self.episodic_stats is not None:
+            # only the stats that don't fit the shared memory schema are sent with the report
+            stats = self.episodic_stats.write(self.policy_id, self.first_actor_idx + finished.numpy(), stats)
+        if stats:
+            reports.append({EPISODIC: stats, POLICY_ID_KEY: self.policy_id})
 
         self.curr_episode_reward[finished] = 0
         self.curr_episode_len[finished] = 0
+        self.curr_episode_costs[finished] = 0
         self.min_raw_rewards[finished] = np.inf
         self.max_raw_rewards[finished] = -np.inf
 
@@ -347,6 +404,7 @@ class BatchedVectorEnvRunner(VectorEnvRunner):
                 time_outs=truncated,  # true only when done is also true, used for value bootstrapping
                 policy_id=self.policy_id_buffer,
             )
+            self._record_costs(infos)
 
             # reset next-step hidden states to zero if we encountered an episode boundary
             # not sure if this is the best practice, but this is what everybody seems to be doing
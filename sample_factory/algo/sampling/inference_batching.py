@@ -0,0 +1,189 @@
+"""
+How long the policy worker waits for more inference requests before it runs the forward pass on the requests it has.
+Waiting longer gives bigger batches, i.e. the fixed cost of a forward pass is amortized over more samples, but every
+rollout worker waiting for actions is blocked for longer.
+"""
+
+from __future__ import annotations
+
+import math
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from sample_factory.utils.typing import Config
+
+# no requests at all: return to the event loop once in a while so that it can process signals
+MAX_IDLE_WAIT_SEC = 0.025
+POLL_TIMEOUT_SEC = 0.005
+
+# number of recent requests for the p99 latency (measured on the policy worker)
+LATENCY_WINDOW = 1000
+
+
+class InferenceBatching:
+    """
+    Waits at most 25 ms for a fixed number of requests (min_num_requests), then continues with what we've got.
+    Records nothing, see AdaptiveInferenceBatching for the batch size and delay stats.
+    """
+
+    def __init__(self, min_num_requests: int):
+        self.target_requests: int = min_num_requests
+        self.window_sec: float = 0.025
+
+    def should_wait(self, num_requests: int, waiting_started: float, oldest_request: Optional[float]) -> bool:
+        return num_requests < self.target_requests and time.time() - waiting_started < self.window_sec
+
+    def poll_timeout(self, oldest_request: Optional[float]) -> float:
+        return POLL_TIMEOUT_SEC
+
+    def on_policy_step(
+        self, num_samples: int, received: np.ndarray, forward_started: float, forward_sec: float, finished: float
+    ) -> None:
+        """Called after the forward pass on the requests received at the given times."""
+        pass
+
+    def stats(self) -> Dict:
+        return dict()
+
+
+class AdaptiveInferenceBatching(InferenceBatching):
+    """
+    Tunes the wait window and the target number of requests online. The cost of a forward pass is modeled as
+    a + b * num_samples (fitted with exponentially weighted least squares). Waiting only pays off while the fixed
+    cost a is a large part of the forward pass, so the target is the batch size that amortizes it to
+    max_fixed_cost_fraction of the forward pass: n = a * (1 - f) / (f * b). With a model dominated by the
+    per-sample cost we do not wait at all, with a model dominated by the fixed cost (e.g. several towers of a
+    constrained model on CPU) we wait for bigger batches, which leaves more CPU time to the rollout workers.
+    We never wait longer than the latency budget left after the forward pass, given the rate at which samples arrive.
+    Rollout workers wait for the actions before they send the next request, so we also never wait for more requests
+    than we've ever received in a single batch: at that point every worker is already blocked on us.
+    The budget is scaled down multiplicatively when the measured p99 latency exceeds the target, and recovers
+    additively when it is well below. The window starts when the oldest pending request is received.
+
+    Latencies are measured on the policy worker, from receiving a request until its actions are sent back. The time
+    a request spends in the queue between the rollout worker and the policy worker is not included. The queueing
+    delay of a request is the time between receiving it and the forward pass. Batch sizes and queueing delays are
+    also reported as histograms for the policy worker stats.
+    """
+
+    ema_alpha = 0.05
+    max_fixed_cost_fraction = 0.1
+    min_budget_scale = 0.05
+
+    def __init__(self, min_num_requests: int, latency_target_sec: float):
+        super().__init__(min_num_requests)
+        self.latency_target_sec = latency_target_sec
+
+        # since the last report, for the histograms
+        self.batch_sizes: List[int] = []
+        self.queueing_delays: List[float] = []
+
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.budget_scale = 0.5  # leave room for the tail of the latency distribution to begin with
+
+        # exponentially weighted moments of (num_samples, forward time) for the cost model
+        self._n = self._t = self._nn = self._nt = None
+
+        self.samples_per_request: Optional[float] = None
+        self.arrival_rate: Optional[float] = None  # samples per second
+        self._last_step_finished: Optional[float] = None
+        self._num_steps = 0
+        self.max_requests = 1
+
+    def should_wait(self, num_requests: int, waiting_started: float, oldest_request: Optional[float]) -> bool:
+        if oldest_request is None:
+            return time.time() - waiting_started < MAX_IDLE_WAIT_SEC
+        return num_requests < self.target_requests and time.time() - oldest_request < self.window_sec
+
+    def poll_timeout(self, oldest_request: Optional[float]) -> float:
+        if oldest_request is None:
+            return POLL_TIMEOUT_SEC
+        return min(POLL_TIMEOUT_SEC, max(self.window_sec - (time.time() - oldest_request), 1e-4))
+
+    def _ema(self, old: Optional[float], new: float) -> float:
+        return new if old is None else old + self.ema_alpha * (new - old)
+
+    def forward_cost(self) -> Tuple[float, float]:
+        """Fixed and per-sample cost of a forward pass, in seconds."""
+        var_n = self._nn - self._n**2
+        if var_n > 1e-6:
+            per_sample = max((self._nt - self._n * self._t) / var_n, 0.0)
+        else:
+            # all batches had the same size so far, assume the cost is all per-sample
+            per_sample = self._t / max(self._n, 1.0)
+        fixed = max(self._t - per_sample * self._n, 0.0)
+        return fixed, per_sample
+
+    def on_policy_step(
+        self, num_samples: int, received: np.ndarray, forward_started: float, forward_sec: float, finished: float
+    ) -> None:
+        self.batch_sizes.append(num_samples)
+        self.queueing_delays.extend(forward_started - received)
+        self.latencies.extend(finished - received)
+
+        self._n = self._ema(self._n, num_samples)
+        self._t = self._ema(self._t, forward_sec)
+        self._nn = self._ema(self._nn, num_samples**2)
+        self._nt = self._ema(self._nt, num_samples * forward_sec)
+        self.samples_per_request = self._ema(self.samples_per_request, num_samples / len(received))
+        self.max_requests = max(self.max_requests, len(received))
+
+        if self._last_step_finished is not None:
+            cycle_sec = max(finished - self._last_step_finished, 1e-6)
+            self.arrival_rate = self._ema(self.arrival_rate, num_samples / cycle_sec)
+        self._last_step_finished = finished
+
+        self._num_steps += 1
+        if self._num_steps % 10 == 0:
+            p99_latency = np.percentile(self.latencies, 99)
+            if p99_latency > self.latency_target_sec:
+                self.budget_scale = max(self.budget_scale * 0.8, self.min_budget_scale)
+            elif p99_latency < 0.8 * self.latency_target_sec:
+                self.budget_scale = min(self.budget_scale + 0.05, 1.0)
+
+        self._update_window()
+
+    def _update_window(self) -> None:
+        if self.arrival_rate is None:
+            return
+
+        fixed, per_sample = self.forward_cost()
+        rate = self.arrival_rate
+        budget = self.latency_target_sec * self.budget_scale
+
+        f = self.max_fixed_cost_fraction
+        if per_sample > 0.0:
+            amortized_samples = fixed * (1.0 - f) / (f * per_sample)
+        else:
+            amortized_samples = math.inf
+
+        # the longest window such that the requests received first still meet the budget after the forward pass
+        max_window = max((budget - fixed) / (1.0 + rate * per_sample), 0.0)
+        window = min(max_window, amortized_samples / rate)
+
+        self.window_sec = window
+        target_samples = max(rate * window, 1.0)
+        target_requests = math.ceil(target_samples / self.samples_per_request)
+        self.target_requests = max(1, min(target_requests, self.max_requests))
+
+    def stats(self) -> Dict:
+        stats = dict()
+        if self.batch_sizes:
+            stats["inference_batch_size"] = np.array(self.batch_sizes)
+            stats["inference_queueing_delay_ms"] = np.array(self.queueing_delays) * 1000
+            stats["inference_queueing_delay_p99_ms"] = np.percentile(stats["inference_queueing_delay_ms"], 99)
+            self.batch_sizes, self.queueing_delays = [], []
+        if self.latencies:
+            stats["inference_worker_latency_p99_ms"] = np.percentile(self.latencies, 99) * 1000
+        stats["inference_wait_window_ms"] = self.window_sec * 1000
+        stats["inference_target_requests"] = self.target_requests
+        return stats
+
+
+def make_inference_batching(cfg: Config, min_num_requests: int) -> InferenceBatching:
+    if "inference_batching" in cfg and cfg.inference_batching == "adaptive":
+        return AdaptiveInferenceBatching(min_num_requests, cfg.inference_latency_target_ms / 1000)
+    return InferenceBatching(min_num_requests)
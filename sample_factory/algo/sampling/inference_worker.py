@@ -12,6 +12,7 @@ import psutil
 import torch
 from signal_slot.signal_slot import TightLoop, Timer, signal
 
+from sample_factory.algo.sampling.inference_batching import InferenceBatching, make_inference_batching
 from sample_factory.algo.utils.context import SampleFactoryContext, set_global_context
 from sample_factory.algo.utils.env_info import EnvInfo
 from sample_factory.algo.utils.heartbeat import HeartbeatStoppableEventLoopObject
@@ -25,7 +26,15 @@ from sample_factory.algo.utils.misc import (
 )
 from sample_factory.algo.utils.model_sharing import ParameterServer, make_parameter_client
 from sample_factory.algo.utils.rl_utils import prepare_and_normalize_obs
-from sample_factory.algo.utils.shared_buffers import policy_device
+from sample_factory.algo.utils.shared_buffers import (
+    REQUEST_AGENT_IDX,
+    REQUEST_ENV_IDX,
+    REQUEST_ROLLOUT_STEP,
+    REQUEST_SPLIT_IDX,
+    REQUEST_TRAJ_IDX,
+    REQUEST_WORKER_IDX,
+    policy_device,
+)
 from sample_factory.algo.utils.tensor_dict import TensorDict, to_numpy
 from sample_factory.algo.utils.tensor_utils import cat_tensors, dict_of_lists_cat, ensure_torch_tensor
 from sample_factory.algo.utils.torch_utils import inference_context, init_torch_runtime, synchronize
@@ -89,9 +98,12 @@ class InferenceWorker(HeartbeatStoppableEventLoopObject, Configurable):
         # shallow copy
         self.traj_tensors: Dict[Device, TensorDict] = copy.copy(buffer_mgr.traj_tensors_torch)
         self.policy_output_tensors: Dict[Device, TensorDict] = copy.copy(buffer_mgr.policy_output_tensors_torch)
+        self.policy_request_rows = buffer_mgr.policy_request_tensors  # non-batched sampling only
 
         self.device: torch.device = policy_device(cfg, policy_id)
-        self.param_client = make_parameter_client(cfg.serial_mode, param_server, cfg, env_info, self.timing)
+        self.param_client = make_parameter_client(
+            cfg.serial_mode, param_server, cfg, env_info, self.timing, client_idx=worker_idx
+        )
         self.inference_queue = inference_queue
 
         self.request_count = deque(maxlen=50)
@@ -107,7 +119,12 @@ class InferenceWorker(HeartbeatStoppableEventLoopObject, Configurable):
         self.min_num_requests = max(1, min_num_requests)
         log.info(f"{self.object_id}: min num requests: %d", self.min_num_requests)
 
+        # how long we wait for more requests before the forward pass (see --inference_batching)
+        self.batching: InferenceBatching = make_inference_batching(cfg, self.min_num_requests)
+
         self.requests = []
+        self.request_rows: Optional[np.ndarray] = None  # index rows of the requests in the current batch
+        self.request_times: List[float] = []  # when we received the pending requests
         self.total_num_samples = self.last_report_samples = 0
 
         self._get_inference_requests_func = (
@@ -148,6 +165,8 @@ class InferenceWorker(HeartbeatStoppableEventLoopObject, Configurable):
         if "cpu" in self.traj_tensors:
             self.traj_tensors["cpu"] = to_numpy(self.traj_tensors["cpu"])
             self.policy_output_tensors["cpu"] = to_numpy(self.policy_output_tensors["cpu"])
+        if self.policy_request_rows is not None:
+            self.policy_request_rows = to_numpy(self.policy_request_rows)
 
         state_dict = None
         policy_version = 0
@@ -208,15 +227,16 @@ class InferenceWorker(HeartbeatStoppableEventLoopObject, Configurable):
 
     def _batch_individual_steps(self, timing):
         with timing.add_time("deserialize"):
-            indices = []
+            rows = self.policy_request_rows
+            request_rows = []
             for request in self.requests:
                 # TODO: what should we do with data sampled on different devices
-                actor_idx, split_idx, request_data, device = request
-                for env_idx, agent_idx, traj_buffer_idx, rollout_step in request_data:
-                    index = [traj_buffer_idx, rollout_step]
-                    indices.append(index)
+                actor_idx, split_idx, (offset, num_rows), device = request
+                request_rows.append(rows[actor_idx, split_idx, offset : offset + num_rows])
 
-            indices = tuple(np.array(indices).T)
+            # a copy, the rollout workers don't touch their rows until they receive the actions
+            self.request_rows = np.concatenate(request_rows)
+            indices = (self.request_rows[:, REQUEST_TRAJ_IDX], self.request_rows[:, REQUEST_ROLLOUT_STEP])
             traj_tensors = self.traj_tensors[device]  # TODO: multiple sampling devices?
             observations = traj_tensors["obs"][indices]
             rnn_states = traj_tensors["rnn_states"][indices]
@@ -304,19 +324,21 @@ class InferenceWorker(HeartbeatStoppableEventLoopObject, Configurable):
         output_tensors = torch.cat(output_tensors, dim=1)
 
         signals_to_send: AdvanceRolloutSignals = dict()
-        output_indices = []
         for request in requests:
-            actor_idx, split_idx, request_data, _ = request
-            for env_idx, agent_idx, traj_buffer_idx, rollout_step in request_data:
-                output_indices.append([actor_idx, split_idx, env_idx, agent_idx])
-
+            actor_idx, split_idx, _, _ = request
             payload = (split_idx, self.policy_id)
             if actor_idx in signals_to_send:
                 signals_to_send[actor_idx].append(payload)
             else:
                 signals_to_send[actor_idx] = [payload]
 
-        output_indices = tuple(np.array(output_indices).T)
+        rows = self.request_rows
+        output_indices = (
+            rows[:, REQUEST_WORKER_IDX],
+            rows[:, REQUEST_SPLIT_IDX],
+            rows[:, REQUEST_ENV_IDX],
+            rows[:, REQUEST_AGENT_IDX],
+        )
         self.policy_output_tensors[device][output_indices] = output_tensors.numpy()
 
         # this should be a no-op unless we have a non-batched env with observations on gpu
@@ -338,35 +360,47 @@ class InferenceWorker(HeartbeatStoppableEventLoopObject, Configurable):
                 normalized_obs = prepare_and_normalize_obs(actor_critic, obs)
                 rnn_states = ensure_torch_tensor(rnn_states).to(self.device).float()
 
+            forward_started = time.time()
             with timing.add_time("forward"):
                 policy_outputs = actor_critic(normalized_obs, rnn_states)
                 policy_outputs["policy_version"] = torch.empty([num_samples]).fill_(self.param_client.policy_version)
 
             with timing.add_time("prepare_outputs"):
                 signals_to_send = self._prepare_policy_outputs_func(num_samples, policy_outputs, self.requests)
+            forward_sec = time.time() - forward_started
 
             with timing.add_time("send_messages"):
                 for actor_idx, data in signals_to_send.items():
                     self.emit_many(advance_rollouts_signal(actor_idx), data)
 
+            received = np.array(self.request_times)
+            self.batching.on_policy_step(num_samples, received, forward_started, forward_sec, time.time())
+
             self.requests = []
+            self.request_times = []
+
+    def _add_requests(self, requests: List) -> None:
+        self.requests.extend(requests)
+        self.request_times.extend([time.time()] * len(requests))
 
     def _get_inference_requests_serial(self):
         try:
-            self.requests.extend(self.inference_queue.get_many(block=False))
+            self._add_requests(self.inference_queue.get_many(block=False))
         except Empty:
             pass
 
     def _get_inference_requests_async(self):
-        # Very conservative timer. Only wait a little bit, then continue with what we've got.
-        wait_for_min_requests = 0.025
+        # Only wait a little bit, then continue with what we've got.
+        batching = self.batching
 
         waiting_started = time.time()
-        while len(self.requests) < self.min_num_requests and time.time() - waiting_started < wait_for_min_requests:
+        oldest_request = self.request_times[0] if self.request_times else None
+        while batching.should_wait(len(self.requests), waiting_started, oldest_request):
             try:
                 with self.timing.timeit("wait_policy"), self.timing.add_time("wait_policy_total"):
-                    policy_requests = self.inference_queue.get_many(timeout=0.005)
-                self.requests.extend(policy_requests)
+                    policy_requests = self.inference_queue.get_many(timeout=batching.poll_timeout(oldest_request))
+                self._add_requests(policy_requests)
+                oldest_request = self.request_times[0]
             except Empty:
                 pass
 
@@ -393,6 +427,7 @@ class InferenceWorker(HeartbeatStoppableEventLoopObject, Configurable):
         stats = memory_stats("policy_worker", self.device)
         if len(self.request_count) > 0:
             stats["avg_request_count"] = np.mean(self.request_count)
+        stats.update(self.batching.stats())
 
         self.report_msg.emit(
             {
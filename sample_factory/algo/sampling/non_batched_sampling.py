@@ -9,10 +9,15 @@ import numpy as np
 
 from sample_factory.algo.sampling.sampling_utils import VectorEnvRunner, record_episode_statistics_wrapper_stats
 from sample_factory.algo.utils.agent_policy_mapping import AgentPolicyMapping
-from sample_factory.algo.utils.env_info import EnvInfo, check_env_info
+from sample_factory.algo.utils.env_info import EnvInfo, check_env_info, cost_stat_keys
 from sample_factory.algo.utils.make_env import make_env_func_non_batched
 from sample_factory.algo.utils.misc import EPISODIC, POLICY_ID_KEY
-from sample_factory.algo.utils.shared_buffers import BufferMgr
+from sample_factory.algo.utils.shared_buffers import (
+    REQUEST_ENV_IDX,
+    REQUEST_ROLLOUT_STEP,
+    REQUEST_TRAJ_IDX,
+    BufferMgr,
+)
 from sample_factory.algo.utils.tensor_dict import TensorDict, to_numpy
 from sample_factory.algo.utils.tensor_utils import clone_tensor, ensure_numpy_array
 from sample_factory.envs.env_utils import find_training_info_interface, set_reward_shaping, set_training_info
@@ -91,9 +96,18 @@ class ActorState:
         self.last_episode_reward = 0
         self.last_episode_duration = 0
 
+        # envs with several constraint channels report a vector of costs per step, accumulated here per channel
+        self.cost_stat_keys = cost_stat_keys(env_info)
+        self.last_episode_costs = np.zeros(len(self.cost_stat_keys), dtype=np.float64)
+
         self.training_info: List[Optional[Dict]] = training_info
         self.env_training_info_interface = find_training_info_interface(env)
 
+        # index of this actor in the shared heatmaps and episodic stats
+        self.actor_idx = global_env_idx * env_info.num_agents + agent_idx
+        self.heatmaps = buffer_mgr.heatmaps
+        self.episodic_stats = buffer_mgr.episodic_stats
+
     def _env_set_curr_policy(self):
         """
         Most environments do not need to know index of the policy that currently collects experience.
@@ -190,7 +204,12 @@ class ActorState:
         done = terminated | truncated
 
         self.curr_traj_buffer["rewards"][rollout_step] = float(reward)
-        self.curr_traj_buffer["costs"][rollout_step] = float(info.get("cost", 0.0))
+        if self.cost_stat_keys:
+            costs = np.asarray(info.get("costs", 0.0), dtype=np.float32)
+            self.curr_traj_buffer["costs"][rollout_step] = costs
+            self.last_episode_costs += costs
+        else:
+            self.curr_traj_buffer["costs"][rollout_step] = float(info.get("cost", 0.0))
         self.curr_traj_buffer["dones"][rollout_step] = done
         self.curr_traj_buffer["time_outs"][rollout_step] = truncated
 
@@ -215,6 +234,7 @@ class ActorState:
                 self._on_new_policy(new_policy_id)
 
             self.last_episode_reward = self.last_episode_duration = 0.0
+            self.last_episode_costs.fill(0.0)
 
         return report
 
@@ -292,14 +312,25 @@ class ActorState:
         if done:
             self.reset_rnn_state()
 
-    def _episodic_stats(self, info: Dict) -> Dict[str, Any]:
+    def _episodic_stats(self, info: Dict) -> Optional[Dict[str, Any]]:
         stats = dict(
             reward=self.last_episode_reward,
             len=self.last_episode_duration,
             episode_extra_stats=info.get("episode_extra_stats", dict()),
-            heatmap=info.get("previous_histogram", []),
         )
 
+        # the histogram is a reference to the env's grid of the finished episode, we accumulate it in shared memory
+        # instead of sending it with the report
+        histogram = info.get("reset_info", dict()).get("episode_histogram")
+        if self.heatmaps is not None and histogram is not None:
+            self.heatmaps.add_episode(self.curr_policy_id, self.actor_idx, histogram)
+
+        for key, episode_cost in zip(self.cost_stat_keys, self.last_episode_costs.tolist()):
+            stats[key] = episode_cost
+
+        if "continual_env_task" in info:
+            stats["task_id"] = info["continual_env_task"]
+
         if (true_objective := info.get("true_objective", self.last_episode_reward)) is not None:
             stats["true_objective"] = true_objective
 
@@ -309,6 +340,12 @@ class ActorState:
             stats["RecordEpisodeStatistics_reward"] = wrapper_rew
             stats["RecordEpisodeStatistics_len"] = wrapper_len
 
+        if self.episodic_stats is not None:
+            # only the stats that don't fit the shared memory schema are sent with the report
+            stats = self.episodic_stats.write(self.curr_policy_id, np.array([self.actor_idx]), stats)
+            if not stats:
+                return None
+
         report = {EPISODIC: stats, POLICY_ID_KEY: self.curr_policy_id}
         return report
 
@@ -359,6 +396,9 @@ class NonBatchedVectorEnvRunner(VectorEnvRunner):
             self.traj_tensors = to_numpy(self.traj_tensors)
             self.policy_output_tensors = to_numpy(self.policy_output_tensors)
 
+        # our slot in the shared requests, one row per actor (see alloc_policy_request_tensors())
+        self.policy_request_rows = to_numpy(buffer_mgr.policy_request_tensors[worker_idx, split_idx])
+
         self.num_envs = num_envs
         self.num_agents = env_info.num_agents
 
@@ -386,6 +426,8 @@ class NonBatchedVectorEnvRunner(VectorEnvRunner):
                 worker_index=self.worker_idx,
                 vector_index=vector_idx,
                 env_id=global_env_idx,
+                # observations are copied to the trajectory buffers before the next step, envs can reuse their arrays
+                reuse_observations=True,
             )
 
             # log.info('Creating env %r... %d-%d-%d', env_config, self.worker_idx, self.split_idx, env_i)
@@ -503,7 +545,8 @@ class NonBatchedVectorEnvRunner(VectorEnvRunner):
                     actor_state.last_rnn_state = policy_outputs_dict["new_rnn_states"]
                     actor_state.last_value = policy_outputs_dict["values"].item()
                     if 'cost_values' in policy_outputs_dict:
-                        actor_state.last_cost_value = policy_outputs_dict["cost_values"].item()
+                        # a float, or a list with one cost value per constraint channel
+                        actor_state.last_cost_value = policy_outputs_dict["cost_values"].squeeze().tolist()
 
                     actor_state.ready = True
                 elif not actor_state.ready:
@@ -579,11 +622,13 @@ class NonBatchedVectorEnvRunner(VectorEnvRunner):
         Note how the data required is basically just indices of envs and agents, as well as location of the step
         data in the shared rollout buffer. This is enough for the policy worker to find the step data in the shared
         data structure.
+        We write these indices to our slot in the shared requests, grouped by policy, so every policy only gets
+        the offset and the number of its rows.
 
         :return: formatted request to be distributed to policy workers through FIFO queues.
         """
 
-        policy_request = dict()
+        actors_per_policy = dict()
 
         for env_i in range(self.num_envs):
             for agent_i in range(self.num_agents):
@@ -593,11 +638,20 @@ class NonBatchedVectorEnvRunner(VectorEnvRunner):
                     policy_id = actor_state.curr_policy_id
 
                     # where policy worker should look for the policy inputs for the next step
-                    data = (env_i, agent_i, actor_state.curr_traj_buffer_idx, self.rollout_step)
+                    data = (env_i, agent_i, actor_state.curr_traj_buffer_idx)
 
-                    if policy_id not in policy_request:
-                        policy_request[policy_id] = []
-                    policy_request[policy_id].append(data)
+                    if policy_id not in actors_per_policy:
+                        actors_per_policy[policy_id] = []
+                    actors_per_policy[policy_id].append(data)
+
+        policy_request = dict()
+        offset = 0
+        for policy_id, actors in actors_per_policy.items():
+            rows = self.policy_request_rows[offset : offset + len(actors)]
+            rows[:, REQUEST_ENV_IDX : REQUEST_TRAJ_IDX + 1] = actors
+            rows[:, REQUEST_ROLLOUT_STEP] = self.rollout_step
+            policy_request[policy_id] = (offset, len(actors))
+            offset += len(actors)
 
         return policy_request
 
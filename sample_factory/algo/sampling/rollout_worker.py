@@ -16,6 +16,7 @@ from sample_factory.algo.utils.env_info import EnvInfo
 from sample_factory.algo.utils.heartbeat import HeartbeatStoppableEventLoopObject
 from sample_factory.algo.utils.misc import advance_rollouts_signal, new_trajectories_signal
 from sample_factory.algo.utils.rl_utils import total_num_agents, trajectories_per_training_iteration
+from sample_factory.algo.utils.task_switch import task_for_split
 from sample_factory.algo.utils.torch_utils import inference_context
 from sample_factory.cfg.configurable import Configurable
 from sample_factory.utils.gpu_utils import set_gpus_for_process
@@ -89,14 +90,16 @@ class RolloutWorker(HeartbeatStoppableEventLoopObject, Configurable):
         self.buffer_mgr = buffer_mgr
         self.inference_queues = inference_queues
 
-        self.current_env_id = 0  # in continual learning setting this will be updated
+        self.vector_size = cfg.num_envs_per_worker
+        self.num_splits = cfg.worker_num_splits
+
+        # in continual learning setting this will be updated, task switches can be staggered across splits
+        self.current_env_ids: List[int] = [0 for _ in range(self.num_splits)]
 
         self.env_info = env_info
         self.worker_idx = worker_idx
         self.sampling_device = str(rollout_worker_device(self.worker_idx, self.cfg, self.env_info))
 
-        self.vector_size = cfg.num_envs_per_worker
-        self.num_splits = cfg.worker_num_splits
         assert self.vector_size >= self.num_splits
         assert self.vector_size % self.num_splits == 0, "Vector size should be divisible by num_splits"
 
@@ -301,10 +304,10 @@ class RolloutWorker(HeartbeatStoppableEventLoopObject, Configurable):
             self.training_info[policy_id] = info
 
         # Check if we need to switch envs (continual learning setting)
-        env_id = self.training_info[0].get("current_env_id", None)
-        if env_id is not None and env_id != self.current_env_id:
-            self.current_env_id = env_id
-            for runner in self.env_runners:
+        for runner in self.env_runners:
+            env_id = task_for_split(self.training_info[0], self.worker_idx, runner.split_idx, self.num_splits)
+            if env_id is not None and env_id != self.current_env_ids[runner.split_idx]:
+                self.current_env_ids[runner.split_idx] = env_id
                 runner.update_env_id(env_id)
 
     def on_stop(self, *args):
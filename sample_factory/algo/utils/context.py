@@ -1,12 +1,13 @@
 from typing import Dict
 
 from sample_factory.model.model_factory import ModelFactory
-from sample_factory.utils.typing import CreateEnvFunc
+from sample_factory.utils.typing import CreateBatchedEnvFunc, CreateEnvFunc
 
 
 class SampleFactoryContext:
     def __init__(self):
         self.env_registry = dict()
+        self.batched_env_registry = dict()
         self.model_factory = ModelFactory()
 
 
@@ -38,6 +39,13 @@ def global_env_registry() -> Dict[str, CreateEnvFunc]:
     return sf_global_context().env_registry
 
 
+def global_batched_env_registry() -> Dict[str, CreateBatchedEnvFunc]:
+    """
+    :return: registry of functions that create natively batched implementations of the registered envs
+    """
+    return sf_global_context().batched_env_registry
+
+
 def global_model_factory() -> ModelFactory:
     """
     :return: global model factory
@@ -5,7 +5,7 @@ import os
 import pickle
 from dataclasses import dataclass
 from os.path import join
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 
 import gymnasium as gym
 
@@ -16,7 +16,7 @@ from sample_factory.envs.env_utils import get_default_reward_shaping
 from sample_factory.utils.typing import Config
 from sample_factory.utils.utils import log, project_tmp_dir
 
-ENV_INFO_PROTOCOL_VERSION = 1
+ENV_INFO_PROTOCOL_VERSION = 2
 
 
 @dataclass
@@ -30,17 +30,37 @@ class EnvInfo:
     action_splits: List[int]  # in the case of tuple actions, the splits for the actions
     all_discrete: bool  # in the case of tuple actions, whether the actions are all discrete
     frameskip: int
-    safety_bound: float
+    # per-episode cost budget, one value per constraint channel if the env reports several of them
+    safety_bound: float | Tuple[float, ...]
     timeout: int
     # potentially customizable reward shaping, a map of reward component names to their respective weights
     # this can be used by PBT to optimize the reward shaping towards a sparse final objective
     reward_shaping_scheme: Optional[Dict[str, float]] = None
+    # shape of the positional visitation histogram, None if the env does not track agent positions
+    heatmap_shape: Optional[Tuple[int, int]] = None
+    # keys of the episode_extra_stats the env reports at the end of every episode, empty if it does not declare them
+    episode_stat_keys: Tuple[str, ...] = ()
+    # names of the constraint channels the env reports costs for, a single scalar cost by default
+    cost_channels: Tuple[str, ...] = ("cost",)
 
     # version of the protocol, used to detect changes in the EnvInfo class and invalidate the cache if needed
     # bump this version if you make any changes to the EnvInfo class
     env_info_protocol_version: Optional[int] = None
 
 
+def cost_shape(env_info: EnvInfo) -> List[int]:
+    """Trailing shape of the per-step costs and cost values: scalars, or a vector if there are several channels."""
+    num_costs = len(env_info.cost_channels)
+    return [num_costs] if num_costs > 1 else []
+
+
+def cost_stat_keys(env_info: EnvInfo) -> Tuple[str, ...]:
+    """Episodic stats with the accumulated cost of every constraint channel, only reported for multi-channel envs."""
+    if len(env_info.cost_channels) <= 1:
+        return ()
+    return tuple(f"episode_cost_{channel}" for channel in env_info.cost_channels)
+
+
 def extract_env_info(env: BatchedVecEnv | NonBatchedVecEnv, cfg: Config) -> EnvInfo:
     obs_space = env.observation_space
     action_space = env.action_space
@@ -56,6 +76,13 @@ def extract_env_info(env: BatchedVecEnv | NonBatchedVecEnv, cfg: Config) -> EnvI
 
     reward_shaping_scheme = get_default_reward_shaping(env)
 
+    heatmap_shape = getattr(env, "heatmap_shape", None)
+    episode_stat_keys = tuple(getattr(env, "episode_stat_keys", ()))
+    cost_channels = tuple(getattr(env, "cost_channels", ("cost",)))
+    if len(cost_channels) > 1:
+        # every constraint channel has its own budget, the same one unless the env declares them
+        safety_bound = tuple(getattr(env, "channel_safety_bounds", (safety_bound,) * len(cost_channels)))
+
     action_splits = None
     all_discrete = None
     if isinstance(action_space, gym.spaces.Tuple):
@@ -74,6 +101,9 @@ def extract_env_info(env: BatchedVecEnv | NonBatchedVecEnv, cfg: Config) -> EnvI
         safety_bound=safety_bound,
         timeout=timeout,
         reward_shaping_scheme=reward_shaping_scheme,
+        heatmap_shape=heatmap_shape,
+        episode_stat_keys=episode_stat_keys,
+        cost_channels=cost_channels,
         env_info_protocol_version=ENV_INFO_PROTOCOL_VERSION,
     )
     return env_info
@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import numbers
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+
+from sample_factory.utils.dicts import iterate_recursively
+from sample_factory.utils.typing import PolicyID
+from sample_factory.utils.utils import log
+
+# stats reported for every episode by the samplers, on top of the ones declared by the env
+CORE_EPISODIC_STAT_KEYS = ("reward", "len", "true_objective", "min_raw_reward", "max_raw_reward", "task_id")
+
+# records per actor, the runner drains the buffers every second so this is plenty even for very short episodes
+EPISODIC_STATS_CAPACITY = 64
+
+
+class SharedEpisodicStats:
+    """
+    Episodic stats of all actors in the system, written into ring buffers in shared memory.
+
+    The schema is fixed when the buffers are created: every record is a float64 row with one column per key, NaN for
+    keys that were not reported for the episode. Each actor owns one ring of `capacity` records and is the only one
+    writing to it, the runner periodically drains all rings at once. Values that don't fit the schema (unknown keys,
+    non-scalars) are handed back to the caller, to be sent with the regular episodic report.
+
+    Rollout workers and the runner only exchange the write counters, so there is no locking: a record is complete
+    once the counter is incremented. If the runner falls behind by `capacity` or more episodes of one actor,
+    the oldest records of that actor are dropped, the slot the writer overwrites next is never read.
+    """
+
+    def __init__(self, num_actors: int, keys: Sequence[str], capacity: int, share: bool):
+        self.keys: Tuple[str, ...] = tuple(dict.fromkeys(keys))
+        self.key_index = {key: i for i, key in enumerate(self.keys)}
+        self.capacity = capacity
+
+        self.records = torch.full([num_actors, capacity, len(self.keys)], np.nan, dtype=torch.float64)
+        self.policy_ids = torch.zeros([num_actors, capacity], dtype=torch.int32)
+        self.write_counts = torch.zeros([num_actors], dtype=torch.int64)
+        if share:
+            self.records.share_memory_()
+            self.policy_ids.share_memory_()
+            self.write_counts.share_memory_()
+
+        # drain state, only used on the runner side
+        self._read_counts = np.zeros(num_actors, dtype=np.int64)
+        self._num_dropped = 0
+
+        self._arrays: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None
+
+    def __getstate__(self):
+        # numpy views of the shared tensors are created in the process that uses them, see _numpy()
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+    def _numpy(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        if self._arrays is None:
+            self._arrays = (self.records.numpy(), self.policy_ids.numpy(), self.write_counts.numpy())
+        return self._arrays
+
+    def write(self, policy_id: PolicyID, actor_indices: np.ndarray, stats: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Called on the rollout worker when the episodes of the given actors are over.
+        Stats are scalars (same for all actors) or arrays with a value per actor, possibly nested in dicts.
+        :return: flat dict of the stats that don't fit the schema, empty if all of them do
+        """
+        records, policy_ids, write_counts = self._numpy()
+        num_records = len(actor_indices)
+
+        values = dict()
+        remaining = dict()
+        for _, key, value in iterate_recursively(stats):
+            column = self.key_index.get(key)
+            if column is None:
+                remaining[key] = value
+            elif isinstance(value, (float, int)) or isinstance(value, numbers.Number):
+                # checking the concrete types first is much cheaper than the numbers.Number ABC
+                values[column] = value
+            elif isinstance(value, np.ndarray) and value.shape == (num_records,):
+                values[column] = value
+            else:
+                remaining[key] = value
+
+        if num_records == 1:
+            # the common case of the non-batched samplers, scalar indexing is a lot cheaper than fancy indexing
+            actor_idx = int(actor_indices[0])
+            count = int(write_counts[actor_idx])
+            slot = count % self.capacity
+
+            row = [np.nan] * len(self.keys)
+            for column, value in values.items():
+                row[column] = value[0] if isinstance(value, np.ndarray) else value
+
+            records[actor_idx, slot] = row
+            policy_ids[actor_idx, slot] = policy_id
+            write_counts[actor_idx] = count + 1
+        else:
+            slots = write_counts[actor_indices] % self.capacity
+
+            rows = np.full((num_records, len(self.keys)), np.nan)
+            for column, value in values.items():
+                rows[:, column] = value
+
+            records[actor_indices, slots] = rows
+            policy_ids[actor_indices, slots] = policy_id
+            write_counts[actor_indices] += 1
+
+        return remaining
+
+    def drain(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Collect all records written since the previous call.
+        :return: [num_records, num_keys] values and [num_records] policy ids
+        """
+        records, policy_ids, write_counts = self._numpy()
+        write_counts = write_counts.copy()
+        # slot write_counts % capacity is the one the writer overwrites next, maybe right now, so we never read it:
+        # of a full ring only the newest capacity - 1 records are read
+        start = np.maximum(self._read_counts, write_counts - self.capacity + 1)
+
+        dropped = int((start - self._read_counts).sum())
+        if dropped > 0:
+            self._num_dropped += dropped
+            log.warning("Dropped %d episodic stats records (%d total), increase the capacity", dropped, self._num_dropped)
+
+        num_new = write_counts - start
+        self._read_counts = write_counts
+
+        total = int(num_new.sum())
+        if total == 0:
+            return np.empty((0, len(self.keys))), np.empty(0, dtype=np.int32)
+
+        actors = np.repeat(np.arange(len(num_new)), num_new)
+        first_record = np.cumsum(num_new) - num_new
+        slots = (np.repeat(start - first_record, num_new) + np.arange(total)) % self.capacity
+
+        return records[actors, slots], policy_ids[actors, slots]
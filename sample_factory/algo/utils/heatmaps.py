@@ -0,0 +1,60 @@
+from __future__ import annotations
+
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import torch
+
+from sample_factory.utils.typing import PolicyID
+from sample_factory.utils.utils import debug_log_every_n
+
+
+class SharedHeatmaps:
+    """
+    Visitation counts of all actors in the system, accumulated in shared memory.
+
+    Each actor owns one int32 grid per policy. Rollout workers add the histogram of a finished episode to their own
+    grid in-place, so episodic reports never have to carry (and pickle) the arrays. The runner periodically merges
+    the grids and turns the delta since the previous merge into a per-episode average heatmap.
+    """
+
+    def __init__(self, num_policies: int, num_actors: int, shape: Tuple[int, int], share: bool):
+        self.shape = tuple(shape)
+
+        self.counts = torch.zeros([num_policies, num_actors, *self.shape], dtype=torch.int32)
+        self.episodes = torch.zeros([num_policies, num_actors], dtype=torch.int32)
+        if share:
+            self.counts.share_memory_()
+            self.episodes.share_memory_()
+
+        # merge state, only used on the runner side
+        self._merged_counts: Dict[PolicyID, np.ndarray] = dict()
+        self._merged_episodes: Dict[PolicyID, int] = dict()
+
+    def add_episode(self, policy_id: PolicyID, actor_idx: int, histogram: np.ndarray) -> None:
+        """Called on the rollout worker at the episode boundary. Histograms larger than the grid are clipped."""
+        h, w = min(histogram.shape[0], self.shape[0]), min(histogram.shape[1], self.shape[1])
+        if (h, w) != histogram.shape:
+            debug_log_every_n(1000, "Histogram %r clipped to the shared heatmap shape %r", histogram.shape, self.shape)
+
+        grid = self.counts[policy_id, actor_idx].numpy()
+        grid[:h, :w] += histogram[:h, :w]
+        self.episodes[policy_id, actor_idx] += 1
+
+    def merge(self, policy_id: PolicyID) -> Optional[np.ndarray]:
+        """
+        Average visitation heatmap over the episodes finished since the previous merge.
+        :return: None if no episodes finished since then
+        """
+        episodes = int(self.episodes[policy_id].sum())
+        num_new_episodes = episodes - self._merged_episodes.get(policy_id, 0)
+        if num_new_episodes <= 0:
+            return None
+
+        counts = self.counts[policy_id].numpy().sum(axis=0, dtype=np.int64)
+        prev_counts = self._merged_counts.get(policy_id)
+        window = counts if prev_counts is None else counts - prev_counts
+
+        self._merged_counts[policy_id] = counts
+        self._merged_episodes[policy_id] = episodes
+        return window / num_new_episodes
@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
 
 import gymnasium as gym
@@ -18,6 +20,7 @@ from sample_factory.envs.env_utils import (
 )
 from sample_factory.utils.dicts import dict_of_lists_append, list_of_dicts_to_dict_of_lists
 from sample_factory.utils.typing import Config
+from sample_factory.utils.utils import log
 
 Actions = Any
 ListActions = Sequence[Actions]
@@ -340,6 +343,11 @@ class ContinualEnv(gym.Env):
     When env i is done, move on to env i+1. Once we exhaust the list, cycle back to the first env.
 
     Now with the ability to forward unknown attributes to the current active env.
+
+    Games for the upcoming tasks are created and initialized ahead of time in a background thread
+    (see --continual_env_pool_size), so that a task switch costs about as much as a regular episode reset instead
+    of a full ViZDoom boot. Synchronous games do not advance while nobody steps them, so the idle pooled games are
+    effectively paused.
     """
 
     def __init__(self, env_names: List[str], cfg, env_config, render_mode):
@@ -347,31 +355,104 @@ class ContinualEnv(gym.Env):
         self.env_names = env_names
         self.cfg = cfg
         self._curr_env_idx = 0
+        self._loaded_env_idx = 0
         self._switch_to_do = False
         self.current_env: Optional[gym.Env] = None
         self.env_config = env_config
         self.render_mode = render_mode
 
+        pool_size = cfg.continual_env_pool_size if "continual_env_pool_size" in cfg else 0
+        self._pool_size = min(pool_size, len(env_names) - 1)
+        self._pool: Dict[int, Future] = dict()
+        self._pool_executor: Optional[ThreadPoolExecutor] = None
+        self._num_switches = 0
+        self._num_pool_hits = 0
+        # visitation histogram of the last episode of the previous task, reported on the next reset
+        self._finished_histogram: Optional[np.ndarray] = None
+
         # Create the first environment
         self._load_env(self._curr_env_idx)
 
+    def _create_env(self, idx: int) -> gym.Env:
+        return create_env(self.env_names[idx], cfg=self.cfg, env_config=self.env_config, render_mode=self.render_mode)
+
+    def _create_initialized_env(self, idx: int) -> gym.Env:
+        env = self._create_env(idx)
+        ensure_initialized = getattr(env.unwrapped, "_ensure_initialized", None)
+        if ensure_initialized is not None:
+            ensure_initialized()
+        return env
+
+    def _upcoming_env_indices(self) -> List[int]:
+        return [(self._curr_env_idx + i) % len(self.env_names) for i in range(1, self._pool_size + 1)]
+
+    def _refill_pool(self):
+        """Keep prepared games exactly for the next tasks in the sequence, close the ones we are not going to need."""
+        if self._pool_size <= 0:
+            return
+
+        if self._pool_executor is None:
+            self._pool_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="continual_env_pool")
+
+        upcoming = self._upcoming_env_indices()
+        for idx in list(self._pool.keys()):
+            if idx not in upcoming:
+                self._pool_executor.submit(self._close_pooled_env, self._pool.pop(idx))
+
+        for idx in upcoming:
+            if idx not in self._pool:
+                self._pool[idx] = self._pool_executor.submit(self._create_initialized_env, idx)
+
+    @staticmethod
+    def _close_pooled_env(env_future: Future):
+        try:
+            env_future.result().close()
+        except Exception as exc:
+            log.warning(f"ContinualEnv: could not close a pooled env: {exc}")
+
     def _load_env(self, idx: int):
-        self.current_env = create_env(self.env_names[idx], cfg=self.cfg, env_config=self.env_config,
-                                      render_mode=self.render_mode)
+        env = None
+        env_future = self._pool.pop(idx, None)
+        if env_future is not None:
+            pool_hit = env_future.done()
+            try:
+                env = env_future.result()
+                self._num_pool_hits += int(pool_hit)
+            except Exception as exc:
+                # e.g. ViZDoom failed to boot in the pool thread, try again the regular way
+                log.warning(f"ContinualEnv: could not prepare task {idx} in the background ({exc!r}), creating it now")
+
+        self.current_env = self._create_env(idx) if env is None else env
+        self._loaded_env_idx = idx
         self.observation_space = self.current_env.observation_space
         self.action_space = self.current_env.action_space
 
     def reset(self, **kwargs):
-        return self.current_env.reset(**kwargs)
+        # start preparing the upcoming tasks only once we are actually used for sampling
+        if self._pool_executor is None:
+            self._refill_pool()
+        obs, info = self.current_env.reset(**kwargs)
+        if self._finished_histogram is not None:
+            info["episode_histogram"] = self._finished_histogram
+            self._finished_histogram = None
+        return obs, info
 
     def step(self, action):
         obs, rew, done, trunc, info = self.current_env.step(action)
 
         if done or trunc:
+            # task on which the finished episode was played, trajectories of the old task can still finish while
+            # a staggered switch is in progress on other workers
+            info["continual_env_task"] = self._loaded_env_idx
             if self._switch_to_do:
+                switch_start = time.time()
                 self._switch_env_after_episode_done()
                 self._switch_to_do = False
                 info["continual_env_switched_to"] = self._curr_env_idx
+                switch_stats = {"continual_env/switch_latency_ms": (time.time() - switch_start) * 1000}
+                if self._pool_size > 0:
+                    switch_stats["continual_env/pool_hit_rate"] = self._num_pool_hits / self._num_switches
+                info["episode_extra_stats"] = {**info.get("episode_extra_stats", dict()), **switch_stats}
 
         return obs, rew, done, trunc, info
 
@@ -380,14 +461,38 @@ class ContinualEnv(gym.Env):
         self._switch_to_do = True
 
     def _switch_env_after_episode_done(self):
-        self.close()
+        prev_env = self.current_env
+        self._num_switches += 1
+
+        # the new env does not know about the episode that just finished, we report its histogram ourselves
+        histogram = getattr(prev_env.unwrapped, "current_histogram", None)
+        self._finished_histogram = None if histogram is None else histogram.copy()
+
         self._load_env(self._curr_env_idx)
+        if self._pool_executor is None:
+            prev_env.close()
+        else:
+            self._pool_executor.submit(prev_env.close)
+        self._refill_pool()
         print(f"ContinualEnv: loaded new task {self._curr_env_idx} - {self.env_names[self._curr_env_idx]}")
 
     def close(self):
         if self.current_env is not None:
             self.current_env.close()
 
+        # don't boot games we are not going to use, only close the ones that are already there (or booting)
+        pool, self._pool = self._pool, dict()
+        for env_future in pool.values():
+            env_future.cancel()
+
+        if self._pool_executor is not None:
+            self._pool_executor.shutdown(wait=True)  # still runs the pending close() calls
+            self._pool_executor = None
+
+        for env_future in pool.values():
+            if not env_future.cancelled():
+                self._close_pooled_env(env_future)
+
     # ---------------------------------------------------------------------
     # FORWARD UNRECOGNIZED ATTRIBUTE ACCESSES TO THE CURRENT ENV
     # ---------------------------------------------------------------------
@@ -410,8 +515,10 @@ class ContinualEnv(gym.Env):
         do so normally. Otherwise, try setting it on the current_env.
         """
         # If it's one of our local attributes, set locally
-        if name in ("env_names", "cfg", "_curr_env_idx", "current_env",
-                    "observation_space", "action_space", "_switch_to_do"):
+        if name in ("env_names", "cfg", "_curr_env_idx", "_loaded_env_idx", "current_env",
+                    "observation_space", "action_space", "_switch_to_do", "env_config", "render_mode",
+                    "_pool_size", "_pool", "_pool_executor", "_num_switches", "_num_pool_hits",
+                    "_finished_histogram"):
             super().__setattr__(name, value)
         else:
             # Otherwise forward to the current_env (if we have one)
@@ -2,7 +2,7 @@
 Utilities for sharing model parameters between components.
 """
 import sys
-from typing import Optional
+from typing import Dict, Optional
 
 import torch
 from torch import Tensor
@@ -13,8 +13,56 @@ from sample_factory.utils.timing import Timing
 from sample_factory.utils.utils import log
 
 
+class SharedWeights:
+    """
+    Double-buffered, versioned copy of the policy weights. The learner publishes into the inactive slot and then
+    flips the active slot, the inference workers (clients) point the tensors of their local models at the active
+    slot, so that neither side takes the policy lock and the clients do not copy any weights.
+    Every client marks the slot it reads from in held_slots (a hazard pointer), the learner does not overwrite a
+    slot that is still held and publishes on the next update instead.
+    """
+
+    def __init__(self, state_dict: Dict[str, Tensor], policy_version: int, num_clients: int):
+        self.slots = [{key: t.detach().clone() for key, t in state_dict.items()} for _ in range(2)]
+        self.slot_versions = torch.tensor([policy_version, -1], dtype=torch.int64)
+        self.active_slot = torch.zeros([1], dtype=torch.int64)
+        self.held_slots = torch.full([num_clients], -1, dtype=torch.int64)
+
+        for t in self._cpu_tensors():
+            t.share_memory_()
+
+    def _cpu_tensors(self):
+        yield from (self.slot_versions, self.active_slot, self.held_slots)
+        for slot in self.slots:
+            yield from (t for t in slot.values() if not t.is_cuda)
+
+    def publish(self, state_dict: Dict[str, Tensor], policy_version: int, device: torch.device) -> bool:
+        target = 1 - int(self.active_slot[0])
+        if bool((self.held_slots == target).any()):
+            # some client still reads the previous weights from this slot
+            return False
+
+        for key, t in self.slots[target].items():
+            t.copy_(state_dict[key])
+
+        # the weights must be in the slot before the clients can see it
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        self.slot_versions[target] = policy_version
+        self.active_slot[0] = target
+        return True
+
+    def acquire_active_slot(self, client_idx: int) -> int:
+        """Marks the active slot as held by the client. Read it again to make sure it was not flipped meanwhile."""
+        while True:
+            slot = int(self.active_slot[0])
+            self.held_slots[client_idx] = slot
+            if int(self.active_slot[0]) == slot:
+                return slot
+
+
 class ParameterServer:
-    def __init__(self, policy_id, policy_versions: Tensor, serial_mode: bool):
+    def __init__(self, policy_id, policy_versions: Tensor, serial_mode: bool, num_weight_clients: int = 0):
         self.policy_id = policy_id
         self.actor_critic = None
         self.cost_critic = None
@@ -24,6 +72,12 @@ class ParameterServer:
         mp_ctx = get_mp_ctx(serial_mode)
         self._policy_lock = get_lock(serial_mode, mp_ctx)
 
+        # with clients in other processes, weights can be published through a double-buffered store
+        # (see --double_buffered_weights), otherwise the clients copy the learner's weights under the policy lock
+        self.num_weight_clients = 0 if serial_mode else num_weight_clients
+        self.shared_weights: Optional[SharedWeights] = None
+        self._published_state: Optional[Dict[str, Tensor]] = None
+
     @property
     def policy_lock(self):
         return self._policy_lock
@@ -32,6 +86,9 @@ class ParameterServer:
         self.actor_critic = actor_critic
         self.policy_versions[self.policy_id] = policy_version
         self.device = device
+        if self.num_weight_clients > 0:
+            self._published_state = actor_critic.state_dict()
+            self.shared_weights = SharedWeights(self._published_state, policy_version, self.num_weight_clients)
         log.debug("Initialized policy %d weights for model version %d", self.policy_id, policy_version)
 
     def update_weights(self, policy_version):
@@ -39,13 +96,17 @@ class ParameterServer:
         In async algorithms policy_versions tensor is in shared memory.
         Therefore clients can just look at the location in shared memory once in a while to see if the
         weights are updated.
+        The learner has to synchronize the device before, so that the weights are committed to memory.
         """
+        if self.shared_weights is not None:
+            self.shared_weights.publish(self._published_state, policy_version, self.device)
         self.policy_versions[self.policy_id] = policy_version
 
 
 class ParameterClient:
-    def __init__(self, param_server: ParameterServer, cfg, env_info, timing: Timing):
+    def __init__(self, param_server: ParameterServer, cfg, env_info, timing: Timing, client_idx: int = 0):
         self.server = param_server
+        self.client_idx = client_idx
         self.policy_id = param_server.policy_id
         self.policy_versions = param_server.policy_versions
 
@@ -95,18 +156,23 @@ class ParameterClientSerial(ParameterClient):
 
 
 class ParameterClientAsync(ParameterClient):
-    def __init__(self, param_server: ParameterServer, cfg, env_info, timing: Timing):
-        super().__init__(param_server, cfg, env_info, timing)
+    def __init__(self, param_server: ParameterServer, cfg, env_info, timing: Timing, client_idx: int = 0):
+        super().__init__(param_server, cfg, env_info, timing, client_idx)
         self._shared_model_weights = None
         self.num_policy_updates = 0
 
+        # with double-buffered weights, the tensors of the local model point at the slot of the shared weights
+        self._local_tensors: Optional[Dict[str, Tensor]] = None
+        self._slot: int = -1
+
     @property
     def actor_critic(self):
         assert self.latest_policy_version >= 0, "Trying to access actor critic before it is initialized"
         return self._actor_critic
 
     def _init_local_copy(self, device, cfg, obs_space, action_space):
-        self._actor_critic = create_actor_critic(cfg, obs_space, action_space)
+        num_costs = len(self.env_info.cost_channels)
+        self._actor_critic = create_actor_critic(cfg, obs_space, action_space, num_costs)
         self._actor_critic.model_to_device(device)
 
         for p in self._actor_critic.parameters():
@@ -118,6 +184,12 @@ class ParameterClientAsync(ParameterClient):
 
         self._init_local_copy(device, self.cfg, self.env_info.obs_space, self.env_info.action_space)
 
+        if isinstance(state_dict, SharedWeights):
+            self._shared_model_weights = state_dict
+            self._local_tensors = self._actor_critic.state_dict(keep_vars=True)
+            self._swap_to_active_slot()
+            return
+
         with self._policy_lock:
             if state_dict is None:
                 log.warning(f"Parameter client {self.policy_id} received empty state dict, using random weights...")
@@ -125,13 +197,31 @@ class ParameterClientAsync(ParameterClient):
                 self._actor_critic.load_state_dict(state_dict)
                 self._shared_model_weights = state_dict
 
+    def _swap_to_active_slot(self) -> int:
+        """Points the local model at the latest published weights, returns their policy version."""
+        shared_weights: SharedWeights = self._shared_model_weights
+        slot = shared_weights.acquire_active_slot(self.client_idx)
+        if slot != self._slot:
+            for key, t in shared_weights.slots[slot].items():
+                self._local_tensors[key].data = t
+            self._slot = slot
+        return int(shared_weights.slot_versions[slot])
+
     def ensure_weights_updated(self):
         server_policy_version = self._get_server_policy_version()
         if self.latest_policy_version < server_policy_version and self._shared_model_weights is not None:
-            with self.timing.time_avg("weight_update"), self._policy_lock:
-                self._actor_critic.load_state_dict(self._shared_model_weights)
-
-            self.latest_policy_version = server_policy_version
+            with self.timing.time_avg("weight_update"):
+                if self._local_tensors is not None:
+                    # the latest version might not be published yet if we held the slot the learner had to write
+                    policy_version = self._swap_to_active_slot()
+                else:
+                    with self._policy_lock:
+                        self._actor_critic.load_state_dict(self._shared_model_weights)
+                    policy_version = server_policy_version
+
+            if policy_version <= self.latest_policy_version:
+                return
+            self.latest_policy_version = policy_version
 
             self.num_policy_updates += 1
             if self.num_policy_updates % 10 == 0:
@@ -146,6 +236,7 @@ class ParameterClientAsync(ParameterClient):
         # TODO: fix termination problems related to shared CUDA tensors (they are harmless but annoying)
         weights = self._shared_model_weights
         del self._actor_critic
+        del self._local_tensors
         del self._shared_model_weights
         del self.policy_versions
 
@@ -156,7 +247,9 @@ class ParameterClientAsync(ParameterClient):
             log.debug(f"Weights refcount: {sys.getrefcount(weights)} {len(weights_referrers)}")
 
 
-def make_parameter_client(is_serial_mode, parameter_server, cfg, env_info, timing: Timing) -> ParameterClient:
+def make_parameter_client(
+    is_serial_mode, parameter_server, cfg, env_info, timing: Timing, client_idx: int = 0
+) -> ParameterClient:
     """Parameter client factory."""
     cls = ParameterClientSerial if is_serial_mode else ParameterClientAsync
-    return cls(parameter_server, cfg, env_info, timing)
+    return cls(parameter_server, cfg, env_info, timing, client_idx)
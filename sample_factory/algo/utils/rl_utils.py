@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-from typing import Dict, Optional, Sequence, Union
+from typing import Dict, Optional, Sequence, Tuple, Union
 
 import numpy as np
 import torch
@@ -94,6 +94,116 @@ def gae_advantages(rewards: Tensor, dones: Tensor, values: Tensor, valids: Tenso
     return advantages
 
 
+@torch.jit.script
+def discounted_sum_scan(x: Tensor, coeffs: Tensor, chunk_size: int) -> Tensor:
+    """
+    Solves the backward linear recurrence out[t] = x[t] + coeffs[t] * out[t+1] (with out[T] = 0) along the first
+    dimension with a chunked associative scan: a log-depth Hillis-Steele scan inside all chunks at once, followed by
+    a sequential pass that carries the result across chunks. This takes log2(chunk_size) + T / chunk_size
+    sequential steps instead of T, which pays off for long rollouts. coeffs must broadcast against x.
+    """
+    num_steps = x.shape[0]
+    num_chunks = (num_steps + chunk_size - 1) // chunk_size
+    padding = num_chunks * chunk_size - num_steps
+
+    # reverse time so that we can scan forward, padded steps come last in the scan order and never affect the result
+    b = x.flip(0)
+    a = coeffs.flip(0).expand_as(x)
+    if padding > 0:
+        b = torch.cat([b, b.new_zeros([padding] + b.shape[1:])])
+        a = torch.cat([a, a.new_zeros([padding] + a.shape[1:])])
+    b = b.reshape([num_chunks, chunk_size] + x.shape[1:])
+    a = a.reshape([num_chunks, chunk_size] + x.shape[1:])
+
+    # after the scan b[n, i] is the result of the chunk-local recurrence and a[n, i] the coefficient of the carry
+    offset = 1
+    while offset < chunk_size:
+        b = torch.cat([b[:, :offset], b[:, offset:] + a[:, offset:] * b[:, :-offset]], dim=1)
+        a = torch.cat([a[:, :offset], a[:, offset:] * a[:, :-offset]], dim=1)
+        offset *= 2
+
+    out = torch.empty_like(b)
+    carry = b[0, 0].clone().fill_(0.0)
+    for n in range(num_chunks):
+        out[n] = b[n] + a[n] * carry
+        carry = out[n, -1]
+
+    return out.reshape([num_chunks * chunk_size] + x.shape[1:])[:num_steps].flip(0)
+
+
+# noinspection NonAsciiCharacters
+@torch.jit.script
+def multi_stream_gae(
+    rewards: Tensor, dones: Tensor, values: Tensor, valids: Tensor, γ: float, λ: float, chunk_size: int = 0
+) -> Tuple[Tensor, Tensor]:
+    """
+    GAE advantages and returns of S reward streams (i.e. rewards and costs) that share the episode boundaries,
+    computed in a single backward pass over the trajectories instead of one pass per stream.
+    rewards: [S, E, T], dones: [E, T], values: [S, E, T+1], valids: [E, T+1]
+    With chunk_size > 0 the chunked associative scan is used instead of a sequential loop over T.
+    :return: advantages and returns (not normalized), both [S, E, T]
+    """
+    rewards = rewards.permute(2, 0, 1)  # [S, E, T] -> [T, S, E]
+    values = values.permute(2, 0, 1)  # [S, E, T+1] -> [T+1, S, E]
+    dones = dones.transpose(0, 1).float().unsqueeze(1)  # [E, T] -> [T, 1, E]
+    valids = valids.transpose(0, 1).float().unsqueeze(1)  # [E, T+1] -> [T+1, 1, E]
+
+    assert len(rewards) == len(dones)
+    assert len(rewards) + 1 == len(values)
+
+    deltas = (rewards - values[:-1]) * valids[:-1] + (1 - dones) * (γ * values[1:] * valids[1:])
+    deltas = deltas.contiguous()
+
+    if chunk_size > 0:
+        # same recurrence as calculate_discounted_sum_torch(), invalid steps are not discounted
+        discount = γ * λ
+        coeffs = (discount * valids[:-1] + (1 - valids[:-1])) * (1.0 - dones)
+        advantages = discounted_sum_scan(deltas, coeffs, chunk_size)
+    else:
+        advantages = calculate_discounted_sum_torch(deltas, dones, valids[:-1], γ * λ)
+
+    returns = advantages + valids[:-1] * values[:-1]
+
+    # back to [S, E, T], so that every stream is a contiguous [E, T] buffer
+    return advantages.permute(1, 2, 0).contiguous(), returns.permute(1, 2, 0).contiguous()
+
+
+# noinspection NonAsciiCharacters
+@torch.jit.script
+def multi_stream_vtrace(
+    ratios: Tensor, rewards: Tensor, dones: Tensor, values: Tensor, γ: float, rho_hat: float, c_hat: float
+) -> Tuple[Tensor, Tensor]:
+    """
+    V-trace value targets and advantages of S reward streams that share the importance sampling ratios,
+    computed in a single backward pass over trajectories of length R.
+    ratios: [N, R], dones: [N, R], rewards: [S, N, R], values: [S, N, R]
+    :return: value targets and advantages, both [S, N, R]
+    """
+    vtrace_rho = torch.clamp_max(ratios, rho_hat).transpose(0, 1).unsqueeze(1)  # [N, R] -> [R, 1, N]
+    vtrace_c = torch.clamp_max(ratios, c_hat).transpose(0, 1).unsqueeze(1)
+    not_done_gamma = (1.0 - dones.transpose(0, 1).unsqueeze(1)) * γ
+    rewards = rewards.permute(2, 0, 1)  # [S, N, R] -> [R, S, N]
+    values = values.permute(2, 0, 1)
+
+    vs = torch.zeros_like(values)
+    adv = torch.zeros_like(values)
+
+    next_values = (values[-1] - rewards[-1]) / γ
+    next_vs = next_values
+
+    i = len(values) - 1
+    while i >= 0:
+        curr_values = values[i]
+        delta_s = vtrace_rho[i] * (rewards[i] + not_done_gamma[i] * next_values - curr_values)
+        adv[i] = vtrace_rho[i] * (rewards[i] + not_done_gamma[i] * next_vs - curr_values)
+        next_vs = curr_values + delta_s + not_done_gamma[i] * vtrace_c[i] * (next_vs - next_values)
+        vs[i] = next_vs
+        next_values = curr_values
+        i -= 1
+
+    return vs.permute(1, 2, 0), adv.permute(1, 2, 0)
+
+
 DonesType = Union[bool, np.ndarray, Tensor, Sequence[bool]]
 
 
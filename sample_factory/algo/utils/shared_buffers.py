@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 import math
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import torch
 from gymnasium import spaces
@@ -10,7 +10,13 @@ from torch import Tensor
 
 from sample_factory.algo.sampling.sampling_utils import rollout_worker_device
 from sample_factory.algo.utils.action_distributions import calc_num_action_parameters, calc_num_actions
-from sample_factory.algo.utils.env_info import EnvInfo
+from sample_factory.algo.utils.env_info import EnvInfo, cost_shape, cost_stat_keys
+from sample_factory.algo.utils.episodic_stats import (
+    CORE_EPISODIC_STAT_KEYS,
+    EPISODIC_STATS_CAPACITY,
+    SharedEpisodicStats,
+)
+from sample_factory.algo.utils.heatmaps import SharedHeatmaps
 from sample_factory.algo.utils.misc import MAGIC_FLOAT, MAGIC_INT
 from sample_factory.algo.utils.rl_utils import trajectories_per_training_iteration
 from sample_factory.algo.utils.tensor_dict import TensorDict
@@ -32,6 +38,12 @@ def policy_device(cfg: AttrDict, policy_id: PolicyID) -> torch.device:
         return torch.device("cuda", index=gpus_for_process(policy_id, 1)[0])
 
 
+def zero_copy_batches(cfg: AttrDict, sampling_device: Device, policy_id: PolicyID) -> bool:
+    """Whether the learner of the policy trains directly on the trajectory buffers of the sampling device."""
+    zero_copy = "zero_copy_batches" in cfg and cfg.zero_copy_batches
+    return zero_copy and str(sampling_device) == str(policy_device(cfg, policy_id))
+
+
 def init_tensor(leading_dimensions: List, tensor_type, tensor_shape, device: torch.device, share: bool) -> Tensor:
     if not isinstance(tensor_type, torch.dtype):
         tensor_type = to_torch_dtype(tensor_type)
@@ -64,7 +76,9 @@ def action_info(env_info: EnvInfo) -> Tuple[int, int]:
     return num_actions, num_action_distribution_parameters
 
 
-def policy_output_shapes(algo: str, num_actions, num_action_distribution_parameters) -> List[Tuple[str, List]]:
+def policy_output_shapes(
+    algo: str, num_actions, num_action_distribution_parameters, costs_shape: Optional[List[int]] = None
+) -> List[Tuple[str, List]]:
     # policy outputs, this matches the expected output of the actor-critic
     policy_outputs = [
         ("actions", [num_actions]),
@@ -74,7 +88,8 @@ def policy_output_shapes(algo: str, num_actions, num_action_distribution_paramet
         ("policy_version", []),
     ]
     if algo in ['PPOLag', 'TRPOLag', 'TRPOPID', 'PPOPID', 'CPO', 'P3O']:
-        policy_outputs += [("cost_values", [])]  # cost values are only given in safe RL methods
+        # cost values are only given in safe RL methods, one per constraint channel
+        policy_outputs += [("cost_values", costs_shape or [])]
     return policy_outputs
 
 
@@ -94,7 +109,7 @@ def alloc_trajectory_tensors(algo: str, env_info: EnvInfo, num_traj, rollout, rn
     tensors["rnn_states"] = init_tensor([num_traj, rollout + 1], torch.float32, [rnn_size], device, share)
 
     num_actions, num_action_distribution_parameters = action_info(env_info)
-    policy_outputs = policy_output_shapes(algo, num_actions, num_action_distribution_parameters)
+    policy_outputs = policy_output_shapes(algo, num_actions, num_action_distribution_parameters, cost_shape(env_info))
 
     # we need one more step to hold values for the last step
     outputs_with_extra_rollout_step = ["values", "cost_values"]
@@ -107,7 +122,7 @@ def alloc_trajectory_tensors(algo: str, env_info: EnvInfo, num_traj, rollout, rn
     # env outputs
     tensors["rewards"] = init_tensor([num_traj, rollout], torch.float32, [], device, share)
     tensors["rewards"].fill_(-42.42)  # if we're using uninitialized values by mistake it will be obvious
-    tensors["costs"] = init_tensor([num_traj, rollout], torch.float32, [], device, share)
+    tensors["costs"] = init_tensor([num_traj, rollout], torch.float32, cost_shape(env_info), device, share)
     tensors["costs"].fill_(-42.42)  # if we're using uninitialized values by mistake it will be obvious
     tensors["dones"] = init_tensor([num_traj, rollout], torch.bool, [], device, share)
     tensors["dones"].fill_(True)
@@ -132,7 +147,9 @@ def alloc_policy_output_tensors(cfg, env_info: EnvInfo, rnn_size, device, share)
         policy_outputs_shape += [envs_per_split, num_agents]
 
     num_actions, num_action_distribution_parameters = action_info(env_info)
-    policy_outputs = policy_output_shapes(cfg.algo, num_actions, num_action_distribution_parameters)
+    policy_outputs = policy_output_shapes(
+        cfg.algo, num_actions, num_action_distribution_parameters, cost_shape(env_info)
+    )
     policy_outputs += [("new_rnn_states", [rnn_size])]  # different name so we don't override current step rnn_state
 
     output_names, output_shapes = list(zip(*policy_outputs))
@@ -153,8 +170,36 @@ def alloc_policy_output_tensors(cfg, env_info: EnvInfo, rnn_size, device, share)
     return policy_output_tensors, output_names, output_sizes
 
 
+# columns of the index rows that rollout workers publish to request actions in non-batched sampling
+REQUEST_WORKER_IDX, REQUEST_SPLIT_IDX, REQUEST_ENV_IDX, REQUEST_AGENT_IDX = 0, 1, 2, 3
+REQUEST_TRAJ_IDX, REQUEST_ROLLOUT_STEP = 4, 5
+REQUEST_ROW_SIZE = 6
+
+
+def alloc_policy_request_tensors(cfg, env_info: EnvInfo, share: bool) -> Tensor:
+    """
+    Shared inference requests for non-batched sampling. Every env runner (worker_idx, split_idx) owns a slot of int32
+    index rows, one per actor. It writes the rows of the actors that need actions grouped by policy, and only sends
+    the offset and the number of rows through the inference queues. Policy workers then gather the inputs and scatter
+    the outputs with a single indexing op. An env runner has at most one request in flight (it steps the envs only
+    after all policies responded), so a slot is never overwritten while a policy worker still reads it.
+    Worker and split indices never change, so we fill them in right away.
+    """
+    envs_per_split = cfg.num_envs_per_worker // cfg.worker_num_splits
+    rows = init_tensor(
+        [cfg.num_workers, cfg.worker_num_splits, envs_per_split * env_info.num_agents],
+        torch.int32,
+        [REQUEST_ROW_SIZE],
+        "cpu",
+        share,
+    )
+    rows[..., REQUEST_WORKER_IDX] = torch.arange(cfg.num_workers, dtype=torch.int32).view(-1, 1, 1)
+    rows[..., REQUEST_SPLIT_IDX] = torch.arange(cfg.worker_num_splits, dtype=torch.int32).view(1, -1, 1)
+    return rows
+
+
 class BufferMgr(Configurable):
-    def __init__(self, cfg, env_info: EnvInfo):
+    def __init__(self, cfg, env_info: EnvInfo, shared_episodic_stats: bool = False):
         super().__init__(cfg)
         self.env_info = env_info
 
@@ -214,6 +259,12 @@ class BufferMgr(Configurable):
                 self.max_batches_to_accumulate * self.trajectories_per_training_iteration * cfg.num_policies,
             )
 
+            if cfg.async_rl:
+                # learners that read the accumulated batches in place hold on to these trajectories while training,
+                # so the samplers need buffers on top of them
+                num_in_place = sum(zero_copy_batches(cfg, device, policy_id) for policy_id in range(cfg.num_policies))
+                num_buffers += num_in_place * self.max_batches_to_accumulate * self.trajectories_per_training_iteration
+
             self.traj_buffer_queues[device] = get_queue(cfg.serial_mode)
 
             self.traj_tensors_torch[device] = alloc_trajectory_tensors(
@@ -239,6 +290,24 @@ class BufferMgr(Configurable):
                 for i in range(num_buffers):
                     self.traj_buffer_queues[device].put(i)
 
+        # non-batched sampling: index rows of the actors that need actions, always on cpu
+        self.policy_request_tensors: Optional[Tensor] = None
+        if not cfg.batched_sampling:
+            self.policy_request_tensors = alloc_policy_request_tensors(cfg, env_info, share)
+
         self.policy_versions = torch.zeros([cfg.num_policies], dtype=torch.int32)
         if share:
             self.policy_versions.share_memory_()
+
+        # positional visitation counts, accumulated by the rollout workers at the episode boundaries
+        self.heatmaps = None
+        if env_info.heatmap_shape is not None and cfg.with_wandb and cfg.log_heatmap:
+            num_actors = cfg.num_workers * cfg.num_envs_per_worker * env_info.num_agents
+            self.heatmaps = SharedHeatmaps(cfg.num_policies, num_actors, env_info.heatmap_shape, share)
+
+        # episodic stats with a fixed schema, written by the rollout workers at the episode boundaries
+        self.episodic_stats = None
+        if shared_episodic_stats:
+            num_actors = cfg.num_workers * cfg.num_envs_per_worker * env_info.num_agents
+            keys = CORE_EPISODIC_STAT_KEYS + cost_stat_keys(env_info) + env_info.episode_stat_keys
+            self.episodic_stats = SharedEpisodicStats(num_actors, keys, EPISODIC_STATS_CAPACITY, share)
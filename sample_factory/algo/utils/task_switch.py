@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import math
+from typing import Any, Dict, List, Optional, Tuple
+
+
+def task_for_split(training_info: Dict[str, Any], worker_idx: int, split_idx: int, num_splits: int) -> Optional[int]:
+    """
+    Continual learning task that the given split of a rollout worker should be running, according to the training info
+    broadcast by the runner. Splits that belong to a wave which is not released yet keep running the task they ran
+    before the switch.
+    """
+    task = training_info.get("current_env_id")
+    num_waves = training_info.get("task_switch_waves", 1)
+    if task is None or num_waves <= 1:
+        return task
+
+    wave = (worker_idx * num_splits + split_idx) % num_waves
+    return task if wave < training_info["task_switch_waves_released"] else training_info["prev_env_ids"][wave]
+
+
+class TaskSwitchScheduler:
+    """
+    Rolls a continual learning task switch across the rollout workers in waves instead of switching everyone at once.
+    Every (worker, split) pair belongs to one of `num_waves` waves, wave i + 1 is released `wave_interval_sec` seconds
+    after wave i. For every wave we measure the sampling throughput until the next wave is released and compare it
+    to the throughput right before the switch.
+
+    A switch can start while the previous one is still being rolled out. The waves that were not released yet then
+    keep running the task before the previous switch until they are released, so we track the previous task per wave.
+    """
+
+    def __init__(self, num_waves: int, wave_interval_sec: float):
+        self.num_waves = max(num_waves, 1)
+        self.wave_interval_sec = wave_interval_sec
+
+        self.task = 0
+        self.prev_tasks = [0] * self.num_waves
+        self.waves_released = self.num_waves
+
+        self._baseline_fps = math.nan
+        self._wave_start: Optional[Tuple[float, int]] = None  # (time, env_steps) at which the measured wave started
+
+    @property
+    def in_progress(self) -> bool:
+        return self._wave_start is not None
+
+    def start_switch(self, new_task: int, now: float, env_steps: int, baseline_fps: float) -> None:
+        # the task every wave is actually running right now, the unreleased waves of an ongoing switch are still on
+        # their previous task
+        self.prev_tasks = [self.task_of_wave(wave) for wave in range(self.num_waves)]
+        self.task = new_task
+        self.waves_released = 1
+        self._baseline_fps = baseline_fps
+        self._wave_start = (now, env_steps)
+
+    def task_of_wave(self, wave: int) -> int:
+        return self.task if wave < self.waves_released else self.prev_tasks[wave]
+
+    def update(self, now: float, env_steps: int) -> List[Tuple[int, float, float]]:
+        """
+        Release the next wave once the current one has run for long enough.
+        :return: (wave index, wave fps, relative fps dip) for every wave measured since the previous call
+        """
+        if self._wave_start is None or now - self._wave_start[0] < self.wave_interval_sec:
+            return []
+
+        wave_start_time, wave_start_steps = self._wave_start
+        wave_fps = (env_steps - wave_start_steps) / (now - wave_start_time)
+        fps_dip = 1.0 - wave_fps / self._baseline_fps if self._baseline_fps > 0 else math.nan
+        measured = [(self.waves_released - 1, wave_fps, fps_dip)]
+
+        if self.waves_released < self.num_waves:
+            self.waves_released += 1
+            self._wave_start = (now, env_steps)
+        else:
+            # the last wave was measured as well, the switch is complete
+            self._wave_start = None
+
+        return measured
+
+    def training_info(self) -> Dict[str, Any]:
+        return dict(
+            current_env_id=self.task,
+            prev_env_ids=list(self.prev_tasks),
+            task_switch_waves=self.num_waves,
+            task_switch_waves_released=self.waves_released,
+        )
@@ -98,6 +98,23 @@ def add_rl_args(p: ArgumentParser):
         "are processed. Set this parameter to 1 to further reduce policy-lag. "
         "If the experience collection is very non-uniform, increasing this parameter can increase overall throughput, at the cost of increased policy-lag.",
     )
+    p.add_argument(
+        "--zero_copy_batches",
+        default=False,
+        type=str2bool,
+        help="Let the learner train directly on the shared trajectory buffers instead of copying every training batch "
+        "into a separate buffer. This applies when the trajectories of a batch form a single contiguous slice on the "
+        "learner device (e.g. CPU training or GPU sampling), fragmented batches are still copied. The trajectories are "
+        "then held until the learner is done with them, so in async mode extra trajectory buffers are allocated.",
+    )
+    p.add_argument(
+        "--prefetch_batches",
+        default=False,
+        type=str2bool,
+        help="With trajectories sampled on the CPU and a GPU learner, gather training batches in pinned host memory "
+        "and upload them on a separate CUDA stream, so that the upload of the next batch overlaps with training on the "
+        "current one. Has no effect when the learner is on the CPU.",
+    )
     p.add_argument(
         "--worker_num_splits",
         default=2,
@@ -111,6 +128,33 @@ def add_rl_args(p: ArgumentParser):
         type=int,
         help="Number of policy workers that compute forward pass (per policy)",
     )
+    p.add_argument(
+        "--inference_batching",
+        default="fixed",
+        choices=["fixed", "adaptive"],
+        type=str,
+        help="How long policy workers wait for more inference requests before the forward pass. fixed: at most 25 ms "
+        "for a number of requests that depends on the number of rollout workers. adaptive: tune the wait window and "
+        "the target batch size online from the measured cost of the forward pass and the rate at which requests "
+        "arrive, so that the p99 latency of the requests stays within --inference_latency_target_ms.",
+    )
+    p.add_argument(
+        "--inference_latency_target_ms",
+        default=25.0,
+        type=float,
+        help="p99 latency target of inference requests with --inference_batching=adaptive, i.e. the time from the "
+        "policy worker receiving a request from a rollout worker until the actions are sent back. The time the request "
+        "waits in the queue before it is received is not included (reported as inference_worker_latency_p99_ms).",
+    )
+    p.add_argument(
+        "--double_buffered_weights",
+        default=False,
+        type=str2bool,
+        help="Publish the policy weights to the policy workers through a double-buffered, versioned copy instead of "
+        "having the policy workers copy the whole state dict under the policy lock that the learner also holds. "
+        "The policy workers switch to the latest published weights without locking or copying, at the cost of two "
+        "extra copies of the weights in (shared) memory.",
+    )
     p.add_argument(
         "--max_policy_lag",
         default=1000,
@@ -388,6 +432,13 @@ def add_rl_args(p: ArgumentParser):
         type=float,
         help="Generalized Advantage Estimation discounting (only used when V-trace is False)",
     )
+    p.add_argument(
+        "--gae_scan_chunk_size",
+        default=0,
+        type=int,
+        help="If > 0, the advantages are computed with a chunked associative scan over time (with chunks of this "
+        "many steps) instead of a sequential loop over the rollout. Helps with long rollouts and with small batches",
+    )
     p.add_argument(
         "--ppo_clip_ratio",
         default=0.1,
@@ -447,6 +498,14 @@ def add_rl_args(p: ArgumentParser):
         type=float,
         help="Damping coefficient for the Fisher vector product to improve numerical stability."
     )
+    p.add_argument(
+        "--fvp_subsample",
+        default=1.0,
+        type=float,
+        help="Fraction of the minibatch trajectories the Fisher vector products are estimated on (TRPO/CPO). "
+             "Values below 1 cost an extra forward pass of the policy on the subset, but make every conjugate "
+             "gradient iteration proportionally cheaper."
+    )
 
     # Line Search Parameters
     p.add_argument(
@@ -467,6 +526,16 @@ def add_rl_args(p: ArgumentParser):
         type=float,
         help="Improvement ratio threshold for accepting a step during line search."
     )
+    p.add_argument(
+        "--line_search_mode",
+        default="sequential",
+        choices=["sequential", "batched"],
+        type=str,
+        help="How TRPO and CPO evaluate the backtracking steps of the line search. sequential: one step at a time "
+             "until one is accepted, with a host sync per step. batched: all steps up front (in a single vmapped "
+             "forward pass for feed-forward policies) and a single host sync, so the update latency doesn't grow "
+             "with the number of backtracks, at the price of evaluating steps that wouldn't be needed."
+    )
 
 
     # optimization
@@ -485,6 +554,16 @@ def add_rl_args(p: ArgumentParser):
         type=float,
         help="Max L2 norm of the gradient vector, set to 0 to disable gradient clipping",
     )
+    p.add_argument(
+        "--compile_train_step",
+        default="off",
+        choices=["off", "default", "reduce-overhead", "max-autotune"],
+        type=str,
+        help="Compile the minibatch forward pass of the PPO-style learners with torch.compile in the given mode "
+             "(reduce-overhead also captures it in CUDA graphs). Only for feed-forward policies, RNN policies always "
+             "run in eager mode. With compilation enabled the training loop also stops reading the loss and "
+             "KL-divergence of every minibatch back to the host, the sanity checks run once per epoch instead.",
+    )
 
     # learning rate
     p.add_argument("--learning_rate", default=1e-4, type=float, help="LR")
@@ -621,7 +700,17 @@ def add_rl_args(p: ArgumentParser):
         "--heatmap_avg",
         default=1000,
         type=int,
-        help="How many episodes of agent trajectories to average for plotting the location heatmap",
+        help="Deprecated, has no effect. Heatmaps average over all episodes finished since the previous heatmap was "
+             "logged",
+    )
+    p.add_argument(
+        "--shared_episodic_stats",
+        default=False,
+        type=str2bool,
+        help="Rollout workers write the episodic stats declared by the env into ring buffers in shared memory that "
+             "the runner drains periodically and passes to the episodic stats handlers, instead of sending every episode "
+             "as a pickled report. Stats outside of this schema are still sent as reports. "
+             "Off by default, every episode is then sent as a report through the queues",
     )
     p.add_argument(
         "--summaries_use_frameskip",
@@ -661,6 +750,29 @@ def add_rl_args(p: ArgumentParser):
         help="Used in continual learning setting. Number of env_steps per environment, before switching to the next environment."
              "If set to -1, the environment will be switched after ceil(train_for_env_steps / len(envs)) steps."
     )
+    p.add_argument(
+        "--continual_env_pool_size",
+        default=0,
+        type=int,
+        help="Used in continual learning setting. Number of upcoming tasks for which each env keeps an initialized game "
+             "in a pool (refilled in a background thread), so that switching tasks does not stall sampling. "
+             "Every pooled game is a separate ViZDoom process, i.e. 1 doubles the number of games per env. "
+             "By default (0) the next env is created at the switch.",
+    )
+    p.add_argument(
+        "--task_switch_waves",
+        default=1,
+        type=int,
+        help="Used in continual learning setting. Number of waves in which a task switch is rolled out across the "
+             "rollout worker splits, so that not all envs rebuild at the same time. 1 switches all workers at once.",
+    )
+    p.add_argument(
+        "--task_switch_wave_interval_sec",
+        default=10.0,
+        type=float,
+        help="Used in continual learning setting. Seconds between two consecutive waves of a staggered task switch. "
+             "The sampling throughput of every wave is reported relative to the throughput before the switch.",
+    )
 
     # model saving
     p.add_argument("--save_models", default=False, type=str2bool, help="Whether to save policy checkpoints")
@@ -1057,6 +1169,32 @@ def add_logging_args(p: ArgumentParser):
         type=int,
         help="Duration of the heatmap evolution gif",
     )
+    p.add_argument(
+        "--learner_diagnostics",
+        default=[],
+        type=str,
+        nargs="*",
+        choices=["graph", "snapshot", "anomaly"],
+        help="Learner diagnostics to collect at the points of interest of the loss computation (currently the critic "
+             "update of CPO). graph: render the autograd graphs with torchviz, snapshot: save the tensors, anomaly: "
+             "warn about non-finite values (one device sync per check). Artifacts are written in the background to "
+             "<experiment dir>/diagnostics",
+    )
+    p.add_argument(
+        "--diagnostics_trigger",
+        default="startup",
+        choices=["startup", "interval", "nan"],
+        type=str,
+        help="When the graph and snapshot diagnostics are collected. startup: in the first training iteration, "
+             "interval: every --diagnostics_interval training iterations, nan: whenever the diagnosed tensors contain "
+             "non-finite values",
+    )
+    p.add_argument(
+        "--diagnostics_interval",
+        default=1000,
+        type=int,
+        help="Training iterations between diagnostics with --diagnostics_trigger=interval",
+    )
 
 
 
@@ -0,0 +1,294 @@
+from __future__ import annotations
+
+from typing import List, Optional
+
+import cv2
+import gymnasium as gym
+import numpy as np
+import torch
+from vizdoom import GameVariable
+
+from sample_factory.algo.utils.spaces.discretized import Discretized
+from sample_factory.doom.env.batched_scenarios import SCENARIO_FUNCTIONS, ScenarioFunction
+from sample_factory.doom.env.doom_gym import VizdoomEnv
+from sample_factory.doom.env.doom_utils import make_vizdoom_env
+from sample_factory.doom.env.wrappers.observation_space import SetResolutionWrapper
+from sample_factory.utils.attr_dict import AttrDict
+from sample_factory.utils.utils import log
+
+# some variables don't get reset to zero on game.new_episode(), see VizdoomEnv._vizdoom_variables_bug_workaround()
+BUGGED_VARIABLES = ("DEATHCOUNT", "HITCOUNT", "DAMAGECOUNT")
+
+
+def action_lookup_tables(action_space: gym.Space) -> Optional[List[np.ndarray]]:
+    """
+    For every (discrete or discretized) action subspace a table that maps the action index to the Doom buttons,
+    the equivalent of VizdoomEnv._convert_actions() for a whole batch of actions.
+    :return: None if any of the subspaces is continuous
+    """
+    spaces = action_space.spaces if hasattr(action_space, "spaces") else (action_space,)
+
+    tables = []
+    for space in spaces:
+        # Discretized is a subclass of Discrete, the order of the checks matters
+        if isinstance(space, Discretized):
+            tables.append(np.array([[space.to_continuous(a)] for a in range(space.n)], dtype=np.float64))
+        elif isinstance(space, gym.spaces.Discrete):
+            # 0th action in each subspace is a no-op
+            tables.append(np.eye(space.n, dtype=np.float64)[:, 1:])
+        else:
+            return None
+
+    return tables
+
+
+class DoomBatchedEnv(gym.Env):
+    """
+    Steps a batch of Doom games of the same scenario and exposes the results as preallocated [num_envs, ...] arrays.
+
+    This replaces the per-game wrapper stack of make_doom_env_impl() on the batched sampling path: observations are
+    resized straight into the batch, game variables of all games are gathered in one array and the scenario reward
+    and cost functions (see batched_scenarios.py) run as array ops over the whole batch. Games are auto-reset at the
+    end of the episode. Every game is a separate agent of this multi-agent env.
+    """
+
+    def __init__(
+        self,
+        envs: List[VizdoomEnv],
+        scenario: ScenarioFunction,
+        res_w: int,
+        res_h: int,
+        pixel_format: str = "HWC",
+        time_limit: int = -1,
+        reward_scaling: float = 1.0,
+        penalty_scaling: Optional[float] = None,
+        area_pooling: bool = False,
+    ):
+        self.envs = envs
+        self.games = []
+        self.scenario = scenario
+
+        self.num_agents = len(envs)
+        self.is_multiagent = True
+
+        env = envs[0]
+        self.name = env.name
+        self.safety_bound = env.safety_bound
+        self.cost_channels = env.cost_channels
+        self.channel_safety_bounds = env.channel_safety_bounds
+        self.timeout = env.timeout
+        self.skip_frames = env.skip_frames
+        self.time_limit = time_limit
+        self.reward_scaling = reward_scaling
+        self.penalty_scaling = penalty_scaling
+
+        self.action_space = env.action_space
+        self._action_tables = action_lookup_tables(self.action_space)
+
+        n = self.num_agents
+        self._res = (res_w, res_h)
+        self._resize = (env.screen_w, env.screen_h) != self._res
+        self._interpolation = cv2.INTER_AREA if area_pooling else cv2.INTER_NEAREST
+        self._obs_hwc = np.zeros((n, res_h, res_w, env.channels), dtype=np.uint8)
+        self._chw = pixel_format == "CHW"
+        self.obs = np.ascontiguousarray(self._obs_hwc.transpose(0, 3, 1, 2)) if self._chw else self._obs_hwc
+        self.observation_space = gym.spaces.Dict(
+            obs=gym.spaces.Box(0, 255, self.obs.shape[1:], dtype=np.uint8),
+        )
+
+        # game variables in the order of the scenario config file, plus the ones the scenario needs on top of those
+        self._variable_names = sorted(env.variable_indices, key=env.variable_indices.get)
+        self._num_state_variables = len(self._variable_names)
+        self._variable_names += [v for v in scenario.variables if v not in env.variable_indices]
+        self._variables = [getattr(GameVariable, v) for v in self._variable_names]
+        self._scenario_columns = [self._variable_names.index(v) for v in scenario.variables]
+        self._bugged_columns = [i for i, v in enumerate(self._variable_names) if v in BUGGED_VARIABLES]
+
+        self._raw_variables = np.zeros((n, len(self._variable_names)), dtype=np.float64)
+        self._variable_offsets = np.zeros_like(self._raw_variables)
+        self.game_variables = np.zeros_like(self._raw_variables)
+
+        self.rewards = np.zeros(n, dtype=np.float32)
+        self.costs = np.zeros(n, dtype=np.float32)
+        self.true_objective = np.zeros(n, dtype=np.float32)
+        self.terminated = np.zeros(n, dtype=bool)
+        self.truncated = np.zeros(n, dtype=bool)
+        self.episode_frames = np.zeros(n, dtype=np.int64)
+
+        # infos are the same tensors every step, sharing memory with the arrays above
+        self.infos = dict(
+            cost=torch.from_numpy(self.costs),
+            true_objective=torch.from_numpy(self.true_objective),
+            episode_extra_stats={key: torch.from_numpy(value) for key, value in scenario.stats.items()},
+        )
+        if len(self.cost_channels) > 1:
+            # [num_envs, num_channels] costs of the hazards of the scenario
+            self.infos["costs"] = torch.from_numpy(scenario.channel_costs)
+
+    @property
+    def heatmap_shape(self):
+        return None
+
+    @property
+    def episode_stat_keys(self):
+        return self.scenario.stat_keys
+
+    def _read_variables(self, i: int, state) -> None:
+        game, first_queried = self.games[i], self._num_state_variables
+        if state is not None:
+            self._raw_variables[i, :first_queried] = state.game_variables
+        else:
+            # when the episode is finished there is no state, but the game still reports the final values
+            first_queried = 0
+
+        for j in range(first_queried, len(self._variables)):
+            self._raw_variables[i, j] = game.get_game_variable(self._variables[j])
+
+    def _write_obs(self, i: int, state) -> None:
+        screen = self.envs[i]._get_obs_from_state(state)
+        if self._resize:
+            cv2.resize(screen, self._res, dst=self._obs_hwc[i], interpolation=self._interpolation)
+        else:
+            self._obs_hwc[i] = screen
+
+    def _convert_actions(self, actions) -> List[list]:
+        if self._action_tables is None:
+            return [env._convert_actions(env_actions) for env, env_actions in zip(self.envs, actions)]
+
+        actions = np.asarray(actions).reshape(self.num_agents, -1)
+        buttons = np.concatenate([table[actions[:, k]] for k, table in enumerate(self._action_tables)], axis=1)
+        return buttons.tolist()
+
+    def _new_episodes(self, env_indices: np.ndarray) -> None:
+        env_mask = np.zeros(self.num_agents, dtype=bool)
+        env_mask[env_indices] = True
+
+        self._variable_offsets[np.ix_(env_indices, self._bugged_columns)] = self._raw_variables[
+            np.ix_(env_indices, self._bugged_columns)
+        ]
+
+        for i in env_indices:
+            game = self.games[i]
+            game.new_episode()
+            state = game.get_state()
+            self._write_obs(i, state)
+            self._read_variables(i, state)
+
+        self.episode_frames[env_mask] = 0
+        np.subtract(self._raw_variables, self._variable_offsets, out=self.game_variables)
+        self.scenario.reset(env_mask, self.game_variables[:, self._scenario_columns])
+
+    def _finalize_obs(self):
+        if self._chw:
+            np.copyto(self.obs, self._obs_hwc.transpose(0, 3, 1, 2))
+        return dict(obs=self.obs)
+
+    def reset(self, **kwargs):
+        seed = kwargs.get("seed")
+        if seed is not None:
+            # every game gets the seed it would have gotten as an individual env
+            for i, env in enumerate(self.envs):
+                env.seed(seed + i)
+
+        if not self.games:
+            for i, env in enumerate(self.envs):
+                env._ensure_initialized()  # starts the first episode
+                state = env.game.get_state()
+                self.games.append(env.game)
+                self._write_obs(i, state)
+                self._read_variables(i, state)
+
+            np.subtract(self._raw_variables, self._variable_offsets, out=self.game_variables)
+            self.scenario.reset(np.ones(self.num_agents, dtype=bool), self.game_variables[:, self._scenario_columns])
+        else:
+            self._new_episodes(np.arange(self.num_agents))
+
+        return self._finalize_obs(), dict()
+
+    def step(self, actions):
+        buttons = self._convert_actions(actions)
+
+        for i, game in enumerate(self.games):
+            self.rewards[i] = game.make_action(buttons[i], self.skip_frames)
+            terminated = game.is_episode_finished()
+            self.terminated[i] = terminated
+            if terminated:
+                self._read_variables(i, None)
+            else:
+                # observations of finished games are replaced with the first frame of the next episode below
+                state = game.get_state()
+                self._write_obs(i, state)
+                self._read_variables(i, state)
+            # like VizdoomEnv, games that end on their own timeout are both terminated and truncated
+            self.truncated[i] = game.get_episode_time() > self.timeout
+
+        self.episode_frames += self.skip_frames
+        if self.time_limit > 0:
+            self.truncated |= ~self.terminated & (self.episode_frames >= self.time_limit)
+
+        np.subtract(self._raw_variables, self._variable_offsets, out=self.game_variables)
+        self.scenario.step(
+            self.game_variables[:, self._scenario_columns],
+            self.terminated,
+            self.rewards,
+            self.costs,
+            self.true_objective,
+        )
+        if self.reward_scaling != 1.0:
+            self.rewards *= self.reward_scaling
+        if self.penalty_scaling is not None:
+            self.rewards -= self.costs * self.penalty_scaling
+
+        dones = self.terminated | self.truncated
+        if dones.any():
+            self._new_episodes(np.flatnonzero(dones))
+
+        return self._finalize_obs(), self.rewards, self.terminated, self.truncated, self.infos
+
+    def close(self):
+        for env in self.envs:
+            env.close()
+
+
+def make_doom_env_batched(doom_spec, cfg, env_configs: List[AttrDict]) -> Optional[DoomBatchedEnv]:
+    """
+    Batched counterpart of make_doom_env_impl(), registered with register_batched_env().
+    Returns None for configurations that need the per-game wrappers, so that the rollout workers fall back to them.
+    """
+    scenario_cls = SCENARIO_FUNCTIONS.get(doom_spec.name)
+    unsupported = []
+    if scenario_cls is None:
+        unsupported.append(f"no vectorized reward/cost function for {doom_spec.name}")
+    if cfg.record or cfg.use_depth_buffer:
+        unsupported.append("video recording and depth buffer observations")
+    if cfg.algo == "PPOSaute":
+        unsupported.append("Saute state augmentation")
+    if unsupported:
+        log.warning("Batched Doom env does not support %s, using individual envs", ", ".join(unsupported))
+        return None
+
+    envs = []
+    for _ in env_configs:
+        env, resolution = make_vizdoom_env(doom_spec, cfg)
+        SetResolutionWrapper(env, resolution)  # only sets the native resolution of the game, we don't keep the wrapper
+        envs.append(env)
+
+    time_limit = doom_spec.default_timeout
+    if cfg.episode_horizon is not None and cfg.episode_horizon > 0:
+        time_limit = cfg.episode_horizon
+
+    penalty_scaling = None
+    if cfg.algo == "PPOCost":
+        penalty_scaling = cfg.penalty_scaling if cfg.penalty_scaling else doom_spec.penalty_scaling
+
+    return DoomBatchedEnv(
+        envs,
+        scenario_cls(len(envs), hard_constraint=envs[0].hard_constraint),
+        cfg.res_w,
+        cfg.res_h,
+        pixel_format=cfg.pixel_format if "pixel_format" in cfg else "HWC",
+        time_limit=time_limit,
+        reward_scaling=doom_spec.reward_scaling,
+        penalty_scaling=penalty_scaling,
+        area_pooling="area_pooling" in cfg and cfg.area_pooling,
+    )
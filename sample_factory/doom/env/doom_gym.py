@@ -12,19 +12,12 @@ import gymnasium as gym
 import numpy as np
 from filelock import FileLock, Timeout
 from gymnasium.utils import seeding
-from vizdoom import AutomapMode, DoomGame, Mode, ScreenResolution
+from vizdoom import AutomapMode, DoomGame, Mode, ScreenFormat, ScreenResolution
 
 from sample_factory.algo.utils.spaces.discretized import Discretized
+from sample_factory.doom.env.batched_scenarios import SCENARIO_FUNCTIONS
 from sample_factory.utils.utils import log, project_tmp_dir
 
-resolutions = {'1920x1080': ScreenResolution.RES_1920X1080,  # 16:9
-               '1600x1200': ScreenResolution.RES_1600X1200,  # 4:3
-               '1280x720': ScreenResolution.RES_1280X720,  # 16:9
-               '800x600': ScreenResolution.RES_800X600,  # 4:3
-               '640x480': ScreenResolution.RES_640X480,  # 4:3
-               '320x240': ScreenResolution.RES_320X240,  # 4:3
-               '160x120': ScreenResolution.RES_160X120}  # 4:3
-
 
 def doom_lock_file(max_parallel):
     """
@@ -87,9 +80,10 @@ def key_to_action_default(key):
 
 
 def get_screen_resolution(resolution: str) -> ScreenResolution:
-    if resolution not in resolutions:
+    screen_resolution = getattr(ScreenResolution, f"RES_{resolution.upper()}", None)
+    if screen_resolution is None:
         raise ValueError(f'Invalid resolution: {resolution}')
-    return resolutions[resolution]
+    return screen_resolution
 
 
 class VizdoomEnv(gym.Env):
@@ -117,6 +111,8 @@ class VizdoomEnv(gym.Env):
             resolution: str = None,
             seed: Optional[int] = None,
             render_mode: Optional[str] = None,
+            cost_channels: Tuple[str, ...] = ("cost",),
+            channel_safety_bounds: Optional[Tuple[float, ...]] = None,
     ):
         self.initialized = False
         self.name = scenario_name
@@ -209,6 +205,10 @@ class VizdoomEnv(gym.Env):
         # Assign the same color for everything else
         self.default_color = (200, 200, 200)  # All unknown objects
 
+        # lookup table from label buffer values to colors, see segment_obs()
+        self._segmentation_palette = None
+        self._palette_labels = {}  # label value -> object name currently stored in the palette
+
         # can be adjusted after the environment is created (but before any reset() call) via observation space wrapper
         self.screen_w, self.screen_h, self.channels = 640, 480, 3
         self.resolution = resolution
@@ -253,6 +253,8 @@ class VizdoomEnv(gym.Env):
 
         # (optional) histogram to track positional coverage
         # do not pass coord_limits if you don't need this, to avoid extra calculation
+        # the two grids are double-buffered: the finished episode is published by reference on reset() and stays
+        # untouched until the next episode is over, so the consumers never need to copy it
         self.max_histogram_length = max_histogram_length
         self.current_histogram, self.previous_histogram = None, None
         if self.coord_limits:
@@ -278,6 +280,12 @@ class VizdoomEnv(gym.Env):
         self._num_episodes = 0
 
         self.safety_bound = 0.0 if self.hard_constraint else safety_bound
+
+        # constraint channels of the costs, several if the hazards of the scenario are reported separately
+        self.cost_channels = cost_channels
+        if channel_safety_bounds is None:
+            channel_safety_bounds = (safety_bound,) * len(cost_channels)
+        self.channel_safety_bounds = tuple(0.0 if self.hard_constraint else b for b in channel_safety_bounds)
         self.unsafe_reward = unsafe_reward
 
         self.mode = "algo"
@@ -296,6 +304,16 @@ class VizdoomEnv(gym.Env):
         self.curr_seed = self.curr_seed % (2 ** 32)  # Doom only supports 32-bit seeds
         return [self.curr_seed, self.rng]
 
+    @property
+    def heatmap_shape(self) -> Optional[Tuple[int, int]]:
+        return None if self.current_histogram is None else self.current_histogram.shape
+
+    @property
+    def episode_stat_keys(self) -> Tuple[str, ...]:
+        """The episode_extra_stats of the scenario, as declared by its ScenarioFunction (see batched_scenarios.py)."""
+        scenario_cls = SCENARIO_FUNCTIONS.get(self.name)
+        return scenario_cls.stat_keys if scenario_cls is not None else ()
+
     def calc_observation_space(self):
         self.observation_space = gym.spaces.Box(0, 255, (self.screen_h, self.screen_w, self.channels), dtype=np.uint8)
 
@@ -313,6 +331,8 @@ class VizdoomEnv(gym.Env):
         self.game = DoomGame()
         self.game.set_screen_resolution(get_screen_resolution(self.resolution))
         self.game.load_config(self.config_path)
+        # HWC frames straight from the engine, transposing CRCGCB buffers on every step costs more than the resize
+        self.game.set_screen_format(ScreenFormat.RGB24)
         self.game.set_doom_scenario_path(self.scenario_path)
         self.game.set_seed(self.curr_seed)
         self.game.set_depth_buffer_enabled(self.use_depth_buffer or self.render_depth_buffer)
@@ -472,6 +492,8 @@ class VizdoomEnv(gym.Env):
             self.current_histogram = self.previous_histogram
             self.previous_histogram = swap
             self.current_histogram.fill(0)
+            if self._num_episodes > 0:
+                info["episode_histogram"] = self.previous_histogram
 
         self._actions_flattened = None
         self._last_episode_info = copy.deepcopy(self._prev_info)
@@ -538,50 +560,49 @@ class VizdoomEnv(gym.Env):
     def _get_obs_from_state(self, state):
         # Default observation: screen buffer
         obs = state.automap_buffer if self.show_automap else state.screen_buffer
-        obs = np.transpose(obs, (1, 2, 0))  # Transpose to HWC format
 
         # Apply segmentation if enabled
         if self.segment_objects:
             obs = self.segment_obs(obs, state)
         return obs
 
+    def _build_segmentation_palette(self):
+        palette = np.empty((256, 3), dtype=np.uint8)
+        palette[:] = self.default_color
+        for value, color in self.object_id_to_color.items():
+            palette[value] = color
+        return palette
+
     def segment_obs(self, obs, state):
-        # Convert obs to BGR for OpenCV processing
-        obs = cv2.cvtColor(obs, cv2.COLOR_RGB2BGR)
-        # Get label buffer and labels information
-        label_buffer = state.labels_buffer.astype(np.uint8)
-        labels = state.labels  # List of Label objects
-        # Build mapping from label value to object name or ID
-        value_to_object = {}
-        for label in labels:
-            self.unique_label_names.add(label.object_name)
-            value_to_object[label.value] = label.object_name  # or label.object_id
-        # Assign consistent colors to each object
+        """
+        Color every pixel by the object it belongs to. Label values are assigned by ViZDoom on every frame, so we keep
+        a persistent 256-entry palette and only rewrite the entries whose object changed since the previous frame.
+        The segmented frame is then produced with a single lookup into the palette.
+        """
+        if self._segmentation_palette is None:
+            self._segmentation_palette = self._build_segmentation_palette()
+        palette = self._segmentation_palette
+
+        value_to_object = {label.value: label.object_name for label in state.labels}
+
+        # labels that are no longer on screen fall back to the default colors
+        for value in self._palette_labels.keys() - value_to_object.keys():
+            palette[value] = self.object_id_to_color.get(value, self.default_color)
+            del self._palette_labels[value]
+
         for value, object_name in value_to_object.items():
+            if self._palette_labels.get(value) == object_name:
+                continue
+
+            self.unique_label_names.add(object_name)
             if object_name not in self.object_name_to_color:
                 # Assign a unique color to each object_name
                 self.object_name_to_color[object_name] = self._generate_unique_color()
-        # Create segmented observation
-        segmented_obs = np.zeros_like(obs)
-        unique_values = np.unique(label_buffer)
-        for value in unique_values:
-            object_name = value_to_object.get(value, None)
-            if object_name is not None:
-                color = self.object_name_to_color[object_name]
-            else:
-                color = self.object_id_to_color.get(value, None)
-            if color is None:
-                color = self.default_color  # For undefined values
-
-            # Create a mask for current value
-            mask = (label_buffer == value).astype(np.uint8)
-
-            # Apply color to the segmented observation
-            for i in range(3):  # Apply color per channel
-                segmented_obs[:, :, i] += (mask * color[i])
-        # Update observation with segmented version
-        obs = segmented_obs
-        return obs
+
+            palette[value] = self.object_name_to_color[object_name]
+            self._palette_labels[value] = object_name
+
+        return palette[state.labels_buffer]
 
     def _process_game_step(self, state, done, info):
         if not done:
@@ -700,10 +721,7 @@ class VizdoomEnv(gym.Env):
     def get_info_all(self, variables=None):
         if variables is None:
             variables = self._game_variables_dict(self.game.get_state())
-        info = self.get_info(variables)
-        if self.previous_histogram is not None:
-            info["previous_histogram"] = copy.deepcopy(self.previous_histogram)
-        return info
+        return self.get_info(variables)
 
     def get_positions(self, variables):
         return self._get_positions(variables)
@@ -729,10 +747,7 @@ class VizdoomEnv(gym.Env):
         if self.game.is_episode_finished():
             return None
         state = self.game.get_state()
-        map_ = state.automap_buffer
-        map_ = np.swapaxes(map_, 0, 2)
-        map_ = np.swapaxes(map_, 0, 1)
-        return map_
+        return state.automap_buffer
 
     def _update_histogram(self, info, eps=1e-8):
         if self.current_histogram is None:
@@ -844,8 +859,6 @@ class VizdoomEnv(gym.Env):
 
                     if doom.show_automap and state.automap_buffer is not None:
                         map_ = state.automap_buffer
-                        map_ = np.swapaxes(map_, 0, 2)
-                        map_ = np.swapaxes(map_, 0, 1)
                         cv2.imshow("ViZDoom Automap Buffer", map_)
                         if time_wait > 0:
                             cv2.waitKey(int(time_wait) * 1000)
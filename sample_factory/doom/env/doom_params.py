@@ -29,6 +29,24 @@ def add_doom_env_args(parser):
     )
     p.add_argument("--res_w", default=128, type=int, help="Game frame width after resize")
     p.add_argument("--res_h", default=72, type=int, help="Game frame height after resize")
+    p.add_argument(
+        "--plan_render_resolution",
+        default=False,
+        type=str2bool,
+        help="Render at the cheapest native resolution with the aspect ratio of --resolution that can be decimated "
+             "to res_w x res_h with integer strides, instead of always rendering at --resolution and resizing. "
+             "Changes what the agent sees (fewer rendered pixels), so it is off by default. "
+             "Has no effect with the default 160x120 -> 128x72: 160x120 is already the cheapest resolution and it is "
+             "not an integer multiple of the target. It pays off for larger --resolution, e.g. 640x480 -> 80x60",
+    )
+    p.add_argument(
+        "--area_pooling",
+        default=False,
+        type=str2bool,
+        help="Reduce rendered frames to res_w x res_h by averaging the covered pixels (cv2.INTER_AREA) instead of "
+             "nearest-neighbour sampling. With --plan_render_resolution and an integer multiple of the target this "
+             "is a plain pooling of whole pixel blocks",
+    )
     p.add_argument(
         "--wide_aspect_ratio",
         default=False,
@@ -37,6 +55,22 @@ def add_doom_env_args(parser):
     )
     p.add_argument('--level', type=int, default=1, choices=[1, 2, 3], help='Difficulty level')
     p.add_argument('--constraint', type=str, default='soft', choices=['soft', 'hard'], help='Soft/Hard safety constraint')
+    p.add_argument(
+        "--multi_constraint",
+        default=False,
+        type=str2bool,
+        help="Report the costs of scenarios with several hazards (e.g. armament_burden, detonators_dilemma) as "
+             "separate constraint channels, each with its own cost critic head and Lagrange multiplier, instead of "
+             "a single total cost",
+    )
+    p.add_argument(
+        "--channel_safety_bounds",
+        default=None,
+        type=float,
+        nargs="+",
+        help="Allowed accumulated cost per episode of every constraint channel with --multi_constraint, "
+             "in the order of the channels of the scenario. By default every channel gets --safety_bound",
+    )
     p.add_argument('--render_mode', type=str, default='rgb_array', help='Rendering mode')
     p.add_argument("--video_dir", default='videos', type=str, help="Record episodes to this folder after an interval.")
     p.add_argument("--video_length", default=2100, type=int, help="Length of recorded video.")
@@ -1,7 +1,7 @@
 import datetime
 import os
 from os.path import join
-from typing import Optional
+from typing import Optional, Tuple
 
 from sample_factory.doom.env.action_space import (
     doom_turn_attack, doom_turn_move_jump_accelerate,
@@ -11,34 +11,35 @@ from sample_factory.doom.env.action_space import (
     doom_turn_move_use
 )
 from sample_factory.doom.env.doom_gym import VizdoomEnv
+from sample_factory.doom.env.batched_scenarios import (
+    SCENARIO_FUNCTIONS,
+    ArmamentBurden,
+    ArmsDealer,
+    Chainsaw,
+    CollateralDamage,
+    DetonatorsDilemma,
+    FloorIsLava,
+    HealthGathering,
+    HideAndSeek,
+    Parkour,
+    Pitfall,
+    PrecipicePlunge,
+    RaiseTheRoof,
+    RemedyRush,
+    RunAndGun,
+    VolcanicVenture,
+)
 from sample_factory.doom.env.wrappers.cost_penalty import CostPenalty
 from sample_factory.doom.env.wrappers.multiplayer_stats import MultiplayerStatsWrapper
-from sample_factory.doom.env.wrappers.observation_space import SetResolutionWrapper, resolutions
+from sample_factory.doom.env.wrappers.observation_space import (
+    SetResolutionWrapper,
+    plan_render_resolution,
+    report_render_costs,
+    resolutions,
+)
 from sample_factory.doom.env.wrappers.record_video import RecordVideo
 from sample_factory.doom.env.wrappers.saute import Saute
-from sample_factory.doom.env.wrappers.scenario_wrappers.armament_burden_cost_function import ArmamentBurdenCostFunction
-from sample_factory.doom.env.wrappers.scenario_wrappers.arms_dealer_reward_function import ArmsDealerRewardFunction
-from sample_factory.doom.env.wrappers.scenario_wrappers.chainsaw_reward_function import ChainsawRewardFunction
-from sample_factory.doom.env.wrappers.scenario_wrappers.floor_is_lava_reward_function import FloorIsLavaRewardFunction
-from sample_factory.doom.env.wrappers.scenario_wrappers.parkour_reward_function import ParkourRewardFunction
-from sample_factory.doom.env.wrappers.scenario_wrappers.pitfall_reward_function import PitfallRewardFunction
-from sample_factory.doom.env.wrappers.scenario_wrappers.hide_and_seek_reward_function import HideAndSeekRewardFunction
-from sample_factory.doom.env.wrappers.scenario_wrappers.health_gathering_reward_function import \
-    HealthGatheringRewardFunction
-from sample_factory.doom.env.wrappers.scenario_wrappers.raise_the_roof_reward_function import \
-    RaiseTheRoofRewardFunction
-from sample_factory.doom.env.wrappers.scenario_wrappers.run_and_gun_reward_function import RunAndGunRewardFunction
-from sample_factory.doom.env.wrappers.scenario_wrappers.collateral_damage_cost_function import \
-    DoomCollateralDamageCostFunction
-from sample_factory.doom.env.wrappers.scenario_wrappers.detonators_dilemma_cost_function import \
-    DoomDetonatorsDilemmaCostFunction
-from sample_factory.doom.env.wrappers.scenario_wrappers.precipice_plunge_cost_function import \
-    PrecipicePlungeCostFunction
-from sample_factory.doom.env.wrappers.scenario_wrappers.precipice_plunge_reward_function import \
-    PrecipicePlungeRewardFunction
-from sample_factory.doom.env.wrappers.scenario_wrappers.remedy_rush_cost_function import RemedyRushCostFunction
-from sample_factory.doom.env.wrappers.scenario_wrappers.volcanic_venture_cost_function import \
-    VolcanicVentureCostFunction
+from sample_factory.doom.env.wrappers.scenario_function import ScenarioFunctionWrapper
 from sample_factory.envs.env_wrappers import (
     PixelFormatChwWrapper,
     ResizeWrapper,
@@ -97,7 +98,7 @@ DOOM_ENVS = [
         safety_bound=5,
         unsafe_reward=-0.005,
         coord_limits=[0, 256, 960, 1216],
-        extra_wrappers=[(ArmamentBurdenCostFunction, {})]
+        extra_wrappers=[(ScenarioFunctionWrapper, dict(scenario_cls=ArmamentBurden))]
     ),
     DoomSpec(
         'collateral_damage',
@@ -109,7 +110,7 @@ DOOM_ENVS = [
         safety_bound=5,
         unsafe_reward=-0.1,
         coord_limits=[-576, -640, 256, 640],
-        extra_wrappers=[(DoomCollateralDamageCostFunction, {})]
+        extra_wrappers=[(ScenarioFunctionWrapper, dict(scenario_cls=CollateralDamage))]
     ),
     DoomSpec(
         'detonators_dilemma',
@@ -121,7 +122,7 @@ DOOM_ENVS = [
         safety_bound=5,
         unsafe_reward=-0.01,
         coord_limits=[-720, -1120, 1804, -360],
-        extra_wrappers=[(DoomDetonatorsDilemmaCostFunction, {})]
+        extra_wrappers=[(ScenarioFunctionWrapper, dict(scenario_cls=DetonatorsDilemma))]
     ),
     DoomSpec(
         'precipice_plunge',
@@ -133,7 +134,7 @@ DOOM_ENVS = [
         safety_bound=50,
         unsafe_reward=-0.7,
         coord_limits=[0, 0, 2176, 448],
-        extra_wrappers=[(PrecipicePlungeRewardFunction, {}), (PrecipicePlungeCostFunction, {})]
+        extra_wrappers=[(ScenarioFunctionWrapper, dict(scenario_cls=PrecipicePlunge))]
     ),
     DoomSpec(
         'remedy_rush',
@@ -145,7 +146,7 @@ DOOM_ENVS = [
         safety_bound=5,
         unsafe_reward=-0.025,
         coord_limits=[-608, -736, 1040, 1296],
-        extra_wrappers=[(RemedyRushCostFunction, {})]
+        extra_wrappers=[(ScenarioFunctionWrapper, dict(scenario_cls=RemedyRush))]
     ),
     DoomSpec(
         'volcanic_venture',
@@ -157,7 +158,7 @@ DOOM_ENVS = [
         safety_bound=50,
         unsafe_reward=-0.01,
         coord_limits=[0, 64, 2176, 2240],
-        extra_wrappers=[(VolcanicVentureCostFunction, {})]
+        extra_wrappers=[(ScenarioFunctionWrapper, dict(scenario_cls=VolcanicVenture))]
     ),
     DoomSpec(
         "arms_dealer",
@@ -169,7 +170,7 @@ DOOM_ENVS = [
         safety_bound=0,
         default_timeout=1000,
         coord_limits=None,
-        extra_wrappers=[(ArmsDealerRewardFunction, {})],
+        extra_wrappers=[(ScenarioFunctionWrapper, dict(scenario_cls=ArmsDealer))],
     ),
     DoomSpec(
         "chainsaw",
@@ -181,7 +182,7 @@ DOOM_ENVS = [
         safety_bound=0,                  # no unsafe signal
         default_timeout=1000,
         coord_limits=None,
-        extra_wrappers=[(ChainsawRewardFunction, {})],
+        extra_wrappers=[(ScenarioFunctionWrapper, dict(scenario_cls=Chainsaw))],
     ),
     DoomSpec(
         "floor_is_lava",
@@ -193,7 +194,7 @@ DOOM_ENVS = [
         safety_bound=0,
         default_timeout=2500,
         coord_limits=None,
-        extra_wrappers=[(FloorIsLavaRewardFunction, {})],
+        extra_wrappers=[(ScenarioFunctionWrapper, dict(scenario_cls=FloorIsLava))],
     ),
     DoomSpec(
         "health_gathering",
@@ -205,7 +206,7 @@ DOOM_ENVS = [
         safety_bound=0,
         default_timeout=2500,
         coord_limits=None,
-        extra_wrappers=[(HealthGatheringRewardFunction, {})],
+        extra_wrappers=[(ScenarioFunctionWrapper, dict(scenario_cls=HealthGathering))],
     ),
     DoomSpec(
         "hide_and_seek",
@@ -217,7 +218,7 @@ DOOM_ENVS = [
         safety_bound=0,
         default_timeout=2500,
         coord_limits=None,
-        extra_wrappers=[(HideAndSeekRewardFunction, {})],
+        extra_wrappers=[(ScenarioFunctionWrapper, dict(scenario_cls=HideAndSeek))],
     ),
     DoomSpec(
         "parkour",
@@ -229,7 +230,7 @@ DOOM_ENVS = [
         safety_bound=0,
         default_timeout=2500,
         coord_limits=None,
-        extra_wrappers=[(ParkourRewardFunction, {})],
+        extra_wrappers=[(ScenarioFunctionWrapper, dict(scenario_cls=Parkour))],
     ),
     DoomSpec(
         "pitfall",
@@ -241,7 +242,7 @@ DOOM_ENVS = [
         safety_bound=0,
         default_timeout=2500,
         coord_limits=None,
-        extra_wrappers=[(PitfallRewardFunction, {})],
+        extra_wrappers=[(ScenarioFunctionWrapper, dict(scenario_cls=Pitfall))],
     ),
     DoomSpec(
         "raise_the_roof",
@@ -253,7 +254,7 @@ DOOM_ENVS = [
         safety_bound=0,
         default_timeout=2500,
         coord_limits=None,
-        extra_wrappers=[(RaiseTheRoofRewardFunction, {})],
+        extra_wrappers=[(ScenarioFunctionWrapper, dict(scenario_cls=RaiseTheRoof))],
     ),
     DoomSpec(
         "run_and_gun",
@@ -265,7 +266,7 @@ DOOM_ENVS = [
         safety_bound=0,
         default_timeout=2500,
         coord_limits=None,
-        extra_wrappers=[(RunAndGunRewardFunction, {})],
+        extra_wrappers=[(ScenarioFunctionWrapper, dict(scenario_cls=RunAndGun))],
     ),
 
 
@@ -279,21 +280,15 @@ def doom_env_by_name(name):
     raise RuntimeError("Unknown Doom env")
 
 
-# noinspection PyUnusedLocal
-def make_doom_env_impl(
-        doom_spec,
-        cfg=None,
-        env_config=None,
-        skip_frames=None,
-        player_id=None,
-        num_agents=None,
-        max_num_players=None,
-        num_bots=0,  # for multi-agent
-        custom_resolution=None,
-        render: bool = False,
-        render_mode: Optional[str] = None,
-        **kwargs,
-):
+def make_vizdoom_env(
+        doom_spec, cfg, skip_frames=None, render_mode: Optional[str] = None, report_resize_costs: bool = False
+) -> Tuple[VizdoomEnv, str]:
+    """
+    Bare VizdoomEnv for the scenario, without any wrappers.
+    With report_resize_costs the per-frame cost of every render resolution option is logged (see
+    report_render_costs()).
+    :return: the env and the native screen resolution it should be rendered at (see SetResolutionWrapper)
+    """
     skip_frames = skip_frames if skip_frames is not None else cfg.env_frameskip
 
     fps = cfg.fps if "fps" in cfg else None
@@ -304,10 +299,35 @@ def make_doom_env_impl(
     if cfg.unsafe_reward:
         doom_spec.unsafe_reward = cfg.unsafe_reward
 
+    # the hazards of the scenario as separate constraint channels, if it has several
+    cost_channels, channel_safety_bounds = ("cost",), None
+    scenario = SCENARIO_FUNCTIONS.get(doom_spec.name)
+    if "multi_constraint" in cfg and cfg.multi_constraint and scenario is not None:
+        cost_channels = scenario.cost_channels
+        if cfg.channel_safety_bounds is not None:
+            if len(cfg.channel_safety_bounds) != len(cost_channels):
+                raise ValueError(f"{doom_spec.name} has the constraint channels {cost_channels}, "
+                                 f"got --channel_safety_bounds {cfg.channel_safety_bounds}")
+            channel_safety_bounds = tuple(cfg.channel_safety_bounds)
+
     config_file = f'{doom_spec.name}_all.cfg' if cfg.all_actions else f'{doom_spec.name}.cfg'
     action_space = doom_spec.full_action_space if cfg.all_actions else doom_spec.action_space
     max_histogram_length = cfg.max_histogram_length if cfg.max_histogram_length else doom_spec.max_histogram_len
 
+    resolution = cfg.resolution
+    if resolution is None:
+        resolution = "256x144" if cfg.wide_aspect_ratio else "160x120"
+
+    assert resolution in resolutions
+    configured_resolution = resolution
+    if "plan_render_resolution" in cfg and cfg.plan_render_resolution:
+        # render directly at the policy resolution or an integer multiple of it, if there is one
+        resolution = plan_render_resolution(resolution, cfg.res_w, cfg.res_h)
+
+    if report_resize_costs:
+        area_pooling = "area_pooling" in cfg and cfg.area_pooling
+        report_render_costs(configured_resolution, cfg.res_w, cfg.res_h, resolution, area_pooling)
+
     env = VizdoomEnv(
         doom_spec.name,
         config_file,
@@ -328,8 +348,34 @@ def make_doom_env_impl(
         async_mode=async_mode,
         render_mode=render_mode,
         env_modification=cfg.env_modification,
-        resolution=cfg.resolution,
+        resolution=resolution,
         seed=cfg.seed,
+        cost_channels=cost_channels,
+        channel_safety_bounds=channel_safety_bounds,
+    )
+
+    return env, resolution
+
+
+# noinspection PyUnusedLocal
+def make_doom_env_impl(
+        doom_spec,
+        cfg=None,
+        env_config=None,
+        skip_frames=None,
+        player_id=None,
+        num_agents=None,
+        max_num_players=None,
+        num_bots=0,  # for multi-agent
+        custom_resolution=None,
+        render: bool = False,
+        render_mode: Optional[str] = None,
+        **kwargs,
+):
+    # report the resize options only once, for the first env of the experiment
+    first_env = env_config is not None and env_config.get("env_id") == 0
+    env, resolution = make_vizdoom_env(
+        doom_spec, cfg, skip_frames=skip_frames, render_mode=render_mode, report_resize_costs=first_env
     )
 
     record_to = cfg.record_to if "record_to" in cfg else None
@@ -342,11 +388,6 @@ def make_doom_env_impl(
 
     env = MultiplayerStatsWrapper(env)
 
-    resolution = cfg.resolution
-    if resolution is None:
-        resolution = "256x144" if cfg.wide_aspect_ratio else "160x120"
-
-    assert resolution in resolutions
     env = SetResolutionWrapper(env, resolution)  # default (wide aspect ratio)
 
     if cfg.use_depth_buffer:
@@ -354,7 +395,18 @@ def make_doom_env_impl(
 
     h, w, channels = env.observation_space.shape
     if w != cfg.res_w or h != cfg.res_h:
-        env = ResizeWrapper(env, cfg.res_w, cfg.res_h, grayscale=False)
+        # only the samplers ask for this: they copy the observation to the trajectory buffers right away, so the
+        # output frame can be reused. Everyone else (enjoy, evaluation scripts) gets a new array every step
+        reuse_observations = env_config is not None and env_config.get("reuse_observations", False)
+        area_pooling = "area_pooling" in cfg and cfg.area_pooling
+        env = ResizeWrapper(
+            env,
+            cfg.res_w,
+            cfg.res_h,
+            grayscale=False,
+            area_interpolation=area_pooling,
+            preallocate_output=reuse_observations,
+        )
 
     debug_log_every_n(50, "Doom resolution: %s, resize resolution: %r", resolution, (cfg.res_w, cfg.res_h))
 
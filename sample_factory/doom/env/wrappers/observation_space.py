@@ -1,4 +1,12 @@
+import timeit
+from functools import lru_cache
+from typing import List, Tuple
+
+import cv2
 import gymnasium as gym
+import numpy as np
+
+from sample_factory.utils.utils import log
 
 resolutions = [
     "160x120",
@@ -73,3 +81,86 @@ class SetResolutionWrapper(gym.Wrapper):
             new_obs_space = self.unwrapped.observation_space
 
         self.observation_space = self.unwrapped.observation_space = new_obs_space
+
+
+def resolution_to_wh(resolution: str) -> Tuple[int, int]:
+    width, height = resolution.lower().split("x")
+    return int(width), int(height)
+
+
+def _render_resolution_options(resolution: str, target_w: int, target_h: int) -> List[Tuple[str, bool]]:
+    """
+    Native resolutions with the aspect ratio (and therefore the field of view) of the configured one that render at
+    most as many pixels, cheapest first, and whether each is an integer multiple of the target resolution.
+    """
+    width, height = resolution_to_wh(resolution)
+
+    options = []
+    for candidate in sorted(resolutions, key=lambda r: np.prod(resolution_to_wh(r))):
+        w, h = resolution_to_wh(candidate)
+        if w * height != h * width or w * h > width * height:
+            continue  # different aspect ratio or more expensive to render than the configured resolution
+        options.append((candidate, w % target_w == 0 and h % target_h == 0))
+
+    return options
+
+
+@lru_cache(maxsize=None)
+def plan_render_resolution(resolution: str, target_w: int, target_h: int) -> str:
+    """
+    Pick the cheapest native ViZDoom resolution to render at, given the configured one and the policy resolution.
+
+    Among the candidates of _render_resolution_options() we take the smallest one that is an integer multiple of the
+    target, so that the resize degenerates to a plain integer-stride decimation or an area pooling of whole pixel
+    blocks (or disappears entirely when the native resolution matches the target). If there is no such resolution
+    we keep the configured one. This is the case for the defaults (160x120 -> 128x72), i.e. planning only changes
+    something for larger configured resolutions or targets that divide them.
+    """
+    for candidate, exact in _render_resolution_options(resolution, target_w, target_h):
+        if exact:
+            if candidate != resolution:
+                log.debug("Render at %s instead of %s, reduce to %dx%d", candidate, resolution, target_w, target_h)
+            return candidate
+
+    return resolution
+
+
+def _per_frame_resize_cost_us(width: int, height: int, target_w: int, target_h: int, interpolation: int) -> float:
+    if (width, height) == (target_w, target_h):
+        return 0.0
+
+    frame = np.zeros((height, width, 3), dtype=np.uint8)
+    out = np.empty((target_h, target_w, 3), dtype=np.uint8)
+    num_repeats = 20
+    resize = lambda: cv2.resize(frame, (target_w, target_h), dst=out, interpolation=interpolation)
+    resize()  # the first call in the process is much slower
+    return timeit.timeit(resize, number=num_repeats) / num_repeats * 1e6
+
+
+def report_render_costs(resolution: str, target_w: int, target_h: int, selected: str, area_pooling: bool) -> None:
+    """
+    Log the per-frame cost of reducing every render resolution option to the policy resolution, with nearest
+    neighbour decimation and with area pooling. Meant to be called once, when the first env is created.
+    """
+    for candidate, exact in _render_resolution_options(resolution, target_w, target_h):
+        w, h = resolution_to_wh(candidate)
+        for pooling, interpolation in ((False, cv2.INTER_NEAREST), (True, cv2.INTER_AREA)):
+            if (w, h) == (target_w, target_h):
+                method = "no resize"
+            elif exact:
+                method = f"{'area pool' if pooling else 'decimate'} by {h // target_h}x{w // target_w}"
+            else:
+                method = f"{'area' if pooling else 'nearest'} resize"
+
+            log.info(
+                "Render %s (%d px) -> %dx%d: %s, %.1f us/frame%s",
+                candidate,
+                w * h,
+                target_w,
+                target_h,
+                method,
+                _per_frame_resize_cost_us(w, h, target_w, target_h, interpolation),
+                " (selected)" if candidate == selected and pooling == area_pooling else "",
+            )
+            if (w, h) == (target_w, target_h):
+                break  # nothing to pool
@@ -0,0 +1,67 @@
+from typing import Type
+
+import gymnasium as gym
+import numpy as np
+from vizdoom import GameVariable
+
+from sample_factory.doom.env.batched_scenarios import ScenarioFunction
+
+
+class ScenarioFunctionWrapper(gym.Wrapper):
+    """
+    Reward and cost function of the scenario for an individual env: evaluates the ScenarioFunction declared in
+    batched_scenarios.py for a batch of one game, so that individual envs and the batched env compute the same.
+
+    Coefficients of the scenario (i.e. reward_scale) can be overridden with keyword arguments.
+    """
+
+    def __init__(self, env, scenario_cls: Type[ScenarioFunction], **coefficients):
+        super().__init__(env)
+        self.scenario = scenario_cls(1, hard_constraint=env.unwrapped.hard_constraint)
+        for name, value in coefficients.items():
+            if not hasattr(scenario_cls, name):
+                raise TypeError(f"{scenario_cls.__name__} has no coefficient {name!r}")
+            setattr(self.scenario, name, value)
+
+        self._multi_constraint = len(env.unwrapped.cost_channels) > 1
+        self._game_variables = [getattr(GameVariable, v) for v in scenario_cls.variables]
+
+        self._variables = np.zeros((1, len(self._game_variables)))
+        self._all_envs = np.ones(1, dtype=bool)
+        self._terminated = np.zeros(1, dtype=bool)
+        self._rewards = np.zeros(1)
+        self._costs = np.zeros(1)
+        self._true_objective = np.zeros(1)
+
+    def _read_variables(self) -> None:
+        # also valid when the episode is finished, the game still reports the final values
+        game = self.unwrapped.game
+        for j, variable in enumerate(self._game_variables):
+            self._variables[0, j] = game.get_game_variable(variable)
+
+    def reset(self, **kwargs):
+        obs, info = self.env.reset(**kwargs)
+        self._read_variables()
+        self.scenario.reset(self._all_envs, self._variables)
+        return obs, info
+
+    def step(self, action):
+        obs, reward, terminated, truncated, info = self.env.step(action)
+
+        self._read_variables()
+        self._rewards[0] = reward
+        self._terminated[0] = terminated
+        self.scenario.step(self._variables, self._terminated, self._rewards, self._costs, self._true_objective)
+
+        info["cost"] = self._costs[0].item()
+        if self._multi_constraint:
+            info["costs"] = self.scenario.channel_costs[0].tolist()
+        info["true_objective"] = self._true_objective[0].item()
+        done = terminated or truncated
+        info["episode_extra_stats"] = {
+            key: value[0].item()
+            for key, value in self.scenario.stats.items()
+            if done or key not in self.scenario.episode_end_stat_keys
+        }
+
+        return obs, self._rewards[0].item(), terminated, truncated, info
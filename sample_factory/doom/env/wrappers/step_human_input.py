@@ -29,7 +29,7 @@ class StepHumanInput(gym.Wrapper):
         truncated = False
 
         if not terminated:
-            observation = np.transpose(state.screen_buffer, (1, 2, 0))
+            observation = state.screen_buffer
         else:
             observation = np.uint8(np.zeros(self.observation_space.shape))
 
@@ -3,17 +3,22 @@ import sys
 
 from sample_factory.algo.utils.context import global_model_factory
 from sample_factory.cfg.arguments import parse_full_cfg, parse_sf_args
-from sample_factory.envs.env_utils import register_env
+from sample_factory.envs.env_utils import register_batched_env, register_env
 from sample_factory.train import run_rl
+from sample_factory.doom.env.doom_batched import make_doom_env_batched
 from sample_factory.doom.env.doom_model import make_vizdoom_encoder
 from sample_factory.doom.env.doom_params import add_doom_env_args, doom_override_defaults
 from sample_factory.doom.env.doom_utils import DOOM_ENVS, make_doom_env_from_spec
+from sample_factory.doom.env.batched_scenarios import SCENARIO_FUNCTIONS
 
 
 def register_vizdoom_envs():
     for env_spec in DOOM_ENVS:
         make_env_func = functools.partial(make_doom_env_from_spec, env_spec)
         register_env(env_spec.name, make_env_func)
+        if env_spec.name in SCENARIO_FUNCTIONS:
+            # used by rollout workers with --batched_sampling
+            register_batched_env(env_spec.name, functools.partial(make_doom_env_batched, env_spec))
 
 
 def register_vizdoom_models():
@@ -127,6 +127,7 @@ def enjoy(cfg: Config) -> Tuple[StatusCode, float]:
         cfg, env_config=AttrDict(worker_index=0, vector_index=0, env_id=0), render_mode=render_mode
     )
     cfg.resolution = cfg.resolution_eval
+    cfg.plan_render_resolution = False  # the render env has to keep the evaluation resolution
     env_render = make_env_func_batched(
         cfg, env_config=AttrDict(worker_index=0, vector_index=0, env_id=1), render_mode=render_mode
     )
@@ -137,7 +138,7 @@ def enjoy(cfg: Config) -> Tuple[StatusCode, float]:
         env.unwrapped.reset_on_init = False
         env_render.unwrapped.reset_on_init = False
 
-    actor_critic = create_actor_critic(cfg, env.observation_space, env.action_space)
+    actor_critic = create_actor_critic(cfg, env.observation_space, env.action_space, len(env_info.cost_channels))
     actor_critic.eval()
 
     device = torch.device("cpu" if cfg.device == "cpu" else "cuda")
@@ -1,12 +1,12 @@
 from __future__ import annotations
 
-from typing import Optional
+from typing import List, Optional
 
-from sample_factory.algo.utils.context import global_env_registry
+from sample_factory.algo.utils.context import global_batched_env_registry, global_env_registry
 from sample_factory.algo.utils.gymnasium_utils import patch_non_gymnasium_env
 from sample_factory.envs.env_wrappers import EpisodeCounterWrapper
 from sample_factory.utils.attr_dict import AttrDict
-from sample_factory.utils.typing import Config
+from sample_factory.utils.typing import Config, Env
 from sample_factory.utils.utils import log
 
 
@@ -44,3 +44,15 @@ def create_env(
         env = EpisodeCounterWrapper(env)
 
     return env
+
+
+def create_batched_env(full_env_name: str, cfg: Config, env_configs: List[AttrDict]) -> Optional[Env]:
+    """
+    Creates a natively batched env simulating len(env_configs) env instances, see register_batched_env().
+    :return: None if there is no batched implementation of this env (or it does not support the configuration)
+    """
+    env_factory = global_batched_env_registry().get(full_env_name)
+    if env_factory is None:
+        return None
+
+    return env_factory(cfg, env_configs)
@@ -4,8 +4,8 @@ from functools import wraps
 from time import sleep
 from typing import Any, Dict, Optional
 
-from sample_factory.algo.utils.context import global_env_registry
-from sample_factory.utils.typing import CreateEnvFunc
+from sample_factory.algo.utils.context import global_batched_env_registry, global_env_registry
+from sample_factory.utils.typing import CreateBatchedEnvFunc, CreateEnvFunc
 from sample_factory.utils.utils import is_module_available, log
 
 
@@ -31,6 +31,27 @@ def register_env(env_name: str, make_env_func: CreateEnvFunc) -> None:
     env_registry[env_name] = make_env_func
 
 
+def register_batched_env(env_name: str, make_batched_env_func: CreateBatchedEnvFunc) -> None:
+    """
+    Register a callable that creates a natively batched implementation of an already registered environment.
+    With --batched_sampling, rollout workers use it to simulate all envs of a split with a single object instead of
+    stacking individual env instances. It is called like:
+        make_batched_env_func(cfg, env_configs)
+        Where env_configs is a list with the env_config of every env instance in the batch. It can return None if the
+        configuration is not supported, in which case we fall back to the regular envs.
+    The batched env must be multi-agent with one agent per env instance.
+    """
+
+    env_registry = global_batched_env_registry()
+
+    if env_name in env_registry:
+        log.warning(f"Batched environment {env_name} already registered, overwriting...")
+
+    assert callable(make_batched_env_func), f"{make_batched_env_func=} must be callable"
+
+    env_registry[env_name] = make_batched_env_func
+
+
 class EnvCriticalError(Exception):
     pass
 
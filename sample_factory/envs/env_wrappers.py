@@ -22,9 +22,15 @@ def has_image_observations(observation_space):
 
 
 class ResizeWrapper(gym.core.Wrapper):
-    """Resize observation frames to specified (w,h) and convert to grayscale."""
+    """
+    Resize observation frames to specified (w,h) and convert to grayscale.
+    With preallocate_output=True every observation is written into the same array, i.e. it is overwritten by the
+    next step() or reset().
+    """
 
-    def __init__(self, env, w, h, grayscale=True, add_channel_dim=False, area_interpolation=False):
+    def __init__(
+        self, env, w, h, grayscale=True, add_channel_dim=False, area_interpolation=False, preallocate_output=False
+    ):
         super(ResizeWrapper, self).__init__(env)
 
         self.w = w
@@ -42,6 +48,13 @@ class ResizeWrapper(gym.core.Wrapper):
         else:
             self.observation_space = self._calc_new_obs_space(env.observation_space)
 
+        # Resize every frame into the same buffer. The returned observation is then only valid until the next
+        # step/reset, so this is only safe if the consumer copies it before stepping again (e.g. rollout workers
+        # write it into the shared trajectory buffers) and does not keep references to previous observations.
+        self.output_buffer = None
+        if preallocate_output and not isinstance(env.observation_space, spaces.Dict) and not grayscale:
+            self.output_buffer = np.empty(self.observation_space.shape, dtype=self.observation_space.dtype)
+
     def _calc_new_obs_space(self, old_space):
         low, high = old_space.low.flat[0], old_space.high.flat[0]
 
@@ -60,7 +73,7 @@ class ResizeWrapper(gym.core.Wrapper):
         if obs is None:
             return obs
 
-        obs = cv2.resize(obs, (self.w, self.h), interpolation=self.interpolation)
+        obs = cv2.resize(obs, (self.w, self.h), dst=self.output_buffer, interpolation=self.interpolation)
         if self.grayscale:
             obs = cv2.cvtColor(obs, cv2.COLOR_RGB2GRAY)
 
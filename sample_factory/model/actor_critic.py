@@ -1,6 +1,7 @@
 from __future__ import annotations
 
-from typing import Dict, Optional, Tuple, Union, List
+import inspect
+from typing import Dict, Optional, Sequence, Tuple, Union, List
 
 import torch
 from torch import Tensor, nn
@@ -30,7 +31,11 @@ class ActorCritic(nn.Module, Configurable):
         # to load/save the state of the normalizer (running mean and stddev statistics)
         self.obs_normalizer: ObservationNormalizer = ObservationNormalizer(obs_space, cfg)
 
+        # number of constraint channels predicted by the cost critic of the safe RL models
+        self.num_costs: int = 1
+
         self.returns_normalizer: Optional[RunningMeanStdInPlace] = None
+        self.costs_normalizer: Optional[RunningMeanStdInPlace] = None
         if cfg.normalize_returns:
             returns_shape = (1,)  # it's actually a single scalar but we use 1D shape for the normalizer
             self.returns_normalizer = RunningMeanStdInPlace(returns_shape)
@@ -41,6 +46,16 @@ class ActorCritic(nn.Module, Configurable):
 
         self.last_action_distribution = None  # to be populated after each forward step
 
+    def _init_cost_channels(self, num_costs: int) -> None:
+        """Models with a cost critic predict one cost value per constraint channel, each with its own statistics."""
+        self.num_costs = num_costs
+        if self.costs_normalizer is not None and num_costs > 1:
+            self.costs_normalizer = torch.jit.script(RunningMeanStdInPlace((num_costs,)))
+
+    def _squeeze_cost_values(self, cost_values: Tensor) -> Tensor:
+        # [B, K] values of several channels are kept as they are, a single channel is squeezed like the reward values
+        return cost_values.squeeze() if self.num_costs == 1 else cost_values
+
     def get_action_parameterization(self, decoder_output_size: int):
         if not self.cfg.adaptive_stddev and is_continuous_action_space(self.action_space):
             action_parameterization = ActionParameterizationContinuousNonAdaptiveStddev(
@@ -110,6 +125,25 @@ class ActorCritic(nn.Module, Configurable):
     def action_distribution(self):
         return self.last_action_distribution
 
+    def _forward_critic_values(
+        self, critics: List[Critic], normalized_obs_dict: Dict[str, Tensor], rnn_states: Sequence[Tensor]
+    ) -> List[Tensor]:
+        """Values predicted by the given critic towers of a model with separate weights, the actor is not evaluated."""
+        values = []
+        for critic, critic_rnn_states in zip(critics, rnn_states):
+            core_output, _ = critic.core(critic.head(normalized_obs_dict), critic_rnn_states)
+            values.append(critic.tail(core_output).squeeze(-1))
+        return values
+
+    @staticmethod
+    def _values_result(values: Dict[str, Tensor], out: Optional[TensorDict]) -> TensorDict:
+        if out is None:
+            return TensorDict(values)
+
+        for key, buffer in out.items():
+            buffer.copy_(values[key].view_as(buffer))
+        return out
+
     def _maybe_sample_actions(self, sample_actions: bool, result: TensorDict) -> None:
         if sample_actions:
             # for non-trivial action spaces it is faster to do these together
@@ -129,6 +163,20 @@ class ActorCritic(nn.Module, Configurable):
         Tensor, Tuple[TensorDict, ...]]:
         raise NotImplementedError()
 
+    def forward_values(
+        self, normalized_obs_dict: Dict[str, Tensor], rnn_states: Tensor, out: Optional[TensorDict] = None
+    ) -> TensorDict:
+        """
+        Only the value estimates: "values", plus "cost_values" for models with a cost critic. Used to bootstrap the
+        returns after the last step of the rollout. The actor is not evaluated and no new RNN states are returned.
+        Derived classes skip everything that is not needed, this default goes through the full values_only forward.
+        :param out: optional preallocated tensors (i.e. slices of the experience buffers) to write the values into,
+        which is then returned. Only the values with a tensor in `out` are written.
+        """
+        result = self.forward(normalized_obs_dict, rnn_states, values_only=True)
+        values = {key: result[key] for key in ("values", "cost_values") if key in result}
+        return self._values_result(values, out)
+
 
 class ActorCriticSharedWeights(ActorCritic):
     def __init__(
@@ -185,6 +233,18 @@ class ActorCriticSharedWeights(ActorCritic):
         result["new_rnn_states"] = new_rnn_states
         return result
 
+    def _forward_decoder(self, normalized_obs_dict: Dict[str, Tensor], rnn_states: Tensor) -> Tensor:
+        x = self.forward_head(normalized_obs_dict)
+        x, _ = self.forward_core(x, rnn_states)
+        return self.decoder(x)
+
+    def forward_values(
+        self, normalized_obs_dict: Dict[str, Tensor], rnn_states: Tensor, out: Optional[TensorDict] = None
+    ) -> TensorDict:
+        decoder_output = self._forward_decoder(normalized_obs_dict, rnn_states)
+        values = self.critic_linear(decoder_output).squeeze(-1)
+        return self._values_result(dict(values=values), out)
+
 
 class ActorCriticSaute(ActorCriticSharedWeights):
     def __init__(
@@ -212,16 +272,26 @@ class SafeActorCriticSharedWeights(ActorCriticSharedWeights):
             obs_space: ObsSpace,
             action_space: ActionSpace,
             cfg: Config,
+            num_costs: int = 1,
     ):
         super().__init__(model_factory, obs_space, action_space, cfg)
+        self._init_cost_channels(num_costs)
         decoder_out_size: int = self.decoder.get_out_size()
-        self.cost_critic_linear = nn.Linear(decoder_out_size, 1)
+        self.cost_critic_linear = nn.Linear(decoder_out_size, num_costs)
         self.apply(self.initialize_weights)
 
+    def forward_values(
+        self, normalized_obs_dict: Dict[str, Tensor], rnn_states: Tensor, out: Optional[TensorDict] = None
+    ) -> TensorDict:
+        decoder_output = self._forward_decoder(normalized_obs_dict, rnn_states)
+        values = self.critic_linear(decoder_output).squeeze(-1)
+        cost_values = self.cost_critic_linear(decoder_output).squeeze(-1)
+        return self._values_result(dict(values=values, cost_values=cost_values), out)
+
     def forward_tail(self, core_output, values_only: bool, sample_actions: bool, mean_std: bool = False) -> TensorDict:
         decoder_output = self.decoder(core_output)
         values = self.critic_linear(decoder_output).squeeze()
-        cost_values = self.cost_critic_linear(decoder_output).squeeze()
+        cost_values = self._squeeze_cost_values(self.cost_critic_linear(decoder_output))
 
         result = TensorDict(values=values, cost_values=cost_values)
         if values_only:
@@ -287,9 +357,9 @@ class Actor(ACBase):
 
 
 class Critic(ACBase):
-    def __init__(self, model_factory, obs_space, cfg):
+    def __init__(self, model_factory, obs_space, cfg, *, num_outputs: int = 1):
         super(Critic, self).__init__(model_factory, obs_space, cfg)
-        self.linear = nn.Linear(self.decoder.get_out_size(), 1)
+        self.linear = nn.Linear(self.decoder.get_out_size(), num_outputs)
 
     @property
     def out_head(self):
@@ -372,12 +442,20 @@ class ActorCriticSeparateWeights(ActorCritic):
 
         return result
 
+    def forward_values(
+        self, normalized_obs_dict: Dict[str, Tensor], rnn_states: Tensor, out: Optional[TensorDict] = None
+    ) -> TensorDict:
+        _, rnn_states_critic = rnn_states.chunk(2, dim=1)
+        values = self._forward_critic_values([self.critic], normalized_obs_dict, [rnn_states_critic])[0]
+        return self._values_result(dict(values=values), out)
+
 
 class SafeActorCriticSeparateWeights(ActorCriticSeparateWeights):
 
-    def __init__(self, model_factory, obs_space, action_space, cfg):
+    def __init__(self, model_factory, obs_space, action_space, cfg, num_costs: int = 1):
         super(SafeActorCriticSeparateWeights, self).__init__(model_factory, obs_space, action_space, cfg)
-        self.cost_critic = Critic(model_factory, obs_space, cfg)
+        self._init_cost_channels(num_costs)
+        self.cost_critic = Critic(model_factory, obs_space, cfg, num_outputs=num_costs)
         self.encoders.append(self.cost_critic.encoder)
 
     def forward_head(self, normalized_obs_dict: Dict[str, Tensor], values_only=False) -> Tuple[
@@ -421,7 +499,7 @@ class SafeActorCriticSeparateWeights(ActorCriticSeparateWeights):
             sample_actions: bool
     ) -> TensorDict:
         results = super().forward_tail(actor_core_output, critic_core_output, values_only, sample_actions)
-        cost_values = self.cost_critic.tail(cost_critic_core_output).squeeze()
+        cost_values = self._squeeze_cost_values(self.cost_critic.tail(cost_critic_core_output))
         results["cost_values"] = cost_values
         return results
 
@@ -465,6 +543,15 @@ class SafeActorCriticSeparateWeights(ActorCriticSeparateWeights):
 
         return result
 
+    def forward_values(
+        self, normalized_obs_dict: Dict[str, Tensor], rnn_states: Tensor, out: Optional[TensorDict] = None
+    ) -> TensorDict:
+        _, rnn_states_critic, rnn_states_cost_critic = rnn_states.chunk(3, dim=1)
+        values, cost_values = self._forward_critic_values(
+            [self.critic, self.cost_critic], normalized_obs_dict, [rnn_states_critic, rnn_states_cost_critic]
+        )
+        return self._values_result(dict(values=values, cost_values=cost_values), out)
+
 
 class ActorCriticSeparateWeightsOld(ActorCritic):
     def __init__(
@@ -588,12 +675,16 @@ class ActorCriticSeparateWeightsOld(ActorCritic):
 
 
 class ConstraintActorCritic(ActorCritic):
+    """
+    Separate actor, critic and cost critic towers (CPO). The heads and cores of the towers are given and returned as
+    [actor, critic, cost critic] lists, their RNN states are concatenated in this order.
+    """
 
     def __init__(self, model_factory, obs_space, action_space, cfg):
         super(ConstraintActorCritic, self).__init__(obs_space, action_space, cfg)
-        self.actor = Actor(model_factory, obs_space, action_space, cfg, 0)
-        self.critic = Critic(model_factory, obs_space, cfg, 1)
-        self.cost_critic = Critic(model_factory, obs_space, cfg, 2)
+        self.actor = Actor(model_factory, obs_space, action_space, cfg)
+        self.critic = Critic(model_factory, obs_space, cfg)
+        self.cost_critic = Critic(model_factory, obs_space, cfg)
         self.encoders = [self.actor.encoder, self.critic.encoder, self.cost_critic.encoder]
 
     def forward_head(self, normalized_obs_dict: Dict[str, Tensor], values_only=False) -> Tuple[
@@ -604,55 +695,62 @@ class ConstraintActorCritic(ActorCritic):
             return None, critic_head, cost_critic_head
         return self.actor.head(normalized_obs_dict), critic_head, cost_critic_head
 
-    def forward_core(self, head_output, rnn_states=None, values_only=False) -> Tuple[List[Tensor, Tensor, Tensor], List[
-        Tensor, Tensor, Tensor]]:
-        num_cores = len(self.encoders)
-        rnn_states = rnn_states.chunk(num_cores, dim=1)
+    def forward_core(self, head_output, rnn_states, values_only=False) -> Tuple[List[Optional[Tensor]], Tensor]:
+        towers = [self.actor, self.critic, self.cost_critic]
+        rnn_states = rnn_states.chunk(len(towers), dim=1)
 
         if isinstance(head_output, PackedSequence):
-            # We cannot chunk PackedSequence directly, we first have to unpack it,
-            # chunk, then pack chunks again to be able to process then through the cores.
-            # Finally we have to return concatenated outputs so we repeat the process,
-            # but this time using concatenation - unpack, cat and pack.
-
-            unpacked_head_output, lengths = pad_packed_sequence(head_output)
-            unpacked_head_output_split = unpacked_head_output.chunk(num_cores, dim=2)
+            # the concatenated heads of the towers, packed as one sequence (i.e. by Learner._minibatch_rnn_inputs())
+            # the features of the towers are split without changing the layout of the packed sequence,
+            # so that the core outputs can be unpacked with the indices of the original one
             head_output = [
-                pack_padded_sequence(unpacked_head_output_split[i], lengths, enforce_sorted=False)
-                for i in range(num_cores)
+                PackedSequence(data, head_output.batch_sizes, head_output.sorted_indices, head_output.unsorted_indices)
+                for data in head_output.data.chunk(len(towers), dim=1)
             ]
 
-        critic_core, new_rnn_states_critic = self.critic.core(head_output, rnn_states)
-        cost_critic_core, new_rnn_states_cost_critic = self.cost_critic.core(head_output, rnn_states)
-        if values_only:
-            return [Tensor(), critic_core, cost_critic_core], [Tensor(), new_rnn_states_critic,
-                                                               new_rnn_states_cost_critic]
-        actor_core, new_rnn_states_actor = self.actor.core(head_output, rnn_states)
-        return [actor_core, critic_core, cost_critic_core], [new_rnn_states_actor, new_rnn_states_critic,
-                                                             new_rnn_states_cost_critic]
+        core_outputs, new_rnn_states = [], []
+        for tower, tower_head_output, tower_rnn_states in zip(towers, head_output, rnn_states):
+            if values_only and tower is self.actor:
+                core_outputs.append(None)
+                new_rnn_states.append(torch.zeros_like(tower_rnn_states))
+                continue
+            core_output, tower_new_rnn_states = tower.core(tower_head_output, tower_rnn_states)
+            core_outputs.append(core_output)
+            new_rnn_states.append(tower_new_rnn_states)
+
+        return core_outputs, torch.cat(new_rnn_states, dim=1)
 
     def forward_tail(self, core_output, values_only: bool, sample_actions: bool) -> TensorDict:
-        values = self.critic.tail(core_output).squeeze()
-        cost_values = self.cost_critic.tail(core_output).squeeze()
+        actor_core_output, critic_core_output, cost_critic_core_output = core_output
+        values = self.critic.tail(critic_core_output).squeeze()
+        cost_values = self.cost_critic.tail(cost_critic_core_output).squeeze()
         result = TensorDict(values=values, cost_values=cost_values)
         if values_only:
             return result
-        result["action_logits"], self.last_action_distribution = self.actor.tail(core_output)
+        result["action_logits"], self.last_action_distribution = self.actor.tail(actor_core_output)
         self._maybe_sample_actions(sample_actions, result)
         return result
 
-    def forward(self, normalized_obs_dict, rnn_states=None, values_only=False):
+    def forward(self, normalized_obs_dict, rnn_states, values_only=False):
         head_outputs = self.forward_head(normalized_obs_dict, values_only)
         core_outputs, new_rnn_states = self.forward_core(head_outputs, rnn_states, values_only)
         result = self.forward_tail(core_outputs, values_only, sample_actions=True)
         result["new_rnn_states"] = new_rnn_states
-        # result["new_rnn_states_actor"] = new_rnn_states[0]
-        # result["new_rnn_states_critic"] = new_rnn_states[1]
-        # result["new_rnn_states_cost_critic"] = new_rnn_states[2]
         return result
 
+    def forward_values(
+        self, normalized_obs_dict: Dict[str, Tensor], rnn_states: Tensor, out: Optional[TensorDict] = None
+    ) -> TensorDict:
+        _, rnn_states_critic, rnn_states_cost_critic = rnn_states.chunk(3, dim=1)
+        values, cost_values = self._forward_critic_values(
+            [self.critic, self.cost_critic], normalized_obs_dict, [rnn_states_critic, rnn_states_cost_critic]
+        )
+        return self._values_result(dict(values=values, cost_values=cost_values), out)
+
 
-def default_make_actor_critic_func(cfg: Config, obs_space: ObsSpace, action_space: ActionSpace) -> ActorCritic:
+def default_make_actor_critic_func(
+    cfg: Config, obs_space: ObsSpace, action_space: ActionSpace, num_costs: int = 1
+) -> ActorCritic:
     from sample_factory.algo.utils.context import global_model_factory
 
     model_factory = global_model_factory()
@@ -664,9 +762,9 @@ def default_make_actor_critic_func(cfg: Config, obs_space: ObsSpace, action_spac
     elif cfg.algo in ["TRPO"]:
         return ActorCriticSeparateWeights(model_factory, obs_space, action_space, cfg)
     elif cfg.algo in ["TRPOLag", "TRPOPID"]:
-        return SafeActorCriticSeparateWeights(model_factory, obs_space, action_space, cfg)
+        return SafeActorCriticSeparateWeights(model_factory, obs_space, action_space, cfg, num_costs)
     elif cfg.algo in ["PPOLag", "PPOPID", "P3O"]:
-        return SafeActorCriticSharedWeights(model_factory, obs_space, action_space, cfg)
+        return SafeActorCriticSharedWeights(model_factory, obs_space, action_space, cfg, num_costs)
     elif cfg.algo == "PPOSaute":
         return ActorCriticSaute(model_factory, obs_space, action_space, cfg)
 
@@ -676,9 +774,20 @@ def default_make_actor_critic_func(cfg: Config, obs_space: ObsSpace, action_spac
         return ActorCriticSeparateWeights(model_factory, obs_space, action_space, cfg)
 
 
-def create_actor_critic(cfg: Config, obs_space: ObsSpace, action_space: ActionSpace) -> ActorCritic:
+def create_actor_critic(cfg: Config, obs_space: ObsSpace, action_space: ActionSpace, num_costs: int = 1) -> ActorCritic:
     # check if user specified custom actor/critic creation function
     from sample_factory.algo.utils.context import global_model_factory
 
     make_actor_critic_func = global_model_factory().make_actor_critic_func
-    return make_actor_critic_func(cfg, obs_space, action_space)
+    if num_costs == 1:
+        return make_actor_critic_func(cfg, obs_space, action_space)
+
+    # several constraint channels, only factories that know about them can build the models
+    try:
+        inspect.signature(make_actor_critic_func).bind(cfg, obs_space, action_space, num_costs=num_costs)
+    except TypeError:
+        raise TypeError(
+            f"The env has {num_costs} constraint channels, but the actor-critic factory {make_actor_critic_func} "
+            f"does not accept a num_costs keyword argument"
+        ) from None
+    return make_actor_critic_func(cfg, obs_space, action_space, num_costs=num_costs)
@@ -4,10 +4,12 @@ from sample_factory.model.actor_critic import ActorCritic, default_make_actor_cr
 from sample_factory.model.core import ModelCore, default_make_core_func
 from sample_factory.model.decoder import Decoder, default_make_decoder_func
 from sample_factory.model.encoder import Encoder, default_make_encoder_func
-from sample_factory.utils.typing import ActionSpace, Config, ObsSpace
+from sample_factory.utils.typing import Config, ObsSpace
 from sample_factory.utils.utils import log
 
-MakeActorCriticFunc = Callable[[Config, ObsSpace, ActionSpace], ActorCritic]
+# (cfg, obs_space, action_space), with several constraint channels also a num_costs keyword argument,
+# see create_actor_critic()
+MakeActorCriticFunc = Callable[..., ActorCritic]
 MakeEncoderFunc = Callable[[Config, ObsSpace], Encoder]
 MakeCoreFunc = Callable[[Config, int], ModelCore]
 MakeDecoderFunc = Callable[[Config, int], Decoder]
@@ -32,6 +34,8 @@ class ModelFactory:
     def register_actor_critic_factory(self, make_actor_critic_func: MakeActorCriticFunc):
         """
         Override the default actor-critic with a custom model.
+        Called as make_actor_critic_func(cfg, obs_space, action_space). Envs with several constraint channels
+        additionally pass num_costs=K, so the factory has to accept that keyword to train on them.
         """
         log.debug(f"register_actor_critic_factory: {make_actor_critic_func}")
         self.make_actor_critic_func = make_actor_critic_func
@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-from typing import Any, Dict, Iterable, List, Optional, OrderedDict
+from typing import Any, Dict, Iterable, List, Optional
 
 
 def dict_of_lists_append(d: Dict[Any, List], new_data):
@@ -26,7 +26,7 @@ def iterate_recursively(d):
 
     """
     for k, v in d.items():
-        if isinstance(v, (dict, OrderedDict)):
+        if isinstance(v, dict):
             yield from iterate_recursively(v)
         else:
             yield d, k, v
@@ -43,7 +43,7 @@ def iterate_recursively_with_prefix(d: Dict, prefix=None):
         prefix = []
 
     for k, v in d.items():
-        if isinstance(v, (dict, OrderedDict)):
+        if isinstance(v, dict):
             yield from iterate_recursively_with_prefix(v, prefix + [k])
         else:
             yield d, k, v, prefix
@@ -58,7 +58,7 @@ def copy_dict_structure(d):
 
 def _copy_dict_structure_func(d, d_copy):
     for key, value in d.items():
-        if isinstance(value, (dict, OrderedDict)):
+        if isinstance(value, dict):
             d_copy[key] = type(value)()
             _copy_dict_structure_func(value, d_copy[key])
         else:
@@ -74,7 +74,7 @@ def iter_dicts_recursively(d1, d2):
     for k, v in d1.items():
         assert k in d2
 
-        if isinstance(v, (dict, OrderedDict)):
+        if isinstance(v, dict):
             yield from iter_dicts_recursively(d1[k], d2[k])
         else:
             yield d1, d2, k, d1[k], d2[k]
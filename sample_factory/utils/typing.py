@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 import argparse
-from typing import Any, Callable, Dict, Optional, Tuple, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import torch
 from gymnasium import spaces
@@ -24,6 +24,8 @@ ObsSpace = Union[spaces.Space, spaces.Dict]
 ActionSpace = spaces.Space
 
 CreateEnvFunc = Callable[[str, Optional[Config], Optional[AttrDict], Optional[str]], Env]
+# creates a single env object that simulates a whole vector of env instances, or returns None if it can't
+CreateBatchedEnvFunc = Callable[[Config, List[AttrDict]], Optional[Env]]
 
 # there currenly isn't a single class all distributions derive from, but we gotta use something for the type hint
 ActionDistribution = Any